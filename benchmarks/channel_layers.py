@@ -0,0 +1,86 @@
+"""
+    Fan-out throughput of the in-process channel layers.
+
+    Puts `--members` channels in one group, each drained by its own task the
+    way a consumer would, then times `--messages` group sends until every
+    member has received every message.
+
+    python -m benchmarks.channel_layers --members 5000 --messages 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_application.settings")
+
+import django
+
+django.setup()
+
+from channels.layers import InMemoryChannelLayer
+from chat.layers import ShardedInMemoryChannelLayer
+
+
+async def run(layer, members, messages):
+    group = "bench"
+    channels = [await layer.new_channel() for _ in range(members)]
+    for channel in channels:
+        await layer.group_add(group, channel)
+
+    remaining = members
+    done = asyncio.Event()
+
+    async def drain(channel):
+        nonlocal remaining
+        for _ in range(messages):
+            await layer.receive(channel)
+        remaining -= 1
+        if not remaining:
+            done.set()
+
+    tasks = [asyncio.create_task(drain(channel)) for channel in channels]
+    await asyncio.sleep(0)
+
+    payload = {"type": "chat_message", "text": json.dumps({"message": "x" * 64, "sender": "bench"})}
+    start = time.perf_counter()
+    for _ in range(messages):
+        await layer.group_send(group, payload)
+        await asyncio.sleep(0)  # Let the receivers run, as a real event loop would
+    await done.wait()
+    elapsed = time.perf_counter() - start
+
+    for task in tasks:
+        task.cancel()
+    await layer.flush()
+
+    deliveries = members * messages
+    return {
+        "seconds": round(elapsed, 4),
+        "group_sends_per_sec": round(messages / elapsed, 1),
+        "deliveries_per_sec": round(deliveries / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=100)
+    args = parser.parse_args()
+
+    # Capacity covers the whole run so neither layer drops messages
+    layers = {
+        "channels.InMemoryChannelLayer": InMemoryChannelLayer(capacity=args.messages + 1),
+        "chat.ShardedInMemoryChannelLayer": ShardedInMemoryChannelLayer(capacity=args.messages + 1),
+    }
+    results = {
+        "members": args.members,
+        "messages": args.messages,
+        "layers": {name: asyncio.run(run(layer, args.members, args.messages)) for name, layer in layers.items()},
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+    Throughput of the conversation history read path.
+
+    Seeds one conversation of `--messages` messages on a throwaway test
+    database, then renders `--pages` history pages of `--page-size` rows
+    through:
+
+    drf      `MessageSerializer` over `Message` instances and DRF's JSON
+             renderer, the way generic list views do it
+    history  `chat.history`: value tuples, names resolved in one batch,
+             JSON bytes built directly
+
+    Both paths run the same keyset query; queries per page are reported too.
+
+    python -m benchmarks.history_read --messages 20000 --page-size 200 --pages 50
+"""
+import argparse
+import json
+import os
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_application.settings")
+
+import django
+
+django.setup()
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from chat import history
+from chat.models import Message, User
+from chat.pagination import KeysetPagination
+from chat.serializers import MessageSerializer
+from chat.user_cache import get_user_cache
+
+
+def seed(count):
+    a, b = User.objects.bulk_create([
+        User(email=f"history-bench-{i}-{time.time_ns()}@example.com", name=f"Bench {i}") for i in range(2)
+    ])
+    messages = [
+        Message(sender=a if i % 2 else b, receiver=b if i % 2 else a, content=f"message {i} " + "x" * 60)
+        for i in range(count)
+    ]
+    Message.objects.bulk_create(messages, batch_size=1000)
+    return a, b
+
+
+def conversation(a, b):
+    return [Message.objects.filter(sender=a, receiver=b), Message.objects.filter(sender=b, receiver=a)]
+
+
+def drf_page(querysets, page_size):
+    rows = KeysetPagination().fetch(querysets, None, False, page_size)
+    return JSONRenderer().render({"previous": None, "next": None, "results": MessageSerializer(rows, many=True).data})
+
+
+def history_page(querysets, page_size):
+    rows = history.HistoryPagination().fetch(querysets, None, False, page_size)
+    return history.render_page(rows, None, None)
+
+
+def measure(render, querysets, page_size, pages):
+    render(querysets, page_size)  # Warm up
+    with CaptureQueriesContext(connection) as queries:
+        render(querysets, page_size)
+    start = time.perf_counter()
+    size = 0
+    for _ in range(pages):
+        size = len(render(querysets, page_size))
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": round(elapsed, 4),
+        "rows_per_sec": round(page_size * pages / elapsed, 1),
+        "queries_per_page": len(queries.captured_queries),
+        "page_bytes": size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=50)
+    args = parser.parse_args()
+
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    settings.DEBUG = False  # Only log the queries measure() captures
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        querysets = conversation(*seed(args.messages))
+        get_user_cache().clear()
+        results = {
+            "messages": args.messages,
+            "page_size": args.page_size,
+            "pages": args.pages,
+            "paths": {
+                "drf": measure(drf_page, querysets, args.page_size, args.pages),
+                "history": measure(history_page, querysets, args.page_size, args.pages),
+            },
+        }
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+    Write contention on SQLite, with and without WAL and the writer thread.
+
+    `--threads` threads each perform `--writes` small write transactions
+    (alternately a login timestamp update and a message insert, with its
+    inbox summary and outbox signals) while one more thread keeps reading
+    history pages. Each mode runs on a fresh database file:
+
+    rollback   default journal, deferred transactions, direct writes
+    wal        the SQLITE_PRAGMAS + IMMEDIATE transactions of the settings
+    wal+writer the same, with writes going through `chat.db_writer`
+
+    Reports writes/sec, write and read latency percentiles and the number of
+    "database is locked" failures.
+
+    python -m benchmarks.sqlite_contention --threads 16 --writes 200
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_application.settings")
+
+import django
+
+django.setup()
+
+from django.conf import settings
+from django.db import OperationalError, connection, connections
+from django.utils import timezone
+from chat.db_writer import DatabaseWriter
+from chat.models import Message, User
+
+MODES = {
+    "rollback": ({"timeout": 5}, False),
+    "wal": ({"init_command": ";".join(settings.SQLITE_PRAGMAS), "transaction_mode": "IMMEDIATE", "timeout": 20}, False),
+    "wal+writer": ({"init_command": ";".join(settings.SQLITE_PRAGMAS), "transaction_mode": "IMMEDIATE", "timeout": 20},
+                   True),
+}
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] * 1000, 2)
+
+
+def write(op, user, other):
+    if op % 2:
+        User.objects.filter(pk=user.pk).update(last_login=timezone.now())
+    else:
+        Message.objects.create(sender=user, receiver=other, content=f"contention {op}")
+
+
+def run_mode(name, options, use_writer, args, directory):
+    db = connections["default"]
+    db.close()
+    db.settings_dict["OPTIONS"] = options
+    db.settings_dict["TEST"]["NAME"] = os.path.join(directory, f"{name.replace('+', '_')}.sqlite3")
+    old_name = db.creation.create_test_db(verbosity=0)
+    writer = DatabaseWriter(enabled=True) if use_writer else None
+    try:
+        users = User.objects.bulk_create([
+            User(email=f"contention-{i}@example.com", name=f"Contention {i}") for i in range(args.threads + 1)
+        ])
+        write_latencies, read_latencies, locked, errors = [], [], [0], [0]
+        lock = threading.Lock()
+        stop_reading = threading.Event()
+
+        def writer_thread(index):
+            user, other = users[index], users[-1]
+            samples = []
+            for op in range(args.writes):
+                start = time.perf_counter()
+                try:
+                    if writer is not None:
+                        writer.call(write, op, user, other)
+                    else:
+                        write(op, user, other)
+                    samples.append(time.perf_counter() - start)
+                except OperationalError as e:
+                    with lock:
+                        if "locked" in str(e):
+                            locked[0] += 1
+                        else:
+                            errors[0] += 1
+            with lock:
+                write_latencies.extend(samples)
+            connection.close()
+
+        def reader_thread():
+            other = users[-1]
+            while not stop_reading.is_set():
+                start = time.perf_counter()
+                try:
+                    list(Message.objects.filter(receiver=other).order_by('-timestamp', '-id')
+                         .values_list('id', 'content', 'timestamp')[:50])
+                    read_latencies.append(time.perf_counter() - start)
+                except OperationalError:
+                    with lock:
+                        locked[0] += 1
+            connection.close()
+
+        reader = threading.Thread(target=reader_thread)
+        reader.start()
+        threads = [threading.Thread(target=writer_thread, args=(i,)) for i in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        stop_reading.set()
+        reader.join()
+
+        return {
+            "seconds": round(elapsed, 3),
+            "writes_per_sec": round(len(write_latencies) / elapsed, 1),
+            "write_p50_ms": percentile(write_latencies, 0.5),
+            "write_p99_ms": percentile(write_latencies, 0.99),
+            "read_p50_ms": percentile(read_latencies, 0.5),
+            "read_p99_ms": percentile(read_latencies, 0.99),
+            "reads": len(read_latencies),
+            "database_locked": locked[0],
+            "other_errors": errors[0],
+            "writer_jobs_per_batch": writer.stats()["jobs_per_batch"] if writer is not None else None,
+        }
+    finally:
+        if writer is not None:
+            writer.stop()
+        db.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--writes", type=int, default=200, help="Write transactions per thread.")
+    parser.add_argument("--modes", default=",".join(MODES), help="Comma-separated subset of the modes.")
+    args = parser.parse_args()
+
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    settings.DEBUG = False
+
+    directory = tempfile.mkdtemp(prefix="chat-contention-")
+    try:
+        results = {
+            "threads": args.threads,
+            "writes_per_thread": args.writes,
+            "modes": {
+                name: run_mode(name, *MODES[name], args, directory) for name in args.modes.split(",")
+            },
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""
+    Load generator and latency benchmark for the WebSocket endpoints.
+
+    Simulates `--clients` connections authenticated with generated JWTs and
+    has some of them send messages, measuring send -> deliver latency.
+
+    --mode room       everyone joins ws/chat/<room>/, `--senders` of them talk
+    --mode onetoone   clients are paired on ws/onetone/<user_id>/ and both
+                      sides of each pair talk
+
+    By default everything runs in-process through channels'
+    WebsocketCommunicator, on a throwaway test database and the in-process
+    channel layer, so DB queries and memory per connection can be measured
+    too. With `--url ws://127.0.0.1:8000` the clients connect to a running
+    daphne instead; users are then created in the configured database.
+
+    Inbound rate limits (`CHAT_RATE_LIMITS`) are turned off in-process so
+    they don't skew comparisons; `--rate-limits` keeps the configured ones.
+    Throttled frames (in-process), the error frames clients got (throttle
+    errors are coalesced, so fewer) and connections the server closed are
+    counted in the report. A remote server applies its own settings.
+
+    python -m benchmarks.websocket_load --mode onetoone --clients 2000 --messages 20 --output before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_application.settings")
+os.environ.setdefault("CHANNEL_BACKEND", "memory")
+
+import django
+
+django.setup()
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+from rest_framework_simplejwt.tokens import AccessToken
+from chat import metrics
+from chat.models import User
+from chat.writer import get_message_writer
+
+MARKER = "bench|"
+
+
+class QueryCounter:
+    """Counts queries on every DB connection, including the ORM thread pool's."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        connection.execute_wrappers.append(self)
+        connection_created.connect(self.on_connection_created, weak=False)
+
+    def on_connection_created(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+class InProcessClient:
+
+    def __init__(self, application, path):
+        self.communicator = WebsocketCommunicator(application, path)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=60)
+        if not connected:
+            raise RuntimeError("WebSocket handshake rejected")
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def recv(self, timeout):
+        return await self.communicator.receive_from(timeout=timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class RemoteClient:
+
+    def __init__(self, base_url, path):
+        self.uri = base_url.rstrip("/") + path
+
+    async def connect(self):
+        import websockets
+        self.websocket = await websockets.connect(self.uri, max_queue=None)
+
+    async def send(self, text):
+        await self.websocket.send(text)
+
+    async def recv(self, timeout):
+        return await asyncio.wait_for(self.websocket.recv(), timeout)
+
+    async def close(self):
+        await self.websocket.close()
+
+
+def create_users(count):
+    users = [User(email=f"bench-{i}-{time.time_ns()}@example.com", name=f"Bench {i}") for i in range(count)]
+    for user in users:
+        user.set_unusable_password()
+    return User.objects.bulk_create(users, batch_size=500)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return round(samples[index] * 1000, 3)
+
+
+def plan(args, users):
+    """Return (paths, senders, deliveries expected per client)."""
+    tokens = [str(AccessToken.for_user(user)) for user in users]
+    if args.mode == "room":
+        paths = [f"/ws/chat/bench/?token={token}" for token in tokens]
+        senders = list(range(min(args.senders, len(paths))))
+        expected = [
+            args.messages * (len(senders) - (1 if index in senders else 0))
+            for index in range(len(paths))
+        ]
+        return paths, senders, expected
+
+    paths = []
+    for index, token in enumerate(tokens):
+        partner = users[index ^ 1]
+        paths.append(f"/ws/onetone/{partner.id}/?token={token}")
+    senders = list(range(len(paths)))
+    expected = [args.messages] * len(paths)
+    return paths, senders, expected
+
+
+async def run(args):
+    clients_count = args.clients - args.clients % 2 if args.mode == "onetoone" else args.clients
+    counter = QueryCounter()
+    if not args.url:
+        counter.install()
+    users = await asyncio.to_thread(create_users, clients_count)
+    paths, senders, expected = plan(args, users)
+
+    if args.url:
+        clients = [RemoteClient(args.url, path) for path in paths]
+    else:
+        from chat_application.asgi import application
+        clients = [InProcessClient(application, path) for path in paths]
+
+    # Connect, measuring memory held per open connection
+    if not args.url:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with semaphore:
+            await client.connect()
+            await client.recv(timeout=30)  # Welcome frame
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in clients))
+    connect_seconds = time.perf_counter() - start
+    memory_per_connection = None
+    if not args.url:
+        memory_per_connection = (tracemalloc.get_traced_memory()[0] - baseline) / len(clients)
+        tracemalloc.stop()
+
+    latencies = []
+    delivered = 0
+    errors = {}
+    closed = 0
+
+    async def receive(client, count):
+        nonlocal delivered, closed
+        while count:
+            try:
+                frame = json.loads(await client.recv(timeout=args.idle_timeout))
+            except asyncio.TimeoutError:
+                return
+            except Exception:
+                closed += 1  # Closed by the server, e.g. after being throttled too often
+                return
+            if frame.get("type") == "error":
+                errors[frame.get("error")] = errors.get(frame.get("error"), 0) + 1
+                continue
+            message = frame.get("message", "")
+            if isinstance(message, str) and message.startswith(MARKER):
+                latencies.append(time.time() - float(message[len(MARKER):]))
+                delivered += 1
+                count -= 1
+
+    async def send(client):
+        for _ in range(args.messages):
+            await client.send(json.dumps({"message": f"{MARKER}{time.time()}", "sender": "bench"}))
+            if args.interval:
+                await asyncio.sleep(args.interval)
+
+    counter.count = 0
+    throttled_before = metrics.THROTTLED.total()
+    # Deliveries lost per throttled message: one per other room member, or the partner
+    lost_per_throttle = len(clients) - 1 if args.mode == "room" else 1
+    receivers = [asyncio.create_task(receive(client, count)) for client, count in zip(clients, expected)]
+    start = time.perf_counter()
+    await asyncio.gather(*(send(clients[index]) for index in senders))
+    send_seconds = time.perf_counter() - start
+    # Stop as soon as everything that wasn't throttled has arrived, rather than at the idle timeout
+    while not all(receiver.done() for receiver in receivers):
+        throttled = metrics.THROTTLED.total() - throttled_before
+        if not args.url and delivered >= sum(expected) - throttled * lost_per_throttle:
+            break
+        await asyncio.sleep(0.01)
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    throttled = metrics.THROTTLED.total() - throttled_before if not args.url else None
+    deliver_seconds = time.perf_counter() - start
+    if not args.url:
+        await get_message_writer().close()
+
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+    sent = len(senders) * args.messages
+    latencies.sort()
+    return {
+        "mode": args.mode,
+        "transport": args.url or "in-process",
+        "clients": len(clients),
+        "senders": len(senders),
+        "messages_sent": sent,
+        "deliveries_expected": sum(expected),
+        "deliveries": delivered,
+        "connect_seconds": round(connect_seconds, 3),
+        "send_seconds": round(send_seconds, 3),
+        "deliver_seconds": round(deliver_seconds, 3),
+        "sent_per_sec": round(sent / send_seconds, 1) if send_seconds else None,
+        "delivered_per_sec": round(delivered / deliver_seconds, 1) if deliver_seconds else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": percentile(latencies, 1.0),
+        },
+        "rate_limits": args.rate_limits or bool(args.url),
+        "throttled_frames": throttled,
+        "error_frames": errors,
+        "closed_by_server": closed,
+        "db_queries_per_message": round(counter.count / sent, 3) if sent and not args.url else None,
+        "memory_per_connection_bytes": round(memory_per_connection) if memory_per_connection is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["room", "onetoone"], default="room")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--senders", type=int, default=10, help="Talking clients in room mode.")
+    parser.add_argument("--messages", type=int, default=20, help="Messages per sender.")
+    parser.add_argument("--interval", type=float, default=0.0, help="Pause between one sender's messages.")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--idle-timeout", type=float, default=10.0,
+                        help="Give up on a client that receives nothing for this long.")
+    parser.add_argument("--url", help="Base ws:// URL of a running server instead of in-process.")
+    parser.add_argument("--output", help="Write the JSON report to this file as well.")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="Keep the configured inbound rate limits in-process instead of turning them off.")
+    args = parser.parse_args()
+
+    if not args.url and not args.rate_limits:
+        settings.CHAT_RATE_LIMITS = {**settings.CHAT_RATE_LIMITS, "CONNECTION": None, "USER": None, "ACTIONS": {}}
+
+    if not args.url:
+        from django.test.utils import setup_test_environment
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if not args.url:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
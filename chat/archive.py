@@ -0,0 +1,168 @@
+"""
+    Cold storage for old messages.
+
+    Each conversation gets a directory under `CHAT_ARCHIVE["ROOT"]` holding:
+    - `segment.dat`: append-only zlib-compressed blocks, each a MessagePack
+      list of up to `BLOCK_SIZE` messages in (timestamp, id) order
+    - `index.dat`: one fixed-size record per block with its first and last
+      (timestamp, id) key, byte offset, length and message count
+
+    Reads go through the index to the blocks holding the requested key range
+    and decompress just those out of an mmap of the segment, so a history
+    page never loads a whole segment. Archived messages are read-only:
+    nothing could mark one seen later, so archiving counts as reading.
+    `archive_messages` stores every message as seen and takes the unseen
+    ones off the inbox unread counters. Archived messages also drop out of
+    the search index.
+"""
+import mmap
+import os
+import struct
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+import msgpack
+from django.conf import settings
+from .models import ConversationSummary, Message
+
+# first ts, first id, last ts, last id, offset, length, count
+INDEX_RECORD = struct.Struct("<q16sq16sQII")
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_micros(timestamp):
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def archive_key(key):
+    """(timestamp, UUID) -> the (microseconds, id bytes) form the index compares on."""
+    timestamp, pk = key
+    return to_micros(timestamp), uuid.UUID(str(pk)).bytes
+
+
+def get_archive_root():
+    return getattr(settings, "CHAT_ARCHIVE", {}).get("ROOT", os.path.join(settings.BASE_DIR, "archive"))
+
+
+def archived_conversations(root=None):
+    """The (low, high) user id pairs that have an archive."""
+    root = root or get_archive_root()
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return []
+    pairs = []
+    for name in names:
+        try:
+            low, high = name.split("_")
+            pairs.append((uuid.UUID(low), uuid.UUID(high)))
+        except ValueError:
+            continue
+    return pairs
+
+
+class ConversationArchive:
+    """Archived messages of the conversation between two users."""
+
+    def __init__(self, user_a_id, user_b_id, root=None):
+        # Parsed as UUIDs first: the ids end up in a path
+        low, high = ConversationSummary.pair(uuid.UUID(str(user_a_id)), uuid.UUID(str(user_b_id)))
+        self.directory = os.path.join(root or get_archive_root(), f"{low}_{high}")
+        self.segment_path = os.path.join(self.directory, "segment.dat")
+        self.index_path = os.path.join(self.directory, "index.dat")
+
+    def read_index(self):
+        """The block records; a torn record left by a crash mid-append is ignored."""
+        try:
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        return [
+            ((first_ts, first_id), (last_ts, last_id), offset, length, count)
+            for first_ts, first_id, last_ts, last_id, offset, length, count
+            in INDEX_RECORD.iter_unpack(data[:usable])
+        ]
+
+    def last_key(self):
+        """Key of the newest archived message, as (microseconds, id bytes), or None."""
+        blocks = self.read_index()
+        return blocks[-1][1] if blocks else None
+
+    def append(self, rows):
+        """
+            Append one block of (id, sender_id, receiver_id, content, timestamp,
+            seen) rows, oldest first and all newer than `last_key()`. The block
+            is on disk before its index record, so a crash in between only
+            leaves unreferenced bytes at the end of the segment.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        packed = [
+            [uuid.UUID(str(pk)).bytes, uuid.UUID(str(sender_id)).bytes, uuid.UUID(str(receiver_id)).bytes,
+             content, to_micros(timestamp), seen]
+            for pk, sender_id, receiver_id, content, timestamp, seen in rows
+        ]
+        block = zlib.compress(msgpack.packb(packed, use_bin_type=True))
+
+        with open(self.segment_path, "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+
+        first, last = packed[0], packed[-1]
+        record = INDEX_RECORD.pack(first[4], first[0], last[4], last[0], offset, len(block), len(packed))
+        with open(self.index_path, "ab") as f:
+            # Drop a torn record from an earlier crash so the new one stays aligned
+            size = f.seek(0, os.SEEK_END)
+            if size % INDEX_RECORD.size:
+                f.truncate(size - size % INDEX_RECORD.size)
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def fetch(self, key, newer, limit):
+        """
+            Up to `limit` archived messages past the (timestamp, id) `key`
+            (from the newest/oldest end when it's None), nearest first, as
+            unsaved `Message` objects, the same order `KeysetPagination.fetch`
+            uses.
+        """
+        blocks = self.read_index()
+        if not blocks or limit <= 0:
+            return []
+        bound = archive_key(key) if key is not None else None
+
+        if newer:
+            candidates = [block for block in blocks if bound is None or block[1] > bound]
+        else:
+            candidates = [block for block in reversed(blocks) if bound is None or block[0] < bound]
+        if not candidates:
+            return []
+
+        rows = []
+        with open(self.segment_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+            for _, _, offset, length, _ in candidates:
+                block = msgpack.unpackb(zlib.decompress(segment[offset:offset + length]), raw=False)
+                if not newer:
+                    block.reverse()
+                for pk, sender_id, receiver_id, content, micros, seen in block:
+                    if bound is not None and ((micros, pk) <= bound if newer else (micros, pk) >= bound):
+                        continue
+                    rows.append(Message(
+                        id=uuid.UUID(bytes=pk),
+                        sender_id=uuid.UUID(bytes=sender_id),
+                        receiver_id=uuid.UUID(bytes=receiver_id),
+                        content=content,
+                        timestamp=from_micros(micros),
+                        seen=seen,
+                    ))
+                    if len(rows) == limit:
+                        return rows
+        return rows
+
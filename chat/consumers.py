@@ -1,209 +1,785 @@
-import json
-from asgiref.sync import sync_to_async
+import asyncio
+import functools
+import logging
+import time
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .models import Message, User
+from .models import Message, Room, RoomMessage, User
 from channels.db import database_sync_to_async
 from datetime import datetime
-from channels.layers import get_channel_layer
-
-
-channel_layer = get_channel_layer()
+from django.conf import settings
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+from .writer import get_message_writer, get_room_message_writer
+from .rooms import get_room_registry, message_entry, room_group_name
+from .db_writer import database_write
+from .summaries import record_seen
+from .history_cache import get_history_cache
+from .user_cache import get_user_cache
+from .presence import get_presence
+from . import wire
+from .outbound import OutboundQueue, RESYNC_CLOSE_CODE, transport_backlog
+from .outbox import chat_message_event, conversation_group_name, get_outbox_dispatcher
+from .outbox import send_seen_to_participants, send_to_participants, user_group_name
+from .pagination import KeysetPagination, decode_cursor, encode_cursor
+from . import metrics, profiling, ratelimit
+
+logger = logging.getLogger(__name__)
+
+
+class WireProtocolMixin:
+    """
+        Frame encoding shared by the chat consumers: JSON text frames by
+        default, binary MessagePack frames when the client negotiated the
+        `msgpack` subprotocol (see `chat.wire`).
+
+        Outbound frames go through a bounded per-connection queue (see
+        `chat.outbound.OutboundQueue`). Clients connecting with `?batch=1`
+        get them coalesced into array frames. A client that falls further
+        behind than the queue allows is closed with `RESYNC_CLOSE_CODE` and
+        is expected to reload history before reconnecting.
+    """
+
+    # Value of the `consumer` label on this consumer's metrics
+    metrics_label = None
+
+    async def accept_negotiated(self):
+        self.wire_format = wire.negotiate(self.scope)
+        batching = getattr(settings, "CHAT_OUTBOUND_BATCHING", {})
+        limits = getattr(settings, "CHAT_OUTBOUND_QUEUE", {})
+        self.outbound = OutboundQueue(
+            self.write_frame,
+            binary=self.wire_format == wire.MSGPACK,
+            batching=wire.wants_batching(self.scope),
+            window=batching.get("WINDOW", 0.005),
+            max_frames=batching.get("MAX_FRAMES", 64),
+            max_bytes=batching.get("MAX_BYTES", 65536),
+            max_depth=limits.get("MAX_DEPTH", 1000),
+            max_queue_bytes=limits.get("MAX_BYTES", 4 * 1024 * 1024),
+            policy=limits.get("POLICY", "coalesce"),
+            on_overflow=self.outbound_overflow,
+            backlog=transport_backlog(self.base_send),
+            high_water=limits.get("TRANSPORT_HIGH_WATER", 256 * 1024),
+        )
+        await self.accept(subprotocol=self.wire_format)
+        metrics.WS_CONNECTS.labels(self.metrics_label).inc()
+
+    async def write_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def send_payload(self, payload, ephemeral=False, key=None):
+        """
+            Encode and queue a payload meant for this connection only.
+            `ephemeral` frames may be dropped when the client falls behind;
+            a newer frame with the same `key` may replace a queued one.
+        """
+        if self.wire_format == wire.MSGPACK:
+            self.outbound.put(wire.encode_binary(payload), ephemeral, key)
+        else:
+            self.outbound.put(wire.encode_text(payload), ephemeral, key)
+
+    async def send_encoded(self, event, ephemeral=False, key=None):
+        """Queue a broadcast frame that was encoded once by `wire.encode_frames`."""
+        self.outbound.put(event["bin"] if self.wire_format == wire.MSGPACK else event["text"], ephemeral, key)
+
+    def record_delivery(self, event):
+        """Count a chat message handed to this socket and how long it took since it was received."""
+        metrics.MESSAGES_DELIVERED.labels(self.metrics_label).inc()
+        received_at = event.get("received_at")
+        if received_at is not None:
+            metrics.DELIVER_SECONDS.observe(time.time() - received_at)
+
+    async def outbound_overflow(self):
+        """The client stopped reading; close so it reconnects and resyncs from history."""
+        logger.warning("Outbound queue overflow, closing %s", self.channel_name)
+        await self.close(code=RESYNC_CLOSE_CODE)
+
+    def close_outbound(self):
+        if getattr(self, "outbound", None) is not None:
+            self.outbound.discard()
+
+    async def invalid_frame(self, error):
+        """Answer a frame that couldn't be decoded (bad JSON or MessagePack, not an object)."""
+        metrics.ERRORS.labels("decode").inc()
+        logger.info("Invalid frame from %s: %s", self.channel_name, error)
+        await self.send_payload({"type": "error", "error": "invalid_frame"}, ephemeral=True, key="invalid_frame")
+
+    async def handle_wire_action(self, action, data):
+        """Handle connection-level actions; returns False when `action` isn't one of them."""
+        if action == "outbound_stats":
+            await self.send_payload({"type": "outbound_stats", **self.outbound.stats()}, ephemeral=True)
+            return True
+        return False
+
+
+class RateLimitMixin:
+    """
+        Inbound rate limits shared by the chat consumers (see
+        `chat.ratelimit`). `admit_frame` runs before a frame is decoded and
+        `admit_action` once its action is known; a throttled frame is
+        answered with a `rate_limited` error frame. A connection throttled
+        `CLOSE_AFTER` frames in a row is closed with `RATE_LIMIT_CLOSE_CODE`.
+    """
+
+    async def start_rate_limits(self):
+        self.rate_limits = ratelimit.connection_limiter()
+        self.rate_limit_close_after = ratelimit.get_options()["CLOSE_AFTER"]
+        self.throttled_in_a_row = 0
+        self.throttle_closed = False
+        user = self.scope.get("user")
+        self.rate_limit_user_id = str(user.id) if user is not None and user.is_authenticated else None
+        self.user_limiter = ratelimit.get_user_limiter() if self.rate_limit_user_id is not None else None
+        if self.user_limiter is not None:
+            await self.user_limiter.ensure_started()
+
+    async def admit_frame(self, text_data=None, bytes_data=None):
+        """Size, per-connection and per-user limits; False when the frame must be dropped."""
+        if self.throttle_closed:
+            return False  # Frames already in flight when we closed
+        now = time.monotonic()
+        # Characters for text frames: a cheap lower bound of the encoded size
+        size = len(bytes_data) if bytes_data is not None else len(text_data or "")
+        throttled = self.rate_limits.check_frame(size, now)
+        if throttled is None and self.user_limiter is not None:
+            throttled = self.user_limiter.check(self.rate_limit_user_id, now)
+        if throttled is None:
+            return True
+        await self.throttle(*throttled)
+        return False
+
+    async def admit_action(self, action):
+        """Per-action limit; False when the action must be skipped."""
+        throttled = self.rate_limits.check_action(action, time.monotonic())
+        if throttled is None:
+            self.throttled_in_a_row = 0
+            return True
+        await self.throttle(*throttled, action=action)
+        return False
+
+    async def throttle(self, scope, retry_after, action=None):
+        metrics.THROTTLED.labels(self.metrics_label, scope).inc()
+        self.throttled_in_a_row += 1
+        if self.rate_limit_close_after and self.throttled_in_a_row >= self.rate_limit_close_after:
+            self.throttle_closed = True
+            metrics.THROTTLE_CLOSES.labels(self.metrics_label).inc()
+            logger.warning("Closing %s after %s throttled frames", self.channel_name, self.throttled_in_a_row)
+            await self.close(code=ratelimit.RATE_LIMIT_CLOSE_CODE)
+            return
+        # One pending error frame at most, so a flood can't grow the outbound queue
+        await self.send_payload({
+            "type": "error",
+            "error": "rate_limited",
+            "scope": scope,
+            "action": action,
+            "retry_after": round(retry_after, 3) if retry_after is not None else None,
+        }, ephemeral=True, key="rate_limited")
+
+
+class PresenceMixin:
+    """
+        Presence tracking shared by the chat consumers: registers the
+        connection on connect, handles `heartbeat` and `presence` actions and
+        unregisters on disconnect. Anonymous connections are not tracked.
+    """
+    MAX_PRESENCE_QUERY = 500
+
+    async def join_presence(self):
+        user = self.scope.get("user")
+        self.presence_user_id = str(user.id) if user is not None and user.is_authenticated else None
+        if self.presence_user_id is not None:
+            presence = get_presence()
+            presence.connect(self.presence_user_id, self.channel_name)
+            await presence.ensure_started()
+
+    def leave_presence(self):
+        if getattr(self, "presence_user_id", None) is not None:
+            get_presence().disconnect(self.presence_user_id, self.channel_name)
+
+    async def handle_presence_action(self, action, data):
+        """Handle presence actions; returns False when `action` isn't one of them."""
+        if action == "heartbeat":
+            if self.presence_user_id is not None:
+                get_presence().heartbeat(self.presence_user_id, self.channel_name)
+            return True
+        if action == "presence":
+            user_ids = data.get("user_ids", [])
+            if not isinstance(user_ids, list) or not all(isinstance(user_id, str) for user_id in user_ids):
+                await self.invalid_frame("user_ids is not a list of user ids")
+                return True
+            user_ids = user_ids[:self.MAX_PRESENCE_QUERY]
+            await self.send_payload({
+                "type": "presence",
+                "online": get_presence().online(user_ids),
+            }, ephemeral=True)
+            return True
+        return False
+
+
+class ConversationMixin:
+    """
+        Sending messages and read receipts in one-to-one conversations,
+        shared by the per-conversation consumer and the multiplexed per-user
+        one. Both go to the conversation's group, for per-conversation
+        sockets, and to the participants' user groups, for `ws/user/`
+        sockets (see `chat.outbox`).
+    """
+
+    def start_conversations(self):
+        self.user_id = str(self.scope["user"].id)
+        # Read receipts waiting to be written, by the other user's id (see `mark_messages_seen`)
+        self.pending_seen = {}
+        self.seen_flush_task = None
+
+    async def stop_conversations(self):
+        """Write the receipts still waiting for their window."""
+        if self.seen_flush_task is not None:
+            self.seen_flush_task.cancel()
+            self.seen_flush_task = None
+        await self.flush_seen()
+
+    async def send_message(self, receiver_id, message, received_at):
+        """Save a message from this user and deliver it; returns its id, or None if it wasn't saved."""
+        with profiling.stage("persist"):
+            message_id = await self.save_message(self.user_id, receiver_id, message)
+        if message_id is None:
+            return None
+        metrics.PERSIST_SECONDS.observe(time.time() - received_at)
+
+        # Cached user so a renamed sender shows up without a query per message
+        with profiling.stage("user_lookup"):
+            sender = await get_user_cache().aget(self.user_id)
+
+        # Encoded once per format and group; members just write it out
+        delivery = (message_id, self.user_id, receiver_id, message, getattr(sender, "name", "Unknown"), received_at)
+        with profiling.stage("encode"):
+            event = chat_message_event(*delivery)
+        with metrics.GROUP_SEND_SECONDS.labels(self.metrics_label).time(), profiling.stage("group_send"):
+            await self.channel_layer.group_send(conversation_group_name(self.user_id, receiver_id), event)
+            await send_to_participants(self.channel_layer, *delivery)
+        return message_id
 
-async def send_chat_message(sender, receiver, message):
-    """ Sends message only to the receiver's WebSocket group """
-    await channel_layer.group_send(
-        f"chat_{receiver}",  
-        {
-            "type": "chat_message",
-            "message": message,
-            "sender": sender
-        }
-    )       
+    async def save_message(self, sender_id, receiver_id, message):
+        """
+            Queue the chat message on the write-behind writer. Depending on the
+            durability mode this returns once the batch is committed or right
+            after the message is queued.
+        """
+        try:
+            chat_message = await get_message_writer().save(sender_id, receiver_id, message)
+            return str(chat_message.id)  # Return message ID
+        except Exception:
+            metrics.ERRORS.labels("save_message").inc()
+            logger.exception("Database save error")
+            return None
+
+    async def mark_messages_seen(self, other_user_id, message_ids):
+        """
+            Queue messages from `other_user_id` to be marked as seen. Receipts
+            arriving within `CHAT_SEEN_RECEIPT_WINDOW` seconds are coalesced
+            into one UPDATE and one "seen" event per conversation.
+        """
+        pending = self.pending_seen.setdefault(str(other_user_id), set())
+        for message_id in message_ids:
+            try:
+                pending.add(uuid.UUID(str(message_id)))
+            except ValueError:
+                logger.info("Ignoring invalid message id %r in mark_seen", message_id)
+
+        if pending and self.seen_flush_task is None:
+            self.seen_flush_task = asyncio.create_task(self._flush_seen_after_delay())
+
+    async def _flush_seen_after_delay(self):
+        await asyncio.sleep(getattr(settings, "CHAT_SEEN_RECEIPT_WINDOW", 0.25))
+        self.seen_flush_task = None
+        await self.flush_seen()
+
+    async def flush_seen(self):
+        """Write the pending receipts and tell each sender how far the reader got."""
+        pending, self.pending_seen = self.pending_seen, {}
+        for other_user_id, message_ids in pending.items():
+            if not message_ids:
+                continue
+            with profiling.stage("mark_seen"):
+                result = await self._mark_messages_seen(other_user_id, message_ids)
+            if result is None:
+                continue
+
+            up_to_id, up_to_timestamp, count = result
+            receipt = {
+                "reader_id": self.user_id,
+                "up_to": str(up_to_id),
+                "up_to_timestamp": up_to_timestamp.isoformat(),
+                "count": count,
+            }
+            await self.channel_layer.group_send(conversation_group_name(self.user_id, other_user_id), {
+                "type": "messages_seen",
+                "reader_id": self.user_id,
+                **wire.encode_frames({"type": "seen", **receipt})
+            })
+            await send_seen_to_participants(self.channel_layer, self.user_id, other_user_id, receipt)
+
+    @database_write
+    def _mark_messages_seen(self, other_user_id, message_ids):
+        """
+            Mark messages as seen in the database with a single UPDATE scoped to
+            this user as the receiver. Returns the newest message marked, its
+            timestamp and the number of rows updated.
+        """
+        try:
+            with metrics.DB_SECONDS.labels("mark_seen").time(), profiling.stage("mark_seen_query"):
+                messages = Message.objects.filter(
+                    id__in=message_ids,
+                    sender_id=other_user_id,
+                    receiver_id=self.user_id,
+                    seen=False,
+                )
+                newest = messages.order_by('-timestamp', '-id').values_list('id', 'timestamp').first()
+                if newest is None:
+                    return None
+                with transaction.atomic():
+                    count = messages.mark_seen()
+                    record_seen(self.user_id, other_user_id, count)
+                    transaction.on_commit(functools.partial(
+                        get_history_cache().record_seen, self.user_id, other_user_id, message_ids
+                    ))
+            logger.debug("Marked %s messages as seen up to %s", count, newest[0])
+            return newest[0], newest[1], count
+        except Exception:
+            metrics.ERRORS.labels("mark_seen").inc()
+            logger.exception("Error updating seen status")
+            return None
+
+
+class ChatConsumer(profiling.ProfiledConsumerMixin, WireProtocolMixin, RateLimitMixin, PresenceMixin,
+                   AsyncWebsocketConsumer):
+    metrics_label = "room"
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
-        self.room_group_name = f"chat_{self.room_name}"
+        self.room_group_name = room_group_name(self.room_name)
+        self.room_id = None
+        if len(self.room_name) > Room._meta.get_field('name').max_length:
+            await self.close()
+            return
 
+        # Joined before the backlog is read, so nothing sent in between is missed
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        await self.accept()
+        await self.accept_negotiated()
+        await self.start_rate_limits()
+        await self.join_presence()
+
+        user = self.scope.get("user")
+        self.sender_id = user.id if user is not None and user.is_authenticated else None
+        self.room_id, backlog = await get_room_registry().join(self.room_name, self.sender_id)
 
-        await self.send(text_data=json.dumps({
-            "message": f"Welcome to chat {self.room_name}",  
+        await self.send_payload({
+            "message": f"Welcome to chat {self.room_name}",
             "sender": "System"
-        }))
+        })
+        # The newest messages from memory; older ones are paged from /chat/rooms/<name>/messages/
+        await self.send_payload({
+            "type": "history",
+            "messages": backlog,
+            "before": encode_cursor(datetime.fromisoformat(backlog[0]["timestamp"]), backlog[0]["message_id"])
+            if backlog else None,
+        })
 
     async def disconnect(self, close_code):
+        metrics.WS_DISCONNECTS.labels(self.metrics_label).inc()
+        if getattr(self, "room_id", None) is not None:
+            get_room_registry().leave(self.room_name)
+        self.leave_presence()
+        self.close_outbound()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data.get("message", "")
-        sender = data.get("sender", "Anonymous")
-
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "message": message,
-                "sender": sender,
-                "sender_channel": self.channel_name  
-            }
-        ) 
+    async def receive(self, text_data=None, bytes_data=None):
+        if not await self.admit_frame(text_data, bytes_data):
+            return
+        try:
+            with profiling.stage("decode"):
+                data = wire.decode(text_data, bytes_data)
+        except ValueError as e:
+            await self.invalid_frame(e)
+            return
+        action = data.get("action")
+        if not await self.admit_action(action or "message"):
+            return
+        if await self.handle_wire_action(action, data) or await self.handle_presence_action(action, data):
+            return
+
+        message = str(data.get("message", "")).strip()
+        if not message:
+            return
+        received_at = time.time()
+        metrics.MESSAGES_RECEIVED.labels(self.metrics_label).inc()
+
+        # Signed-in users post under their name; anonymous clients name themselves
+        if self.sender_id is not None:
+            sender = getattr(self.scope["user"], "name", "Unknown")
+        else:
+            sender = str(data.get("sender", "Anonymous"))[:RoomMessage._meta.get_field('sender_name').max_length]
+        try:
+            with profiling.stage("persist"):
+                room_message = await get_room_message_writer().save_instance(RoomMessage(
+                    id=uuid.uuid4(), room_id=self.room_id, sender_id=self.sender_id, sender_name=sender,
+                    content=message,
+                ))
+        except Exception:
+            metrics.ERRORS.labels("save_room_message").inc()
+            logger.exception("Database save error")
+            return
+        metrics.PERSIST_SECONDS.observe(time.time() - received_at)
+
+        # Build the outbound frame once per format; members just write it out
+        entry = message_entry(room_message)
+        # Other processes add it to their buffers as the group event arrives
+        get_room_registry().record(self.room_name, entry)
+        with profiling.stage("encode"):
+            frames = wire.encode_frames(entry)
+        with metrics.GROUP_SEND_SECONDS.labels(self.metrics_label).time(), profiling.stage("group_send"):
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    "type": "chat_message",
+                    "entry": entry,
+                    **frames,
+                    "exclude": self.channel_name,
+                    "received_at": received_at
+                }
+            )
 
     async def chat_message(self, event):
         """ Sends message only to other users in the group, not the sender """
-        if event["sender_channel"] != self.channel_name:  
-            await self.send(text_data=json.dumps({
-                "message": event["message"],
-                "sender": event["sender"],
-                "timestamp": datetime.utcnow().isoformat()
-            }))
+        if "entry" in event:
+            get_room_registry().record(self.room_name, event["entry"])
+        if event.get("exclude") == self.channel_name:
+            return
+        await self.send_encoded(event)
+        self.record_delivery(event)
 
 
-class OneToOneChatConsumer(AsyncWebsocketConsumer):
-    
+class OneToOneChatConsumer(profiling.ProfiledConsumerMixin, WireProtocolMixin, RateLimitMixin, PresenceMixin,
+                           ConversationMixin, AsyncWebsocketConsumer):
+    metrics_label = "onetoone"
+
     async def connect(self):
         """Connect WebSocket and join a unique conversation room."""
+        # Set before anything can fail or deliver, `disconnect` and `chat_message` rely on them
+        self.replay_buffer = None
+        self.replay_task = None
         self.other_user_id = str(self.scope['url_route']['kwargs']['user_id'])
-        self.user_id = str(self.scope["user"].id)
+        self.start_conversations()
 
         # Ensure stable room name (sorted user IDs)
-        sorted_ids = sorted([self.user_id, self.other_user_id])
-        self.room_group_name = f"conversation_{'_'.join(sorted_ids)}"
+        self.room_group_name = conversation_group_name(self.user_id, self.other_user_id)
 
         # Join WebSocket room
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept_negotiated()
+        await self.start_rate_limits()
+        await self.join_presence()
+        # Delivers messages created over REST; normally already started by the lifespan hook
+        await get_outbox_dispatcher().ensure_started()
 
         # Send a welcome message
-        await self.send(text_data=json.dumps({
+        await self.send_payload({
             "message": "Welcome to your conversation!",
             "sender": getattr(self.scope["user"], "name", "Unknown")
-        }))
+        })
+
+        # A reconnecting client gets what it missed before live delivery resumes
+        since = wire.resume_point(self.scope)
+        if since is not None:
+            self.replay_buffer = []
+            self.replay_task = asyncio.create_task(self.replay_since(since))
 
     async def disconnect(self, close_code):
         """Disconnect WebSocket and leave the conversation room."""
+        metrics.WS_DISCONNECTS.labels(self.metrics_label).inc()
+        self.leave_presence()
+        self.close_outbound()
+        if self.replay_task is not None:
+            self.replay_task.cancel()
+            self.replay_task = None
+        await self.stop_conversations()
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Receive message from WebSocket, validate input, save to DB, and send to group."""
+        if not await self.admit_frame(text_data, bytes_data):
+            return
         try:
-            data = json.loads(text_data)
-            message = data.get("message", "").strip()
+            with profiling.stage("decode"):
+                data = wire.decode(text_data, bytes_data)
+            message = data.get("message", "")
+            if not isinstance(message, str):
+                await self.invalid_frame("message is not a string")
+                return
+            message = message.strip()
             action = data.get("action")  # Check if action is "mark_seen"
             receiver_id = self.other_user_id  # This should always exist
 
-            sender = self.scope["user"]
-            sender_id = str(sender.id)
+            sender_id = self.user_id
+
+            if not await self.admit_action(action or "message"):
+                return
+            if await self.handle_wire_action(action, data) or await self.handle_presence_action(action, data):
+                return
 
             # 🔥 If action is "mark_seen", update message status 🔥
             if action == "mark_seen":
                 message_ids = data.get("message_ids", [])
-                await self.mark_messages_seen(message_ids)
+                await self.mark_messages_seen(self.other_user_id, message_ids)
                 return
 
             # Validate required fields
             if not message:
-                print("Error: Message cannot be empty!")
+                logger.debug("Ignoring empty message from %s", sender_id)
                 return
 
-            print(f"📩 Message Received: {message}, Sender: {sender_id}, Receiver: {receiver_id}")
-
-            # Save message to DB and get the message ID
-            message_id = await self.save_message(sender_id, receiver_id, message)
+            received_at = time.time()
+            metrics.MESSAGES_RECEIVED.labels(self.metrics_label).inc()
+            logger.debug("Message received from %s for %s", sender_id, receiver_id)
 
-            # Send message to the group with `message_id`
-            event_data = {
-                "type": "chat_message",
-                "message": message,
-                "message_id": message_id,
-                "sender_id": sender_id,
-                "sender_name": getattr(sender, "name", "Unknown"),
-                "receiver_id": receiver_id,
-                "seen": False  # 🔥 Initially, message is unseen 🔥
-            }
-            await self.channel_layer.group_send(self.room_group_name, event_data)
+            # Saved, then sent to the conversation and to both users, with `message_id`
+            await self.send_message(receiver_id, message, received_at)
 
-        except json.JSONDecodeError:
-            print("JSON Decode Error: Invalid JSON format!")
-        except Exception as e:
-            print(f"Error in receive method: {e}")
+        except ValueError as e:
+            await self.invalid_frame(e)
+        except Exception:
+            metrics.ERRORS.labels("receive").inc()
+            logger.exception("Error in receive method")
 
     async def chat_message(self, event):
         """Send the chat message to the WebSocket client (excluding the sender)."""
         try:
-            print(f"Event Received in chat_message: {event}")
-
             receiver_id = event.get("receiver_id")
             sender_id = event.get("sender_id")
             message_id = event.get("message_id")
 
             if not receiver_id or not message_id:
-                print("Error: `receiver_id` or `message_id` is missing in event data!")
+                logger.warning("chat_message event without receiver_id or message_id")
                 return
 
             current_user_id = str(self.scope["user"].id)
 
             # Prevent the sender from receiving their own message
             if current_user_id == sender_id:
-                print("Skipping message for sender")
                 return
 
-            sender_display = event.get("sender_name", "Unknown")
+            if self.replay_buffer is not None:
+                # Held back until the replay has caught up, see `replay_since`
+                self.replay_buffer.append(event)
+                return
 
-            await self.send(text_data=json.dumps({
+            if "text" in event:
+                await self.send_encoded(event)
+                self.record_delivery(event)
+                return
+
+            # Events that weren't pre-encoded
+            await self.send_payload({
                 "message": event["message"],
-                "sender": sender_display,
+                "sender": event.get("sender_name", "Unknown"),
                 "receiver_id": receiver_id,
                 "message_id": message_id,
-                "seen": False  
-            }))
-
-        except Exception as e:
-            print(f"Error in chat_message method: {e}")
-
-    async def mark_messages_seen(self, message_ids):
-        """Mark multiple messages as seen."""
-        await self._mark_messages_seen(message_ids)
+                "seen": False
+            })
+            self.record_delivery(event)
+
+        except Exception:
+            metrics.ERRORS.labels("chat_message").inc()
+            logger.exception("Error in chat_message method")
+
+    async def replay_since(self, since):
+        """
+            Send the messages received after `since` (a message id or history
+            cursor) oldest first, in chunks of `CHAT_RESUME["CHUNK_SIZE"]`,
+            followed by a "resumed" frame and the live messages held back in
+            the meantime, minus any the replay already covered.
+
+            When more than `CHAT_RESUME["MAX_MESSAGES"]` were missed, or
+            `since` is unknown, the client gets "resync_required" instead and
+            should reload the conversation over REST.
+        """
+        options = getattr(settings, "CHAT_RESUME", {})
+        chunk_size = options.get("CHUNK_SIZE", 100)
+        max_messages = options.get("MAX_MESSAGES", 500)
+        replayed = set()
+        resumed = False
+        try:
+            key = await self._resume_key(since)
+            sender = await get_user_cache().aget(self.other_user_id)
+            while key is not None:
+                # One row past the cap tells us the client is too far behind
+                limit = min(chunk_size, max_messages - len(replayed) + 1)
+                with profiling.stage("replay_fetch"):
+                    rows = await self._fetch_missed(key, limit)
+                if len(replayed) + len(rows) > max_messages:
+                    break
+                for message_id, content, timestamp, seen in rows:
+                    await self.send_payload({
+                        "message": content,
+                        "sender": getattr(sender, "name", "Unknown"),
+                        "receiver_id": self.user_id,
+                        "message_id": str(message_id),
+                        "seen": seen
+                    })
+                    replayed.add(str(message_id))
+                if len(rows) < limit:
+                    resumed = True
+                    break
+                key = rows[-1][2], rows[-1][0]
+        except Exception:
+            metrics.ERRORS.labels("replay").inc()
+            logger.exception("Error replaying missed messages")
+
+        if resumed:
+            await self.send_payload({"type": "resumed", "count": len(replayed)})
+        else:
+            await self.send_payload({"type": "resync_required"})
+
+        buffered, self.replay_buffer = self.replay_buffer, None
+        for event in buffered:
+            if event.get("message_id") not in replayed:
+                await self.chat_message(event)
+        self.replay_task = None
 
     @database_sync_to_async
-    def _mark_messages_seen(self, message_ids):
-        """Mark messages as seen in the database."""
+    def _resume_key(self, since):
+        """The (timestamp, id) key to replay from, or None if `since` isn't usable."""
         try:
-            messages = Message.objects.filter(id__in=message_ids, seen=False)
-            for msg in messages:
-                msg.mark_seen()
-            print(f"✅ Marked messages as seen: {message_ids}")
-        except Exception as e:
-            print(f"Error updating seen status: {e}")
-
-    async def save_message(self, sender_id, receiver_id, message):
-        """Save chat message in the database asynchronously."""
-        return await self._save_message(sender_id, receiver_id, message)
+            message_id = uuid.UUID(since)
+        except ValueError:
+            try:
+                return decode_cursor(since)
+            except ValidationError:
+                return None
+        conversation = Message.objects.filter(sender_id=self.user_id, receiver_id=self.other_user_id) | \
+            Message.objects.filter(sender_id=self.other_user_id, receiver_id=self.user_id)
+        return conversation.filter(id=message_id).values_list('timestamp', 'id').first()
 
     @database_sync_to_async
-    def _save_message(self, sender_id, receiver_id, message):
-        """Perform Django ORM operations in a separate thread using `database_sync_to_async`."""
+    def _fetch_missed(self, key, limit):
+        """Messages from the other user after `key`, oldest first, off the conversation index."""
+        received = Message.objects.filter(sender_id=self.other_user_id, receiver_id=self.user_id)
+        with metrics.DB_SECONDS.labels("replay").time():
+            return KeysetPagination().fetch(received.values_list('id', 'content', 'timestamp', 'seen'), key, True,
+                                            limit)
+
+    async def messages_seen(self, event):
+        """Send a compact "seen up to" receipt to the other side of the conversation."""
+        if event["reader_id"] == self.user_id:
+            return
+        # Receipts only move forward, so a newer one supersedes any still queued
+        await self.send_encoded(event, ephemeral=True, key="seen")
+
+
+class UserChatConsumer(profiling.ProfiledConsumerMixin, WireProtocolMixin, RateLimitMixin, PresenceMixin,
+                       ConversationMixin, AsyncWebsocketConsumer):
+    """
+        One socket per user carrying all of their conversations, instead of
+        one `OneToOneChatConsumer` socket per conversation partner. It joins
+        only the user's own group, and every frame names its `conversation`:
+        the other participant's user id.
+
+        Client frames:
+        {"conversation": "<user id>", "message": "..."}
+        {"action": "mark_seen", "conversation": "<user id>", "message_ids": [...]}
+        plus the `outbound_stats`, `heartbeat` and `presence` actions.
+
+        Messages also go to the sender's own sockets, which is how they learn
+        the message id. Resuming with `?since=` is only offered per
+        conversation; a reconnecting client reloads over REST.
+    """
+    metrics_label = "user"
+
+    async def connect(self):
+        self.user_group_name = None
+        user = self.scope.get("user")
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+        self.start_conversations()
+        self.user_group_name = user_group_name(self.user_id)
+
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        await self.accept_negotiated()
+        await self.start_rate_limits()
+        await self.join_presence()
+        # Delivers messages created over REST; normally already started by the lifespan hook
+        await get_outbox_dispatcher().ensure_started()
+
+    async def disconnect(self, close_code):
+        if self.user_group_name is None:
+            return
+        metrics.WS_DISCONNECTS.labels(self.metrics_label).inc()
+        self.leave_presence()
+        self.close_outbound()
+        await self.stop_conversations()
+        await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not await self.admit_frame(text_data, bytes_data):
+            return
         try:
-            sender = User.objects.get(id=sender_id)
-            receiver = User.objects.get(id=receiver_id)
+            with profiling.stage("decode"):
+                data = wire.decode(text_data, bytes_data)
+            action = data.get("action")
+            if not await self.admit_action(action or "message"):
+                return
+            if await self.handle_wire_action(action, data) or await self.handle_presence_action(action, data):
+                return
 
-            chat_message = Message.objects.create(
-                sender=sender,
-                receiver=receiver,
-                content=message
-            )
-            return str(chat_message.id)  # Return message ID
+            try:
+                conversation = str(uuid.UUID(str(data.get("conversation"))))
+            except ValueError:
+                await self.send_conversation_error("invalid_conversation", data.get("conversation"))
+                return
 
-        except User.DoesNotExist:
-            print("Error: Sender or Receiver not found in database!")
-        except Exception as e:
-            print(f"Database Save Error: {e}")
-            return None
\ No newline at end of file
+            if action == "mark_seen":
+                await self.mark_messages_seen(conversation, data.get("message_ids", []))
+                return
+
+            message = str(data.get("message", "")).strip()
+            if not message:
+                logger.debug("Ignoring empty message from %s", self.user_id)
+                return
+            received_at = time.time()
+            metrics.MESSAGES_RECEIVED.labels(self.metrics_label).inc()
+
+            # The receiver must exist; usually cached, it is needed for its name anyway
+            try:
+                await get_user_cache().aget(conversation)
+            except User.DoesNotExist:
+                await self.send_conversation_error("unknown_conversation", conversation)
+                return
+            await self.send_message(conversation, message, received_at)
+
+        except ValueError as e:
+            await self.invalid_frame(e)
+        except Exception:
+            metrics.ERRORS.labels("receive").inc()
+            logger.exception("Error in receive method")
+
+    async def send_conversation_error(self, error, conversation):
+        await self.send_payload({"type": "error", "error": error, "conversation": conversation}, ephemeral=True)
+
+    async def user_message(self, event):
+        """A message in one of the user's conversations, sent by either side."""
+        await self.send_encoded(event)
+        if event["sender_id"] != self.user_id:
+            self.record_delivery(event)
+
+    async def user_seen(self, event):
+        """A "seen up to" receipt; a newer one supersedes any still queued for the same reader."""
+        await self.send_encoded(event, ephemeral=True, key=f"seen:{event['conversation']}:{event['reader_id']}")
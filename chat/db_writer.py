@@ -0,0 +1,173 @@
+"""
+    Single writer thread for the database.
+
+    SQLite lets one connection write at a time. Writes issued from the ORM
+    thread pool and from request threads contend for that lock, and the
+    losers wait out the busy timeout or fail with "database is locked".
+    Routing them through one thread removes the contention: jobs queue up,
+    and everything pending when the thread picks up work runs in one shared
+    transaction, each job in its own savepoint so a failing job only rolls
+    back itself. Under load that is one commit (and one fsync) for many
+    writes.
+
+    Reads stay on the usual `database_sync_to_async` thread pool; with WAL
+    they don't wait for the writer. Only route self-contained writes here:
+    a job runs in another thread, outside any transaction the caller holds.
+"""
+import asyncio
+import atexit
+import functools
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from .lifespan import on_shutdown
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class DatabaseWriter:
+    """
+        Runs write jobs on one dedicated thread, up to `max_batch` of them
+        per transaction. When not `enabled`, jobs run in the caller's thread
+        (async callers go through `database_sync_to_async`), as before.
+    """
+
+    def __init__(self, max_batch=64, enabled=True):
+        self.max_batch = max_batch
+        self.enabled = enabled
+        self.batches = 0
+        self.jobs = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._atexit_registered = False
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue `fn(*args, **kwargs)`; returns a `concurrent.futures.Future` of its result."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((fn, args, kwargs, future))
+        return future
+
+    def call(self, fn, *args, **kwargs):
+        """Run a write job and wait for it (committed) from synchronous code."""
+        if not self.enabled or threading.current_thread() is self._thread:
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a write job and wait for it (committed) from async code."""
+        if not self.enabled:
+            return await database_sync_to_async(fn)(*args, **kwargs)
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _ensure_started(self):
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                # Also restarts after `stop`, e.g. for jobs queued by services shutting down later
+                self._thread = threading.Thread(target=self._loop, name="chat-db-writer", daemon=True)
+                self._thread.start()
+                if not self._atexit_registered:
+                    atexit.register(self.stop)
+                    self._atexit_registered = True
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            job = self._queue.get()
+            if job is _STOP:
+                break
+            batch = [job]
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._execute(batch)
+        connection.close()
+
+    def _execute(self, batch):
+        batch = [job for job in batch if job[3].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        outcomes = []
+        try:
+            with metrics.DB_SECONDS.labels("write_batch").time(), transaction.atomic():
+                for fn, args, kwargs, _ in batch:
+                    try:
+                        with transaction.atomic():
+                            outcomes.append((fn(*args, **kwargs), None))
+                    except Exception as e:
+                        outcomes.append((None, e))
+        except Exception as e:
+            # The commit itself failed: none of the jobs took effect
+            logger.exception("Write batch of %s jobs failed", len(batch))
+            close_old_connections()
+            outcomes = [(None, e)] * len(batch)
+
+        self.batches += 1
+        self.jobs += len(batch)
+        metrics.DB_WRITE_BATCH.observe(len(batch))
+        for (_, _, _, future), (result, error) in zip(batch, outcomes):
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stop(self, timeout=10):
+        """Finish the queued jobs and stop the thread."""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    async def close(self):
+        await asyncio.to_thread(self.stop)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'queued': self._queue.qsize(),
+            'batches': self.batches,
+            'jobs': self.jobs,
+            'jobs_per_batch': self.jobs / self.batches if self.batches else None,
+        }
+
+
+def database_write(fn):
+    """Like `database_sync_to_async`, but runs the function on the writer thread."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await get_database_writer().run(fn, *args, **kwargs)
+    return wrapper
+
+
+_writer = None
+
+
+def get_database_writer():
+    """Return the process-wide database writer, configured from settings."""
+    global _writer
+    if _writer is None:
+        options = getattr(settings, "CHAT_DB_WRITER", {})
+        _writer = DatabaseWriter(
+            max_batch=options.get("MAX_BATCH", 64),
+            enabled=options.get("ENABLED", connection.vendor == "sqlite"),
+        )
+        on_shutdown(_writer.close)
+    return _writer
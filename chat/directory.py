@@ -0,0 +1,77 @@
+"""
+    The user directory: every non-superuser, ordered by name.
+
+    Pages are read with `values()` over the (`name_key`, id) index and
+    cached per directory version. `User.save` keeps `name_key`/`email_key`
+    lowercased with Python's `str.lower`, which the prefix filter uses too;
+    SQLite's LOWER() would only fold ASCII. The version is a single counter row bumped
+    by the `User` save/delete signals, so a cached page or a client's ETag
+    goes stale exactly when something the directory shows has changed. Bulk
+    `update()`s on users skip the signals; call `bump_version()` after them.
+"""
+import hashlib
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import DirectoryVersion, User
+from .serializers import UserSerializer
+
+FIELDS = ('id', 'email', 'name', 'status', 'is_active', 'is_staff', 'date_joined')
+# Saves that only touch these don't change what the directory shows, e.g. logins
+UNLISTED_FIELDS = frozenset({'last_login', 'last_logout', 'password', 'updated_at'})
+# Sorts after any character, so [prefix, prefix + PREFIX_END) is every string starting with prefix
+PREFIX_END = "\U0010ffff"
+
+
+def get_options():
+    options = getattr(settings, "CHAT_DIRECTORY", {})
+    return {
+        "PAGE_SIZE": options.get("PAGE_SIZE", 100),
+        "MAX_PAGE_SIZE": options.get("MAX_PAGE_SIZE", 500),
+        "CACHE_TTL": options.get("CACHE_TTL", 300),
+    }
+
+
+def bump_version():
+    """Mark the directory as changed; runs in the caller's transaction."""
+    now = timezone.now()
+    updated = DirectoryVersion.objects.filter(pk=1).update(version=F('version') + 1, updated_at=now)
+    if not updated:
+        _, created = DirectoryVersion.objects.get_or_create(pk=1, defaults={'version': 1, 'updated_at': now})
+        if not created:  # Another process created it meanwhile
+            DirectoryVersion.objects.filter(pk=1).update(version=F('version') + 1, updated_at=now)
+
+
+def current_version():
+    """(version, last change time or None) of the directory."""
+    row = DirectoryVersion.objects.filter(pk=1).values_list('version', 'updated_at').first()
+    return row if row is not None else (0, None)
+
+
+def listed_users(prefix=None):
+    """
+        Directory rows as a `values()` queryset with the `name_key` sort key,
+        optionally only users whose name or email starts with `prefix`
+        (case-insensitively). Prefixes are matched as index range scans.
+    """
+    users = User.objects.filter(is_superuser=False)
+    if prefix:
+        prefix = prefix.lower()
+        users = users.filter(
+            Q(name_key__gte=prefix, name_key__lt=prefix + PREFIX_END) |
+            Q(email_key__gte=prefix, email_key__lt=prefix + PREFIX_END)
+        )
+    return users.values(*FIELDS, 'name_key')
+
+
+def represent(rows):
+    """Format the rows' fields as `UserSerializer` does, e.g. `date_joined` in local time."""
+    date_joined = UserSerializer().fields['date_joined']
+    for row in rows:
+        row['date_joined'] = date_joined.to_representation(row['date_joined'])
+    return rows
+
+
+def cache_key(version, url):
+    """Key of a cached page: the full URL covers the filter, cursor and page size."""
+    return f"chat:directory:{version}:{hashlib.sha1(url.encode()).hexdigest()}"
@@ -0,0 +1,91 @@
+"""
+    Read path for conversation history.
+
+    Pages are fetched as (id, sender_id, receiver_id, content, timestamp,
+    seen) tuples, the participants' names are resolved from the user cache
+    with at most one query for the misses, and the JSON body is built
+    directly: no model instances, serializer fields or renderer per row.
+    The output matches `MessageSerializer` plus the sender and receiver ids.
+    The newest page of a conversation is usually served from
+    `chat.history_cache`.
+"""
+import json
+from django.utils import timezone
+from .history_cache import get_history_cache
+from .models import User
+from .pagination import KeysetPagination
+from .user_cache import get_user_cache
+from . import metrics
+
+COLUMNS = ('id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'seen')
+
+
+class HistoryPagination(KeysetPagination):
+    """`KeysetPagination` over `COLUMNS` tuples instead of `Message` instances."""
+
+    def get_row_key(self, row):
+        return row[4], row[0]
+
+    def archived_row(self, message):
+        return message.id, message.sender_id, message.receiver_id, message.content, message.timestamp, message.seen
+
+    def fetch_page(self, queryset, key, newer, limit, view=None):
+        """The newest page of views with a `get_conversation_key()` comes from the history cache."""
+        cache = get_history_cache()
+        conversation = view.get_conversation_key() if hasattr(view, 'get_conversation_key') else None
+        if conversation is None or key is not None or newer or not cache.enabled or limit > cache.page_rows:
+            return super().fetch_page(queryset, key, newer, limit, view)
+
+        rows = cache.get(conversation, limit)
+        if rows is None:
+            token = cache.begin_load(conversation)
+            rows = super().fetch_page(queryset, key, newer, cache.page_rows, view)
+            cache.store(conversation, token, rows)
+            rows = rows[:limit]
+        return rows
+
+    def fetch(self, queryset, key, newer, limit):
+        querysets = queryset if isinstance(queryset, (list, tuple)) else [queryset]
+        return super().fetch([qs.values_list(*COLUMNS) for qs in querysets], key, newer, limit)
+
+
+def resolve_names(user_ids):
+    """{user id: name} for the given ids, cached users first, the rest in one query."""
+    cache = get_user_cache()
+    names, missing = {}, []
+    for user_id in user_ids:
+        user = cache.get(user_id)
+        if user is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = user.name
+    if missing:
+        with metrics.DB_SECONDS.labels("history_names").time():
+            names.update(User.objects.filter(id__in=missing).values_list('id', 'name'))
+    return names
+
+
+def format_timestamp(value):
+    """The format DRF renders datetimes in: current time zone, "Z" for UTC."""
+    value = timezone.localtime(value).isoformat()
+    return value[:-6] + "Z" if value.endswith("+00:00") else value
+
+
+def render_page(rows, previous_link, next_link):
+    """The JSON body of a history page, as bytes."""
+    names = resolve_names({user_id for row in rows for user_id in (row[1], row[2]) if user_id is not None})
+    results = [
+        {
+            "id": str(pk),
+            "sender_id": str(sender_id),
+            "sender": names.get(sender_id),
+            "receiver_id": str(receiver_id) if receiver_id is not None else None,
+            "receiver": names.get(receiver_id),
+            "content": content,
+            "timestamp": format_timestamp(timestamp),
+            "seen": seen,
+        }
+        for pk, sender_id, receiver_id, content, timestamp, seen in rows
+    ]
+    body = {"previous": previous_link, "next": next_link, "results": results}
+    return json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode()
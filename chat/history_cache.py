@@ -0,0 +1,254 @@
+"""
+    In-process cache of the newest history page of each conversation.
+
+    Opening a conversation asks for its newest page, so that is the one page
+    worth keeping in memory: up to `page_rows` rows of `chat.history.COLUMNS`
+    tuples per pair of users, newest first, in an LRU bounded by entry count
+    and by an estimate of the bytes the rows hold.
+
+    Entries are filled by the first read and then kept current write-through
+    as messages are committed (`MessageWriter`, and the ORM saves of the REST
+    API via `chat.signals`) and as they are marked seen. Other processes are
+    told over the process bus to drop the entries they hold; the TTL bounds
+    staleness for changes they miss (a process whose bus isn't running yet).
+"""
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from django.conf import settings
+from .process_bus import get_process_bus
+
+# Ids, timestamp and the int behind each UUID, which `sys.getsizeof` doesn't follow
+_FIXED_ROW_BYTES = (
+    3 * (sys.getsizeof(uuid.UUID(int=0)) + sys.getsizeof(2 ** 127))
+    + sys.getsizeof(datetime.now(timezone.utc))
+)
+_ENTRY_BYTES = 256
+
+
+def conversation_key(user_a_id, user_b_id):
+    return tuple(sorted((str(user_a_id), str(user_b_id))))
+
+
+def row_size(row):
+    """Approximate bytes held by one cached row."""
+    return sys.getsizeof(row) + sys.getsizeof(row[3]) + _FIXED_ROW_BYTES
+
+
+def _uuid(value):
+    return value if value is None or isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+
+
+def message_row(message):
+    """A saved `Message` as a history row, with the ids the ORM returns."""
+    return (_uuid(message.id), _uuid(message.sender_id), _uuid(message.receiver_id),
+            message.content, message.timestamp, message.seen)
+
+
+class _Entry:
+    __slots__ = ("rows", "complete", "size", "expires_at")
+
+    def __init__(self, rows, complete, expires_at):
+        self.rows = rows  # Newest first
+        self.complete = complete  # The rows are the whole conversation
+        self.size = _ENTRY_BYTES + sum(row_size(row) for row in rows)
+        self.expires_at = expires_at
+
+
+class HistoryPageCache:
+    """
+        LRU of conversations' newest rows, bounded by `max_entries` and
+        `max_bytes`. A first page of up to `page_rows - 1` rows (one more is
+        read to know whether older ones exist) is served from here.
+    """
+
+    def __init__(self, page_rows=51, max_entries=10000, max_bytes=32 * 1024 * 1024, ttl=300):
+        self.page_rows = page_rows
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = bool(max_entries and max_bytes)
+        self.bytes = 0
+        self._entries = OrderedDict()  # conversation key -> _Entry
+        self._loading = {}  # conversation key -> token of the read filling it
+        self._lock = threading.Lock()
+        self._subscribed = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.updates = 0
+
+    def get(self, key, limit):
+        """The newest `limit` rows, newest first, or None when they aren't all cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None or (len(entry.rows) < limit and not entry.complete):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.rows[:limit]
+
+    def begin_load(self, key):
+        """Call before reading the rows to `store`; a write in between cancels the store."""
+        token = object()
+        with self._lock:
+            self._loading[key] = token
+        return token
+
+    def store(self, key, token, rows):
+        """Cache up to `page_rows` rows read from the database, newest first."""
+        with self._lock:
+            if self._loading.get(key) is not token:
+                return
+            del self._loading[key]
+            self._remove(key)
+            entry = _Entry(list(rows[:self.page_rows]), len(rows) < self.page_rows, time.monotonic() + self.ttl)
+            self._entries[key] = entry
+            self.bytes += entry.size
+            self._evict()
+
+    def record_messages(self, messages):
+        """Add committed messages to the cached pages of their conversations."""
+        if not self.enabled:
+            return
+        changed = set()
+        with self._lock:
+            for message in messages:
+                if message.receiver_id is None or message.timestamp is None:
+                    continue
+                key = conversation_key(message.sender_id, message.receiver_id)
+                changed.add(key)
+                self._loading.pop(key, None)
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._insert(entry, message_row(message))
+            self.updates += len(changed)
+            self._evict()
+        self._publish(changed)
+
+    def record_seen(self, reader_id, other_user_id, message_ids):
+        """Mark the reader's cached copies of messages from `other_user_id` as seen."""
+        if not self.enabled:
+            return
+        key = conversation_key(reader_id, other_user_id)
+        message_ids = {str(message_id) for message_id in message_ids}
+        sender = _uuid(other_user_id)
+        with self._lock:
+            self._loading.pop(key, None)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.rows = [
+                    row[:5] + (True,) if not row[5] and row[1] == sender and str(row[0]) in message_ids else row
+                    for row in entry.rows
+                ]
+            self.updates += 1
+        self._publish({key})
+
+    def invalidate(self, key, publish=True):
+        with self._lock:
+            self._loading.pop(key, None)
+            if self._remove(key):
+                self.invalidations += 1
+        if publish:
+            self._publish({key})
+
+    def _insert(self, entry, row):
+        rows = entry.rows
+        if any(cached[0] == row[0] for cached in rows):
+            return
+        position = 0
+        while position < len(rows) and (rows[position][4], rows[position][0]) > (row[4], row[0]):
+            position += 1
+        if position == len(rows) and not entry.complete:
+            return  # Older than everything cached, so not on the newest page
+        rows.insert(position, row)
+        entry.size += row_size(row)
+        self.bytes += row_size(row)
+        while len(rows) > self.page_rows:
+            entry.complete = False
+            dropped = rows.pop()
+            entry.size -= row_size(dropped)
+            self.bytes -= row_size(dropped)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.bytes -= entry.size
+        return True
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= entry.size
+            self.evictions += 1
+
+    def _publish(self, keys):
+        if keys:
+            get_process_bus().publish_threadsafe({"type": "history.invalidate", "keys": sorted(keys)})
+
+    def subscribe(self):
+        """Receive other processes' invalidations once the process bus runs."""
+        if not self._subscribed:
+            get_process_bus().subscribe("history.invalidate", self._on_invalidate)
+            self._subscribed = True
+
+    async def ensure_started(self):
+        self.subscribe()
+        await get_process_bus().ensure_started()
+
+    async def _on_invalidate(self, event):
+        if event["origin"] == get_process_bus().process_id:
+            return
+        for key in event["keys"]:
+            self.invalidate(tuple(key), publish=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._loading.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            entries, size = len(self._entries), self.bytes
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'updates': self.updates,
+        }
+
+
+_cache = None
+
+
+def get_history_cache():
+    """Return the process-wide history page cache, configured from settings."""
+    global _cache
+    if _cache is None:
+        options = getattr(settings, "CHAT_HISTORY_CACHE", {})
+        _cache = HistoryPageCache(
+            page_rows=options.get("PAGE_SIZE", 50) + 1,
+            max_entries=options.get("MAX_ENTRIES", 10000),
+            max_bytes=options.get("MAX_BYTES", 32 * 1024 * 1024),
+            ttl=options.get("TTL", 300),
+        )
+        # Not left to `ensure_started`: without lifespan events it only runs on the first request
+        _cache.subscribe()
+    return _cache
@@ -0,0 +1,180 @@
+import asyncio
+import random
+import string
+import threading
+import time
+from collections import deque
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+class _Channel:
+    __slots__ = ("messages", "waiters")
+
+    def __init__(self):
+        self.messages = deque()  # (expires_at, message)
+        self.waiters = []
+
+
+class ShardedInMemoryChannelLayer(BaseChannelLayer):
+    """
+        In-process channel layer for single-node deployments and tests.
+
+        - Group tables are split across `shards`, each behind its own lock.
+        - Each channel has a bounded queue (`capacity`). `send` to a full
+          channel raises `ChannelFull`; `group_send` skips full members.
+        - Messages expire after `expiry` seconds, group memberships after
+          `group_expiry` seconds.
+        - `group_send` queues the same message object for every member
+          instead of a copy per member, so received messages must be treated
+          as read-only. A message with an "exclude" key is not delivered to
+          the channel it names (used to skip the sender of a broadcast).
+
+        Safe to use from several threads/event loops in the same process.
+    """
+    extensions = ["groups", "flush"]
+    # Housekeeping of expired messages, empty channels and stale memberships
+    sweep_interval = 10
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, shards=16, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.group_expiry = group_expiry
+        self._channels = {}
+        self._channels_lock = threading.Lock()
+        self._group_shards = [({}, threading.Lock()) for _ in range(shards)]
+        self._last_sweep = time.monotonic()
+
+    # Channel API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+        if not self._put(channel, message):
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._channels_lock:
+                queue = self._channels.get(channel)
+                if queue is None:
+                    queue = self._channels[channel] = _Channel()
+                now = time.monotonic()
+                while queue.messages:
+                    expires_at, message = queue.messages.popleft()
+                    if expires_at > now:
+                        return message
+                waiter = loop.create_future()
+                queue.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                with self._channels_lock:
+                    if waiter in queue.waiters:
+                        queue.waiters.remove(waiter)
+
+    async def new_channel(self, prefix="specific."):
+        suffix = "".join(random.choice(string.ascii_letters) for _ in range(12))
+        return f"{prefix}.inmemory!{suffix}"
+
+    def _put(self, channel, message):
+        """Queue a message; returns False when the channel is full."""
+        with self._channels_lock:
+            queue = self._channels.get(channel)
+            if queue is None:
+                queue = self._channels[channel] = _Channel()
+            if len(queue.messages) >= self.get_capacity(channel):
+                return False
+            queue.messages.append((time.monotonic() + self.expiry, message))
+            waiters, queue.waiters = queue.waiters, []
+        for waiter in waiters:
+            self._wake(waiter)
+        return True
+
+    @staticmethod
+    def _wake(waiter):
+        loop = waiter.get_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            if not waiter.done():
+                waiter.set_result(None)
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(None))
+
+    # Groups extension
+
+    def _group_shard(self, group):
+        return self._group_shards[hash(group) % len(self._group_shards)]
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        groups, lock = self._group_shard(group)
+        with lock:
+            groups.setdefault(group, {})[channel] = time.monotonic() + self.group_expiry
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        groups, lock = self._group_shard(group)
+        with lock:
+            members = groups.get(group)
+            if members is not None:
+                members.pop(channel, None)
+                if not members:
+                    del groups[group]
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        groups, lock = self._group_shard(group)
+        now = time.monotonic()
+        with lock:
+            members = [channel for channel, expires_at in groups.get(group, {}).items() if expires_at > now]
+
+        exclude = message.get("exclude")
+        for channel in members:
+            if channel != exclude:
+                # Full members miss the message, as with the other layers
+                self._put(channel, message)
+
+        if now - self._last_sweep > self.sweep_interval:
+            self._sweep(now)
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        with self._channels_lock:
+            for name, queue in list(self._channels.items()):
+                while queue.messages and queue.messages[0][0] <= now:
+                    queue.messages.popleft()
+                if not queue.messages and not queue.waiters:
+                    del self._channels[name]
+        for groups, lock in self._group_shards:
+            with lock:
+                for group, members in list(groups.items()):
+                    for channel, expires_at in list(members.items()):
+                        if expires_at <= now:
+                            del members[channel]
+                    if not members:
+                        del groups[group]
+
+    # Flush extension
+
+    async def flush(self):
+        with self._channels_lock:
+            channels, self._channels = self._channels, {}
+        for queue in channels.values():
+            for waiter in queue.waiters:
+                if not waiter.done():
+                    waiter.get_loop().call_soon_threadsafe(waiter.cancel)
+        for groups, lock in self._group_shards:
+            with lock:
+                groups.clear()
+
+    async def close(self):
+        pass
@@ -0,0 +1,65 @@
+"""
+    ASGI lifespan handling, so in-process background work is started with the
+    server and drained cleanly when it shuts down. Servers that don't send
+    lifespan events (daphne) get the startup hooks run before the first
+    request or connection instead (see `start_on_first_use`), and rely on the
+    `atexit` hooks registered by each service for shutdown.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+_startup_hooks = []
+_shutdown_hooks = []
+_started = False
+
+
+def on_startup(hook):
+    """Register a coroutine function to await when the server starts."""
+    _startup_hooks.append(hook)
+    return hook
+
+
+def on_shutdown(hook):
+    """Register a coroutine function to await when the server shuts down."""
+    _shutdown_hooks.append(hook)
+    return hook
+
+
+async def run_startup_hooks():
+    global _started
+    _started = True
+    for hook in _startup_hooks:
+        try:
+            await hook()
+        except Exception:
+            logger.exception("Error in startup hook %r", hook)
+
+
+def start_on_first_use(app):
+    """Wrap an ASGI app to run the startup hooks before its first scope, unless lifespan already did."""
+    async def application(scope, receive, send):
+        if not _started:
+            await run_startup_hooks()
+        return await app(scope, receive, send)
+    return application
+
+
+async def run_shutdown_hooks():
+    for hook in reversed(_shutdown_hooks):
+        try:
+            await hook()
+        except Exception:
+            logger.exception("Error in shutdown hook %r", hook)
+
+
+async def lifespan_app(scope, receive, send):
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            await run_startup_hooks()
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            await run_shutdown_hooks()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
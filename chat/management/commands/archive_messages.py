@@ -0,0 +1,71 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from chat.archive import ConversationArchive, archive_key
+from chat.models import ConversationSummary, Message
+from chat.summaries import record_seen
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than the threshold out of the message table into "
+        "per-conversation compressed segment files (see chat.archive). "
+        "Archived messages count as read: they are stored as seen and leave the unread counters."
+    )
+
+    def add_arguments(self, parser):
+        options = getattr(settings, "CHAT_ARCHIVE", {})
+        parser.add_argument('--older-than-days', type=int, default=options.get("OLDER_THAN_DAYS", 90))
+        parser.add_argument('--block-size', type=int, default=options.get("BLOCK_SIZE", 256),
+                            help="Messages per compressed block; also rows deleted per transaction.")
+        parser.add_argument('--dry-run', action='store_true', help="Only count what would be archived.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+        old_messages = Message.objects.filter(timestamp__lt=cutoff, receiver__isnull=False)
+        pairs = {
+            ConversationSummary.pair(sender_id, receiver_id)
+            for sender_id, receiver_id in old_messages.values_list('sender_id', 'receiver_id').distinct()
+        }
+
+        total = 0
+        for low, high in sorted(pairs, key=str):
+            conversation = old_messages.filter(
+                Q(sender_id=low, receiver_id=high) | Q(sender_id=high, receiver_id=low)
+            )
+            if options['dry_run']:
+                total += conversation.count()
+                continue
+            total += self.archive_conversation(ConversationArchive(low, high), conversation, options['block_size'])
+
+        verb = "Would archive" if options['dry_run'] else "Archived"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {total} messages from {len(pairs)} conversations."))
+
+    def archive_conversation(self, archive, conversation, block_size):
+        archived = 0
+        rows = conversation.order_by('timestamp', 'id').values_list(
+            'id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'seen'
+        )
+        while True:
+            block = list(rows[:block_size])
+            if not block:
+                return archived
+            # Rows at or before the archive's end were written by a run that died before deleting them
+            last_key = archive.last_key()
+            fresh = [row for row in block if last_key is None or archive_key((row[4], row[0])) > last_key]
+            if fresh:
+                # Nothing can mark an archived message seen, so it is archived as seen
+                archive.append([row[:5] + (True,) for row in fresh])
+
+            unseen = {}
+            for _, sender_id, receiver_id, _, _, seen in block:
+                if not seen:
+                    unseen[(receiver_id, sender_id)] = unseen.get((receiver_id, sender_id), 0) + 1
+            with transaction.atomic():
+                Message.objects.filter(id__in=[row[0] for row in block]).delete()
+                for (receiver_id, sender_id), count in unseen.items():
+                    record_seen(receiver_id, sender_id, count)
+            archived += len(fresh)
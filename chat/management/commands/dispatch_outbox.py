@@ -0,0 +1,30 @@
+import asyncio
+from django.core.management.base import BaseCommand
+from chat.models import OutboxEvent
+from chat.outbox import get_outbox_dispatcher
+
+
+class Command(BaseCommand):
+    help = (
+        "Publish pending outbox events to the channel layer. Use it when no ASGI "
+        "server is running a dispatcher, e.g. behind a WSGI-only API (needs a "
+        "shared channel layer such as Redis)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Publish what is pending and exit instead of polling.")
+
+    def handle(self, *args, **options):
+        dispatcher = get_outbox_dispatcher()
+        if not options['once']:
+            self.stdout.write(f"Polling the outbox every {dispatcher.poll_interval}s, Ctrl+C to stop.")
+            try:
+                asyncio.run(dispatcher.run())
+            except KeyboardInterrupt:
+                pass
+            return
+
+        count = asyncio.run(dispatcher.drain())
+        remaining = OutboxEvent.objects.count()
+        self.stdout.write(self.style.SUCCESS(f"Dispatched {count} outbox events, {remaining} still pending."))
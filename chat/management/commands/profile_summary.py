@@ -0,0 +1,67 @@
+import json
+import os
+from collections import defaultdict
+from django.core.management.base import BaseCommand, CommandError
+from chat.profiling import get_options
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Summarize the slow traces written by sampled profiling (CHAT_PROFILING): "
+        "per handler and per stage, where the time of slow calls went."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help="Trace file; defaults to CHAT_PROFILING['FILE'] and its rotations.")
+        parser.add_argument('--handler', help="Only traces of this handler, e.g. OneToOneChatConsumer.websocket.receive.")
+        parser.add_argument('--top', type=int, default=20, help="Handlers shown, by total time.")
+
+    def handle(self, *args, **options):
+        profiling_options = get_options()
+        path = options['file'] or profiling_options["FILE"]
+        paths = [path] + [f"{path}.{n}" for n in range(1, profiling_options["BACKUP_COUNT"] + 1)]
+        paths = [p for p in paths if os.path.exists(p)]
+        if not paths:
+            raise CommandError(f"No traces at {path}; is CHAT_PROFILING['SAMPLE_RATE'] above 0?")
+
+        handlers = defaultdict(lambda: {"wall": [], "cpu": [], "other": [], "stages": defaultdict(list)})
+        for p in paths:
+            with open(p) as f:
+                for line in f:
+                    try:
+                        trace = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short by a crash or rotation
+                    if options['handler'] and trace["handler"] != options['handler']:
+                        continue
+                    entry = handlers[trace["handler"]]
+                    entry["wall"].append(trace["wall_ms"])
+                    entry["cpu"].append(trace["cpu_ms"])
+                    entry["other"].append(trace["other_ms"])
+                    for stage in trace["stages"]:
+                        entry["stages"][stage["name"]].append((stage["wall_ms"], stage["cpu_ms"]))
+
+        ranked = sorted(handlers.items(), key=lambda item: sum(item[1]["wall"]), reverse=True)
+        for name, entry in ranked[:options['top']]:
+            walls = entry["wall"]
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f"{name}: {len(walls)} slow calls, total {sum(walls):.1f} ms, "
+                f"mean {sum(walls) / len(walls):.1f} ms, p95 {percentile(walls, 0.95):.1f} ms, "
+                f"mean cpu {sum(entry['cpu']) / len(walls):.1f} ms"
+            ))
+            rows = [(stage, [w for w, _ in samples], [c for _, c in samples])
+                    for stage, samples in entry["stages"].items()]
+            rows.append(("(unstaged)", entry["other"], []))
+            rows.sort(key=lambda row: sum(row[1]), reverse=True)
+            self.stdout.write(f"  {'stage':<20} {'count':>7} {'total ms':>11} {'mean ms':>9} {'p95 ms':>9} {'cpu ms':>8}")
+            for stage, stage_walls, stage_cpus in rows:
+                cpu = f"{sum(stage_cpus) / len(stage_cpus):.2f}" if stage_cpus else "-"
+                self.stdout.write(
+                    f"  {stage:<20} {len(stage_walls):>7} {sum(stage_walls):>11.1f} "
+                    f"{sum(stage_walls) / len(stage_walls):>9.2f} {percentile(stage_walls, 0.95):>9.2f} {cpu:>8}"
+                )
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chat.archive import ConversationArchive, archived_conversations
+from chat.models import ConversationSummary, Message, User
+
+
+class Command(BaseCommand):
+    help = "Rebuild the conversation summary table from scratch out of the message table and the archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help="Messages fetched per round trip and summaries inserted per batch.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        summaries = {}
+
+        messages = Message.objects.exclude(receiver__isnull=True).order_by('timestamp', 'id').values_list(
+            'id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'seen'
+        )
+        for message_id, sender_id, receiver_id, content, timestamp, seen in messages.iterator(chunk_size=chunk_size):
+            low, high = ConversationSummary.pair(sender_id, receiver_id)
+            summary = summaries.get((low, high))
+            if summary is None:
+                summary = summaries[(low, high)] = ConversationSummary(user_low_id=low, user_high_id=high)
+            summary.last_message_id = message_id
+            summary.last_message_preview = content[:ConversationSummary.PREVIEW_LENGTH]
+            summary.last_message_at = timestamp
+            summary.last_sender_id = sender_id
+            if not seen:
+                if str(receiver_id) == str(low):
+                    summary.unread_low += 1
+                else:
+                    summary.unread_high += 1
+
+        self.fold_in_archives(summaries)
+
+        with transaction.atomic():
+            ConversationSummary.objects.all().delete()
+            ConversationSummary.objects.bulk_create(summaries.values(), batch_size=chunk_size)
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(summaries)} conversation summaries."))
+
+    def fold_in_archives(self, summaries):
+        """
+            Add conversations whose messages are all archived, with the newest
+            archived message as the last one. Archived messages are stored as
+            seen (see `chat.archive`), so they add nothing to the counters.
+        """
+        pairs = archived_conversations()
+        existing = set(User.objects.filter(
+            id__in={user_id for pair in pairs for user_id in pair}
+        ).values_list('id', flat=True))
+        for low, high in pairs:
+            # Messages left in the table are newer than the archived ones
+            if (low, high) in summaries or low not in existing or high not in existing:
+                continue
+            newest = ConversationArchive(low, high).fetch(None, False, 1)
+            if not newest:
+                continue
+            newest = newest[0]
+            summaries[(low, high)] = ConversationSummary(
+                user_low_id=low, user_high_id=high,
+                last_message_id=newest.id,
+                last_message_preview=newest.content[:ConversationSummary.PREVIEW_LENGTH],
+                last_message_at=newest.timestamp,
+                last_sender_id=newest.sender_id,
+            )
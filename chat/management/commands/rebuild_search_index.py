@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from chat import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text message search index (SQLite FTS5) from the message table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help="Messages indexed per transaction.")
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            raise CommandError("Message search needs the SQLite FTS5 index; this database isn't SQLite.")
+
+        def progress(total):
+            self.stdout.write(f"Indexed {total} messages...")
+
+        total = search.rebuild_index(chunk_size=options['chunk_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the search index with {total} messages."))
@@ -0,0 +1,240 @@
+"""
+    In-process metrics in the Prometheus text format.
+
+    Every thread updates its own shard of values, so recording a sample is a
+    dict update with no lock and no contention between the event loop and
+    the ORM thread pool; shards are only summed when `/chat/metrics/` is
+    scraped. Values are per process, like everything Prometheus scrapes.
+
+    MESSAGES_RECEIVED.labels("onetoone").inc()
+    with DB_SECONDS.labels("mark_seen").time():
+        ...
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from .outbound import OutboundQueue
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+_registry = []
+
+
+def _shard():
+    """This thread's values; registering a new thread is the only locked step."""
+    try:
+        return _local.values
+    except AttributeError:
+        values = _local.values = {}
+        with _shards_lock:
+            _shards.append(values)
+        return values
+
+
+def _collect():
+    """Sum every thread's shard into one {key: value} map."""
+    with _shards_lock:
+        shards = list(_shards)
+    totals = {}
+    for shard in shards:
+        for key, value in list(shard.items()):
+            if isinstance(value, list):
+                current = totals.get(key)
+                totals[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+        _registry.append(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children.setdefault(values, self._child((self.name, values)))
+        return child
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class _CounterChild:
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def inc(self, amount=1):
+        values = _shard()
+        values[self.key] = values.get(self.key, 0) + amount
+
+
+class Counter(_Metric):
+    type = "counter"
+    _child = _CounterChild
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def total(self):
+        """The count summed over every label value, e.g. for a benchmark report."""
+        totals = _collect()
+        return sum(totals.get((self.name, values), 0) for values in list(self._children))
+
+    def render(self, totals):
+        lines = self.header()
+        for values in list(self._children):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} "
+                         f"{_format_value(totals.get((self.name, values), 0))}")
+        return lines
+
+
+class _HistogramChild:
+    __slots__ = ("key", "buckets")
+
+    def __init__(self, key, buckets):
+        self.key = key
+        self.buckets = buckets
+
+    def observe(self, value):
+        values = _shard()
+        counts = values.get(self.key)
+        if counts is None:
+            # One slot per bucket plus +Inf, then sum and count
+            counts = values[self.key] = [0] * (len(self.buckets) + 3)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _child(self, key):
+        return _HistogramChild(key, self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def render(self, totals):
+        lines = self.header()
+        for values in list(self._children):
+            counts = totals.get((self.name, values))
+            if counts is None:
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-2])}")
+            lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+class CallbackMetric:
+    """A value read from elsewhere at scrape time, e.g. a queue depth or an existing counter."""
+
+    def __init__(self, name, documentation, type, callback):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.callback = callback
+        _registry.append(self)
+
+    def render(self, totals):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        try:
+            lines.append(f"{self.name} {_format_value(self.callback())}")
+        except Exception:
+            pass  # A broken callback must not take the whole scrape down
+        return lines
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    totals = _collect()
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render(totals))
+    return "\n".join(lines) + "\n"
+
+
+# WebSocket consumers
+WS_CONNECTS = Counter("chat_ws_connects_total", "WebSocket connections accepted.", ["consumer"])
+WS_DISCONNECTS = Counter("chat_ws_disconnects_total", "WebSocket connections closed.", ["consumer"])
+WS_AUTH = Counter("chat_ws_auth_total", "WebSocket handshakes by token authentication result.", ["result"])
+WS_AUTH_SECONDS = Histogram("chat_ws_auth_seconds", "Time spent authenticating a WebSocket handshake.")
+MESSAGES_RECEIVED = Counter("chat_messages_received_total", "Chat messages received from clients.", ["consumer"])
+MESSAGES_DELIVERED = Counter("chat_messages_delivered_total", "Chat messages queued to a recipient socket.",
+                             ["consumer"])
+THROTTLED = Counter("chat_throttled_total", "Inbound frames rejected by rate limits, by limit.",
+                    ["consumer", "scope"])
+THROTTLE_CLOSES = Counter("chat_throttle_closes_total", "Connections closed for sending while throttled.",
+                          ["consumer"])
+ERRORS = Counter("chat_errors_total", "Errors handled without closing the connection.", ["where"])
+PERSIST_SECONDS = Histogram("chat_message_persist_seconds", "From receiving a message to it being persisted.")
+DELIVER_SECONDS = Histogram("chat_message_deliver_seconds",
+                            "From receiving a message to it being queued on a recipient socket.")
+OUTBOUND_DROPPED = CallbackMetric("chat_outbound_dropped_total", "Ephemeral frames dropped for slow clients.",
+                                  "counter", lambda: OutboundQueue.totals["dropped"])
+OUTBOUND_COALESCED = CallbackMetric("chat_outbound_coalesced_total", "Queued frames replaced by a newer one.",
+                                    "counter", lambda: OutboundQueue.totals["coalesced"])
+OUTBOUND_OVERFLOWS = CallbackMetric("chat_outbound_overflows_total", "Connections closed for falling behind.",
+                                    "counter", lambda: OutboundQueue.totals["overflows"])
+GROUP_SEND_SECONDS = Histogram("chat_group_send_seconds", "Time spent in channel layer group_send.", ["consumer"])
+DB_SECONDS = Histogram("chat_db_seconds", "Time spent in the database per operation.", ["operation"])
+DB_WRITE_BATCH = Histogram("chat_db_write_batch_jobs", "Write jobs committed per transaction by the writer thread.",
+                           buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+# REST API
+HTTP_REQUESTS = Counter("chat_http_requests_total", "HTTP requests by view, method and status.",
+                        ["view", "method", "status"])
+HTTP_SECONDS = Histogram("chat_http_request_seconds", "HTTP request duration by view.", ["view"])
@@ -1,10 +1,10 @@
+import time
 from urllib.parse import parse_qs
-from channels.db import database_sync_to_async
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.tokens import AccessToken
-from django.contrib.auth import get_user_model
-
-User = get_user_model()
+from .user_cache import get_user_cache
+from . import metrics
 
 class TokenAuthMiddleware:
     """
@@ -14,6 +14,7 @@ class TokenAuthMiddleware:
         self.inner = inner
 
     async def __call__(self, scope, receive, send):
+        start = time.perf_counter()
         query_string = scope.get('query_string', b'').decode()
         query_params = parse_qs(query_string)
         token = query_params.get('token')
@@ -22,13 +23,53 @@ class TokenAuthMiddleware:
             try:
                 access_token = AccessToken(token)
                 user_id = access_token['user_id']
-                user = await database_sync_to_async(User.objects.get)(id=user_id)
+                user = await get_user_cache().aget(user_id)
                 scope['user'] = user
+                result = "ok"
             except Exception:
                 scope['user'] = AnonymousUser()
+                result = "invalid"
         else:
             scope['user'] = AnonymousUser()
+            result = "anonymous"
+        metrics.WS_AUTH.labels(result).inc()
+        metrics.WS_AUTH_SECONDS.observe(time.perf_counter() - start)
         return await self.inner(scope, receive, send)
 
 def TokenAuthMiddlewareStack(inner):
     return TokenAuthMiddleware(inner)
+
+
+class RequestMetricsMiddleware:
+    """
+        Django middleware counting REST requests and their duration per URL
+        name (the route, not the raw path, so label values stay bounded).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.record(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, start)
+        return response
+
+    @staticmethod
+    def record(request, response, start):
+        match = request.resolver_match
+        view = match.view_name if match is not None else "unmatched"
+        metrics.HTTP_REQUESTS.labels(view, request.method, response.status_code).inc()
+        metrics.HTTP_SECONDS.labels(view).observe(time.perf_counter() - start)
@@ -0,0 +1,50 @@
+# Generated by Django 5.1.4 on 2026-10-18 06:39
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def fill_keys(apps, schema_editor):
+    User = apps.get_model('chat', 'User')
+    users = list(User.objects.only('id', 'name', 'email'))
+    for user in users:
+        user.name_key, user.email_key = user.name.lower(), user.email.lower()
+    User.objects.bulk_update(users, ['name_key', 'email_key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chat', '0008_message_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectoryVersion',
+            fields=[
+                ('id', models.PositiveSmallIntegerField(default=1, editable=False, primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='email_key',
+            field=models.CharField(default='', editable=False, max_length=254),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='name_key',
+            field=models.CharField(default='', editable=False, max_length=100),
+        ),
+        migrations.RunPython(fill_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['name_key', 'id'], name='user_name_key_id'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['email_key'], name='user_email_key'),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import PermissionsMixin, BaseUserManager, AbstractBaseUser
 from django.conf import settings
+from django.utils import timezone
 from rest_framework_simplejwt.tokens import RefreshToken
 import uuid
 
@@ -55,15 +56,33 @@ class User(BaseUUID, AbstractBaseUser, PermissionsMixin):
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='Active')
     last_logout = models.DateTimeField(null=True, blank=True) 
     is_active = models.BooleanField(default=True)
+    # Lowercased in Python, not SQL: SQLite's LOWER() only folds ASCII
+    name_key = models.CharField(max_length=100, default='', editable=False)
+    email_key = models.CharField(max_length=254, default='', editable=False)
 
     objects = UserManager()
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['name']
 
+    class Meta:
+        indexes = [
+            # User directory pages by name, and name/email prefix lookups
+            models.Index(fields=['name_key', 'id'], name='user_name_key_id'),
+            models.Index(fields=['email_key'], name='user_email_key'),
+        ]
+
     def __str__(self):
         return self.email
 
+    def save(self, *args, **kwargs):
+        self.name_key, self.email_key = self.name.lower(), self.email.lower()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            keys = {'name': 'name_key', 'email': 'email_key'}
+            kwargs['update_fields'] = set(update_fields) | {keys[field] for field in update_fields if field in keys}
+        super().save(*args, **kwargs)
+
     def tokens(self):
         """
             Generate JWT tokens using DRF SimpleJWT
@@ -95,6 +114,13 @@ class PrivateChat(BaseUUID):
         super().save(*args, **kwargs)
 
 
+class MessageQuerySet(models.QuerySet):
+
+    def mark_seen(self):
+        """Marks every unseen message in the queryset as seen with a single UPDATE."""
+        return self.filter(seen=False).update(seen=True)
+
+
 class Message(BaseUUID):
     """
         A message exchanged in a private chat.
@@ -105,8 +131,15 @@ class Message(BaseUUID):
     timestamp = models.DateTimeField(auto_now_add=True)
     seen = models.BooleanField(default=False)  # Seen/unseen status
 
+    objects = MessageQuerySet.as_manager()
+
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Keyset pagination over one direction of a conversation
+            models.Index(fields=['sender', 'receiver', 'timestamp', 'id'], name='message_sender_receiver_ts'),
+            models.Index(fields=['receiver', 'sender', 'timestamp', 'id'], name='message_receiver_sender_ts'),
+        ]
 
     def __str__(self):
         return f"{self.sender.name}: {self.content[:30]} ({'Seen' if self.seen else 'Unseen'})"
@@ -116,3 +149,121 @@ class Message(BaseUUID):
         self.seen = True
         self.save(update_fields=['seen'])
 
+
+
+class ConversationSummary(BaseUUID):
+    """
+        Denormalized inbox row for a pair of users, kept up to date as messages
+        are saved and seen. `user_low` is always the user with the smaller id.
+    """
+    PREVIEW_LENGTH = 100
+
+    user_low = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_message_id = models.UUIDField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    unread_low = models.PositiveIntegerField(default=0)  # Unread messages for user_low
+    unread_high = models.PositiveIntegerField(default=0)  # Unread messages for user_high
+
+    class Meta:
+        unique_together = ['user_low', 'user_high']
+        indexes = [
+            # Inbox pages for either side of the pair, newest first
+            models.Index(fields=['user_low', 'last_message_at', 'id'], name='summary_low_recent'),
+            models.Index(fields=['user_high', 'last_message_at', 'id'], name='summary_high_recent'),
+        ]
+
+    def __str__(self):
+        return f"Conversation between {self.user_low_id} and {self.user_high_id}"
+
+    @staticmethod
+    def pair(user_a_id, user_b_id):
+        """Order two user ids the way summaries store them."""
+        return tuple(sorted([user_a_id, user_b_id], key=str))
+
+    def other_user_id(self, user_id):
+        return self.user_high_id if str(self.user_low_id) == str(user_id) else self.user_low_id
+
+    def unread_for(self, user_id):
+        return self.unread_low if str(self.user_low_id) == str(user_id) else self.unread_high
+
+
+class OutboxEvent(models.Model):
+    """
+        A channel layer event written in the same transaction as the change it
+        announces, and published by `chat.outbox.OutboxDispatcher` after commit.
+        Rows are deleted once published.
+    """
+    id = models.BigAutoField(primary_key=True)
+    group_name = models.CharField(max_length=200)
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Set while a dispatcher is publishing the row; expired claims are retried
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"{self.event_type} -> {self.group_name}"
+
+
+class DirectoryVersion(models.Model):
+    """
+        Single-row counter bumped whenever a user shown in the directory is
+        created, changed or deleted (see `chat.directory`). The directory's
+        ETag and Last-Modified come from it.
+    """
+    id = models.PositiveSmallIntegerField(primary_key=True, default=1, editable=False)
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"User directory v{self.version}"
+
+
+class Room(BaseUUID):
+    """A named group chat (`ws/chat/<name>/`), created when someone first joins it."""
+    name = models.CharField(max_length=100, unique=True)
+
+    def __str__(self):
+        return self.name
+
+
+class RoomMembership(BaseUUID):
+    """An authenticated user who has joined a room."""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='room_memberships')
+    joined_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['room', 'user']
+
+    def __str__(self):
+        return f"{self.user_id} in {self.room_id}"
+
+
+class RoomMessage(BaseUUID):
+    """
+        A message sent to a room. `sender_name` is what the room was shown:
+        the user's name, or the name an anonymous client gave itself.
+    """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='messages')
+    sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    sender_name = models.CharField(max_length=100)
+    content = models.TextField()
+    # Set when the message is received, not when its batch is written
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['timestamp']
+        indexes = [
+            # Keyset pagination over a room's history
+            models.Index(fields=['room', 'timestamp', 'id'], name='room_message_room_ts'),
+        ]
+
+    def __str__(self):
+        return f"{self.sender_name}: {self.content[:30]}"
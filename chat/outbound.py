@@ -0,0 +1,278 @@
+import asyncio
+import functools
+import logging
+from collections import deque
+import msgpack
+from . import profiling
+
+logger = logging.getLogger(__name__)
+
+# Close code telling the client it fell too far behind and has to resync
+RESYNC_CLOSE_CODE = 4008
+
+_uninspectable_logged = False
+
+
+def _buffered_bytes(transport):
+    # Twisted's private FileDescriptor state: the pending buffer, the part of it already written, and the
+    # data queued since it was last joined
+    return len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+
+
+def _cant_inspect(transport, error):
+    global _uninspectable_logged
+    if not _uninspectable_logged:
+        _uninspectable_logged = True
+        logger.warning("Can't read the write buffer of %s (%r); outbound queues only count their own frames",
+                       type(transport).__name__, error)
+
+
+def transport_backlog(send):
+    """
+        A callable returning how many bytes the server holds for the socket
+        but hasn't written yet, or None when the server doesn't expose it.
+
+        Daphne's `send` never waits: it hands the frame to Twisted, whose
+        transport buffers without bound while a client isn't reading. Its
+        `send` is a partial over the Twisted protocol, so the transport's
+        write buffer can be read from there. That buffer is Twisted's private
+        state: if a daphne or Twisted release changes it, this logs once and
+        the queue falls back to counting its own frames.
+    """
+    protocol = send.args[0] if isinstance(send, functools.partial) and send.args else None
+    outer = getattr(protocol, "transport", None)
+    if outer is None:
+        return None  # Not daphne
+    # Under TLS the protocol's transport wraps the TCP one
+    transport = outer
+    while transport is not None and not hasattr(transport, "dataBuffer"):
+        transport = getattr(transport, "transport", None)
+    try:
+        _buffered_bytes(transport)
+    except (AttributeError, TypeError) as e:
+        _cant_inspect(outer, e)
+        return None
+
+    def backlog():
+        try:
+            return _buffered_bytes(transport)
+        except (AttributeError, TypeError) as e:
+            _cant_inspect(transport, e)
+            return 0
+    return backlog
+
+
+class _Entry:
+    __slots__ = ("frame", "ephemeral", "key")
+
+    def __init__(self, frame, ephemeral, key):
+        self.frame = frame
+        self.ephemeral = ephemeral
+        self.key = key
+
+
+class OutboundQueue:
+    """
+        Bounded outbound frame queue of one WebSocket connection.
+
+        Handlers only append to the queue; a writer task puts frames on the
+        socket, so a client that stops reading backs up here instead of in
+        the channel layer or the server's buffers. On servers whose `send`
+        waits for the socket to drain (uvicorn) that happens by itself; for
+        the others `backlog` reports the bytes the server is still holding
+        (see `transport_backlog`), and the writer stops handing it frames
+        while that is above `high_water`.
+
+        With batching on, frames produced within `window` seconds are written
+        as a single array frame (a JSON array of the encoded objects, or a
+        MessagePack array) instead of one WebSocket write each. A batch goes
+        out early once it holds `max_frames` frames or `max_bytes` bytes.
+
+        When more than `max_depth` frames or `max_queue_bytes` bytes are
+        waiting, `policy` decides what happens:
+        - "drop_oldest": drop the oldest ephemeral frames (receipts, presence)
+        - "coalesce": like "drop_oldest", and a frame with a `key` also
+          replaces a queued frame with the same key
+        - "disconnect": call `on_overflow` so the consumer can close the socket
+        Chat messages are never dropped silently: if nothing ephemeral is
+        left to drop, every policy falls back to `on_overflow`.
+
+        `write` is the coroutine function that puts one frame on the socket,
+        called with str for text connections and bytes for binary ones.
+    """
+    POLICIES = ("drop_oldest", "coalesce", "disconnect")
+    # Seconds between checks of the server's buffer while it is above `high_water`
+    DRAIN_POLL = 0.01
+    # Process-wide counters across all connections
+    totals = {"dropped": 0, "coalesced": 0, "overflows": 0}
+
+    def __init__(self, write, binary=False, batching=False, window=0.005, max_frames=64, max_bytes=65536,
+                 max_depth=1000, max_queue_bytes=4 * 1024 * 1024, policy="drop_oldest", on_overflow=None,
+                 backlog=None, high_water=256 * 1024):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown outbound queue policy: {policy!r}")
+        self._write = write
+        self.binary = binary
+        self.batching = batching
+        self.window = window
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self.max_queue_bytes = max_queue_bytes
+        self.policy = policy
+        self.on_overflow = on_overflow
+        self.backlog = backlog
+        self.high_water = high_water
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._keys = {}
+        self._task = None
+        self._batch_full = None
+        self._closed = False
+        # Counters: frames handed to us vs. writes that reached the socket
+        self.frames = 0
+        self.writes = 0
+        self.batches = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.peak_depth = 0
+        self.stalls = 0
+
+    def put(self, frame, ephemeral=False, key=None):
+        """Queue a frame for the socket. Never waits."""
+        if self._closed:
+            return
+        self.frames += 1
+
+        if key is not None and self.policy == "coalesce":
+            queued = self._keys.get(key)
+            if queued is not None:
+                self._queued_bytes += len(frame) - len(queued.frame)
+                queued.frame = frame
+                self.coalesced += 1
+                self.totals["coalesced"] += 1
+                return
+
+        entry = _Entry(frame, ephemeral, key)
+        self._queue.append(entry)
+        self._queued_bytes += len(frame)
+        if key is not None:
+            self._keys[key] = entry
+
+        if len(self._queue) > self.max_depth or self._queued_bytes > self.max_queue_bytes:
+            self._overflow()
+            if self._closed:
+                return
+        self.peak_depth = max(self.peak_depth, len(self._queue))
+
+        if self._task is None:
+            self._batch_full = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        elif self.batching and (len(self._queue) >= self.max_frames or self._queued_bytes >= self.max_bytes):
+            self._batch_full.set()
+
+    def _overflow(self):
+        if self.policy != "disconnect":
+            # Drop ephemeral frames, oldest first, until we're back under the limits
+            kept = deque()
+            while self._queue and (len(self._queue) + len(kept) > self.max_depth
+                                   or self._queued_bytes > self.max_queue_bytes):
+                entry = self._queue.popleft()
+                if entry.ephemeral:
+                    self._forget(entry)
+                    self.dropped += 1
+                    self.totals["dropped"] += 1
+                else:
+                    kept.append(entry)
+            kept.extend(self._queue)
+            self._queue = kept
+            if len(self._queue) <= self.max_depth and self._queued_bytes <= self.max_queue_bytes:
+                return
+
+        self.totals["overflows"] += 1
+        self.discard()
+        if self.on_overflow is not None:
+            asyncio.create_task(self.on_overflow())
+
+    def _forget(self, entry):
+        self._queued_bytes -= len(entry.frame)
+        if entry.key is not None and self._keys.get(entry.key) is entry:
+            del self._keys[entry.key]
+
+    def _take(self, limit_frames, limit_bytes):
+        entries, size = [], 0
+        while self._queue and len(entries) < limit_frames and (not entries or size < limit_bytes):
+            entry = self._queue.popleft()
+            self._forget(entry)
+            entries.append(entry)
+            size += len(entry.frame)
+        return entries
+
+    async def _run(self):
+        try:
+            while self._queue:
+                if not self.batching:
+                    await self._send(self._take(1, 0)[0].frame)
+                    continue
+
+                # Give the batch a chance to fill up before writing it
+                if len(self._queue) < self.max_frames and self._queued_bytes < self.max_bytes:
+                    try:
+                        await asyncio.wait_for(self._batch_full.wait(), self.window)
+                    except asyncio.TimeoutError:
+                        pass
+                self._batch_full.clear()
+
+                frames = [entry.frame for entry in self._take(self.max_frames, self.max_bytes)]
+                if len(frames) == 1:
+                    await self._send(frames[0])
+                elif frames:
+                    self.batches += 1
+                    if self.binary:
+                        await self._send(msgpack.Packer().pack_array_header(len(frames)) + b"".join(frames))
+                    else:
+                        await self._send("[" + ",".join(frames) + "]")
+        finally:
+            self._task = None
+
+    async def _send(self, frame):
+        self.writes += 1
+        self.bytes += len(frame)
+        async with profiling.traced("OutboundQueue.send"):
+            await self._write(frame)
+        if self.backlog is not None and self.backlog() > self.high_water:
+            await self._wait_for_drain()
+
+    async def _wait_for_drain(self):
+        """Hold further frames here, where the policy applies, until the server's buffer drains."""
+        self.stalls += 1
+        while not self._closed and self.backlog() > self.high_water // 2:
+            await asyncio.sleep(self.DRAIN_POLL)
+
+    def discard(self):
+        """Drop everything queued and stop accepting frames (the socket is going away)."""
+        self._closed = True
+        self._queue.clear()
+        self._keys.clear()
+        self._queued_bytes = 0
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {
+            "batching": self.batching,
+            "policy": self.policy,
+            "frames": self.frames,
+            "writes": self.writes,
+            "batches": self.batches,
+            "bytes": self.bytes,
+            "depth": len(self._queue),
+            "queued_bytes": self._queued_bytes,
+            "peak_depth": self.peak_depth,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "stalls": self.stalls,
+            "transport_backlog": self.backlog() if self.backlog is not None else None,
+        }
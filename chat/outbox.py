@@ -0,0 +1,249 @@
+import asyncio
+import logging
+from datetime import timedelta
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from . import wire
+from .db_writer import get_database_writer
+from .lifespan import on_shutdown
+from .models import OutboxEvent
+from .user_cache import get_user_cache
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def conversation_group_name(user_a_id, user_b_id):
+    """Channel layer group shared by both sides of a one-to-one conversation."""
+    return "conversation_" + "_".join(sorted([str(user_a_id), str(user_b_id)]))
+
+
+def record_message(message):
+    """
+        Queue the broadcast of a newly saved message. Call it in the
+        transaction that saves the message, so the event exists if and only
+        if the message does; the dispatcher is woken once that commits.
+    """
+    OutboxEvent.objects.create(
+        group_name=conversation_group_name(message.sender_id, message.receiver_id),
+        event_type="chat_message",
+        payload={
+            "message_id": str(message.id),
+            "sender_id": str(message.sender_id),
+            "receiver_id": str(message.receiver_id),
+            "message": message.content,
+        },
+    )
+    transaction.on_commit(get_outbox_dispatcher().wake)
+
+
+def user_group_name(user_id):
+    """Channel layer group of all of a user's multiplexed (`ws/user/`) connections."""
+    return f"user_{user_id}"
+
+
+def chat_message_event(message_id, sender_id, receiver_id, content, sender_name, received_at=None):
+    """The conversation group event of a new message, encoded once per wire format."""
+    return {
+        "type": "chat_message",
+        "message_id": message_id,
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "received_at": received_at,
+        **wire.encode_frames({
+            "message": content,
+            "sender": sender_name,
+            "receiver_id": receiver_id,
+            "message_id": message_id,
+            "seen": False
+        })
+    }
+
+
+async def send_to_participants(layer, message_id, sender_id, receiver_id, content, sender_name, received_at=None):
+    """
+        Deliver a new message to both participants' user groups, each framed
+        with the `conversation` it belongs to from that side: the other
+        participant's id. The sender's own connections get it too, which
+        is how they learn the message id.
+    """
+    for user_id, conversation in {receiver_id: sender_id, sender_id: receiver_id}.items():
+        await layer.group_send(user_group_name(user_id), {
+            "type": "user_message",
+            "message_id": message_id,
+            "sender_id": sender_id,
+            "received_at": received_at,
+            **wire.encode_frames({
+                "conversation": conversation,
+                "message": content,
+                "sender": sender_name,
+                "sender_id": sender_id,
+                "receiver_id": receiver_id,
+                "message_id": message_id,
+                "seen": False
+            })
+        })
+
+
+async def send_seen_to_participants(layer, reader_id, sender_id, receipt):
+    """Deliver a "seen" receipt to both participants' user groups, named by conversation like messages."""
+    for user_id, conversation in {sender_id: reader_id, reader_id: sender_id}.items():
+        await layer.group_send(user_group_name(user_id), {
+            "type": "user_seen",
+            "conversation": conversation,
+            "reader_id": reader_id,
+            **wire.encode_frames({"type": "seen", "conversation": conversation, **receipt})
+        })
+
+
+async def _publish_chat_message(layer, group_name, payload):
+    """The same events `ConversationMixin.send_message` sends for WebSocket messages."""
+    sender = await get_user_cache().aget(payload["sender_id"])
+    message = (payload["message_id"], payload["sender_id"], payload["receiver_id"], payload["message"],
+               getattr(sender, "name", "Unknown"))
+    await layer.group_send(group_name, chat_message_event(*message))
+    await send_to_participants(layer, *message)
+
+
+EVENT_PUBLISHERS = {
+    "chat_message": _publish_chat_message,
+}
+
+
+class OutboxDispatcher:
+    """
+        Publishes `OutboxEvent` rows to the channel layer, oldest first, in
+        batches of `batch_size`, and deletes them once sent.
+
+        It is woken right after a transaction that wrote events commits and
+        polls every `poll_interval` seconds for events written by processes
+        that have no dispatcher running. Rows are claimed for `lease` seconds
+        before publishing, so several dispatchers can share the table; a row
+        whose dispatcher died is published again once its claim expires.
+        A chat message goes to its conversation group and to both
+        participants' user groups; after a partial failure all of them get
+        it again, so clients deduplicate by message id.
+    """
+
+    def __init__(self, batch_size=100, poll_interval=1.0, lease=30):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.published = 0
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+
+    async def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self.run())
+
+    def wake(self):
+        """Thread-safe: called from `on_commit` in whichever thread saved the events."""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return  # Not running in this process; another dispatcher's poll picks the rows up
+        loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.drain()
+            except Exception:
+                logger.exception("Error dispatching outbox events")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain(self):
+        """Publish batches until the outbox is empty; returns the number of events handled."""
+        total = 0
+        while True:
+            count = await self.dispatch_batch()
+            total += count
+            if count < self.batch_size:
+                return total
+
+    async def dispatch_batch(self):
+        events = await get_database_writer().run(self._claim)
+        if not events:
+            return 0
+
+        layer = get_channel_layer()
+        done = []
+        for event in events:
+            publisher = EVENT_PUBLISHERS.get(event.event_type)
+            if publisher is None:
+                logger.error("Dropping outbox event %s of unknown type %r", event.id, event.event_type)
+                done.append(event.id)
+                continue
+            try:
+                await publisher(layer, event.group_name, event.payload)
+            except Exception:
+                # Left claimed; published again when the claim expires
+                logger.exception("Error publishing outbox event %s", event.id)
+                continue
+            done.append(event.id)
+
+        await get_database_writer().run(self._delete, done)
+        self.published += len(done)
+        return len(events)
+
+    def _claim(self):
+        with metrics.DB_SECONDS.labels("outbox_claim").time():
+            return self._claim_batch()
+
+    def _claim_batch(self):
+        now = timezone.now()
+        until = now + timedelta(seconds=self.lease)
+        claimable = OutboxEvent.objects.filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+        with transaction.atomic():
+            ids = list(claimable.values_list('id', flat=True)[:self.batch_size])
+            if not ids:
+                return []
+            # Re-checked in the UPDATE, so a row claimed by another dispatcher meanwhile is skipped
+            claimable.filter(id__in=ids).update(claimed_until=until)
+        return list(OutboxEvent.objects.filter(id__in=ids, claimed_until=until))
+
+    @staticmethod
+    def _delete(ids):
+        if ids:
+            OutboxEvent.objects.filter(id__in=ids).delete()
+
+    async def close(self):
+        """Stop polling and publish whatever is still waiting."""
+        if self._task is None or self._task.done():
+            return
+        self._task.cancel()
+        try:
+            await self.drain()
+        except Exception:
+            logger.exception("Error dispatching outbox events")
+
+
+_dispatcher = None
+
+
+def get_outbox_dispatcher():
+    """Return the process-wide outbox dispatcher, configured from settings."""
+    global _dispatcher
+    if _dispatcher is None:
+        options = getattr(settings, "CHAT_OUTBOX", {})
+        _dispatcher = OutboxDispatcher(
+            batch_size=options.get("BATCH_SIZE", 100),
+            poll_interval=options.get("POLL_INTERVAL", 1.0),
+            lease=options.get("LEASE", 30),
+        )
+        on_shutdown(_dispatcher.close)
+    return _dispatcher
@@ -0,0 +1,243 @@
+import base64
+import binascii
+import uuid
+from datetime import datetime
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from .archive import archive_key
+
+
+def encode_cursor(timestamp, pk):
+    """Encode a (timestamp, id) key as an opaque, URL-safe cursor."""
+    raw = f"{timestamp.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by `encode_cursor` back into (timestamp, id)."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, pk = raw.split("|", 1)
+        return datetime.fromisoformat(timestamp), uuid.UUID(pk)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValidationError({"cursor": "Invalid cursor."})
+
+
+class KeysetPagination(BasePagination):
+    """
+        Cursor pagination on a (timestamp, id) key.
+
+        - no cursor: the newest page
+        - `?before=<cursor>`: the page of rows older than the cursor
+        - `?after=<cursor>`: the page of rows newer than the cursor
+
+        Rows in a page are returned oldest first unless `oldest_first` is
+        turned off. `paginate_queryset` also
+        accepts a list of querysets; each one gets the keyset condition and
+        they are combined with UNION ALL, so every part can be served by its
+        own index range scan instead of one OR'ed filter.
+
+        Views with a `get_archive()` method returning a
+        `chat.archive.ConversationArchive` get pages that cross into the
+        archived range completed from the archive.
+    """
+    timestamp_field = 'timestamp'
+    oldest_first = True
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    before_query_param = 'before'
+    after_query_param = 'after'
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            size = self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_row_key(self, row):
+        return getattr(row, self.timestamp_field), row.pk
+
+    def archived_row(self, message):
+        """A `Message` read from the archive, as the kind of row `fetch` returns."""
+        return message
+
+    def keyset_filter(self, key, newer):
+        timestamp, pk = key
+        lookup = 'gt' if newer else 'lt'
+        return (
+            Q(**{f"{self.timestamp_field}__{lookup}": timestamp}) |
+            Q(**{self.timestamp_field: timestamp, f"pk__{lookup}": pk})
+        )
+
+    def get_ordering(self, newer):
+        prefix = '' if newer else '-'
+        return f"{prefix}{self.timestamp_field}", f"{prefix}pk"
+
+    def fetch(self, queryset, key, newer, limit):
+        """
+            Return up to `limit` rows past `key` (all rows when it's None),
+            nearest first: ascending when `newer`, descending otherwise.
+        """
+        querysets = queryset if isinstance(queryset, (list, tuple)) else [queryset]
+        querysets = [qs.order_by() for qs in querysets]
+        if key is not None:
+            condition = self.keyset_filter(key, newer)
+            querysets = [qs.filter(condition) for qs in querysets]
+
+        combined = querysets[0]
+        if len(querysets) > 1:
+            combined = combined.union(*querysets[1:], all=True)
+        return list(combined.order_by(*self.get_ordering(newer))[:limit])
+
+    def merge_archived(self, rows, archive, key, newer, limit):
+        """
+            Add archived rows to a page fetched from the table. Archived
+            messages are all older than the ones in the table, so walking
+            back only needs the archive once the table runs out, and walking
+            forward only while the cursor is inside the archived range.
+        """
+        if newer:
+            last_key = archive.last_key()
+            if key is None or last_key is None or archive_key(key) >= last_key:
+                return rows
+        elif len(rows) >= limit:
+            return rows
+
+        archived = archive.fetch(key, newer, limit)
+        if not archived:
+            return rows
+        seen = {self.get_row_key(row)[1] for row in rows}
+        archived = [self.archived_row(message) for message in archived]
+        merged = rows + [row for row in archived if self.get_row_key(row)[1] not in seen]
+        merged.sort(key=self.get_row_key, reverse=not newer)
+        return merged[:limit]
+
+    def fetch_page(self, queryset, key, newer, limit, view=None):
+        """`fetch`, completed from the view's archive when it has one."""
+        rows = self.fetch(queryset, key, newer, limit)
+        archive = view.get_archive() if hasattr(view, 'get_archive') else None
+        if archive is not None:
+            rows = self.merge_archived(rows, archive, key, newer, limit)
+        return rows
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+        if before and after:
+            raise ValidationError({"cursor": "Use either `before` or `after`, not both."})
+
+        self.newer = bool(after)
+        cursor = decode_cursor(after or before) if (after or before) else None
+        self.has_cursor = cursor is not None
+        page_size = self.get_page_size(request)
+
+        rows = self.fetch_page(queryset, cursor, self.newer, page_size + 1, view)
+        self.has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if not self.newer:
+            rows.reverse()
+        self.page = rows  # Always oldest first, the links rely on it
+        return rows if self.oldest_first else rows[::-1]
+
+    def has_older(self):
+        # Walking forward from a cursor always leaves the cursor row behind us
+        return self.has_more if not self.newer else self.has_cursor
+
+    def has_newer(self):
+        return self.has_more if self.newer else self.has_cursor
+
+    def get_link(self, param, row):
+        if row is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, param, encode_cursor(*self.get_row_key(row)))
+
+    def get_previous_link(self):
+        if not self.page or not self.has_older():
+            return None
+        return self.get_link(self.before_query_param, self.page[0])
+
+    def get_next_link(self):
+        if not self.page or not self.has_newer():
+            return None
+        return self.get_link(self.after_query_param, self.page[-1])
+
+    def get_paginated_response(self, data):
+        return Response({
+            'previous': self.get_previous_link(),
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+
+class InboxPagination(KeysetPagination):
+    """Keyset pagination over conversation summaries, by last activity."""
+    timestamp_field = 'last_message_at'
+    oldest_first = False
+    page_size = 30
+    max_page_size = 100
+
+
+class DirectoryPagination(BasePagination):
+    """
+        Forward-only keyset pagination over the user directory's
+        (`name_key`, id) key, for the `values()` rows of
+        `chat.directory.listed_users`. `?after=<cursor>` continues from the
+        previous page's `next` link.
+    """
+    page_size = 100
+    max_page_size = 500
+    page_size_query_param = 'page_size'
+    after_query_param = 'after'
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            size = self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    @staticmethod
+    def encode_cursor(name_key, pk):
+        return base64.urlsafe_b64encode(f"{pk}|{name_key}".encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            pk, name_key = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+            return name_key, uuid.UUID(pk)
+        except (ValueError, UnicodeDecodeError, binascii.Error):
+            raise ValidationError({"cursor": "Invalid cursor."})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        after = request.query_params.get(self.after_query_param)
+        if after:
+            name_key, pk = self.decode_cursor(after)
+            queryset = queryset.filter(Q(name_key__gt=name_key) | Q(name_key=name_key, id__gt=pk))
+        page_size = self.get_page_size(request)
+
+        rows = list(queryset.order_by('name_key', 'id')[:page_size + 1])
+        self.has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        self.last_key = (rows[-1]['name_key'], rows[-1]['id']) if rows else None
+        for row in rows:
+            del row['name_key']
+        return rows
+
+    def get_next_link(self):
+        if not self.has_more:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.after_query_param, self.encode_cursor(*self.last_key))
+
+    def get_paginated_response(self, data):
+        return Response({'success': True, 'next': self.get_next_link(), 'data': data})
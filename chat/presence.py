@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import threading
+import time
+from django.conf import settings
+from .lifespan import on_shutdown
+from .process_bus import get_process_bus
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceRegistry:
+    """
+        Who is online, tracked per process and shared across processes.
+
+        Local connections live in a sharded table (user id -> {channel name:
+        last heartbeat}) so lookups from REST threads don't contend with the
+        consumers. Every `debounce` seconds the users whose state actually
+        changed are announced to the other processes in one batch, so a
+        connection that drops and comes back inside the window produces no
+        event at all. A full snapshot goes out every `snapshot_interval`
+        seconds; a process that stops sending them is forgotten after three
+        missed snapshots.
+
+        Connections that have sent at least one heartbeat are dropped when
+        they go quiet for `heartbeat_timeout` seconds.
+    """
+
+    def __init__(self, shards=16, debounce=1.0, heartbeat_timeout=60, snapshot_interval=30):
+        self.debounce = debounce
+        self.heartbeat_timeout = heartbeat_timeout
+        self.snapshot_interval = snapshot_interval
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self._changed = set()
+        self._changed_lock = threading.Lock()
+        self._announced = set()
+        self._remote = {}  # process id -> (expires_at, set of user ids)
+        self._task = None
+        self._loop = None
+
+    def _shard(self, user_id):
+        return self._shards[hash(user_id) % len(self._shards)]
+
+    def _mark_changed(self, user_id):
+        with self._changed_lock:
+            self._changed.add(user_id)
+
+    def connect(self, user_id, channel_name):
+        user_id = str(user_id)
+        connections, lock = self._shard(user_id)
+        with lock:
+            connections.setdefault(user_id, {})[channel_name] = None
+        self._mark_changed(user_id)
+
+    def disconnect(self, user_id, channel_name):
+        user_id = str(user_id)
+        connections, lock = self._shard(user_id)
+        with lock:
+            channels = connections.get(user_id)
+            if channels is not None:
+                channels.pop(channel_name, None)
+                if not channels:
+                    del connections[user_id]
+        self._mark_changed(user_id)
+
+    def heartbeat(self, user_id, channel_name):
+        user_id = str(user_id)
+        connections, lock = self._shard(user_id)
+        with lock:
+            channels = connections.get(user_id)
+            if channels is not None and channel_name in channels:
+                channels[channel_name] = time.monotonic()
+
+    def is_local(self, user_id):
+        connections, lock = self._shard(user_id)
+        with lock:
+            return user_id in connections
+
+    def online(self, user_ids):
+        """Return the subset of `user_ids` that is online in any process."""
+        now = time.monotonic()
+        remote = [users for expires_at, users in list(self._remote.values()) if expires_at > now]
+        result = []
+        for user_id in user_ids:
+            user_id = str(user_id)
+            if self.is_local(user_id) or any(user_id in users for users in remote):
+                result.append(user_id)
+        return result
+
+    async def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        bus = get_process_bus()
+        if self._task is None:
+            bus.subscribe("presence.batch", self._on_batch)
+            bus.subscribe("presence.snapshot", self._on_snapshot)
+        await bus.ensure_started()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        bus = get_process_bus()
+        last_snapshot = 0
+        while True:
+            await asyncio.sleep(self.debounce)
+            try:
+                self._sweep()
+                online, offline = self._collect_changes()
+                if online or offline:
+                    await bus.publish({"type": "presence.batch", "online": online, "offline": offline})
+                if time.monotonic() - last_snapshot >= self.snapshot_interval:
+                    last_snapshot = time.monotonic()
+                    await bus.publish({"type": "presence.snapshot", "users": list(self._announced)})
+            except Exception:
+                logger.exception("Error publishing presence")
+
+    def _sweep(self):
+        """Drop connections whose heartbeats stopped."""
+        if not self.heartbeat_timeout:
+            return
+        cutoff = time.monotonic() - self.heartbeat_timeout
+        for connections, lock in self._shards:
+            with lock:
+                for user_id in list(connections):
+                    channels = connections[user_id]
+                    for channel_name, last_beat in list(channels.items()):
+                        if last_beat is not None and last_beat < cutoff:
+                            del channels[channel_name]
+                    if not channels:
+                        del connections[user_id]
+                        self._mark_changed(user_id)
+
+    def _collect_changes(self):
+        with self._changed_lock:
+            changed, self._changed = self._changed, set()
+        online, offline = [], []
+        for user_id in changed:
+            if self.is_local(user_id):
+                if user_id not in self._announced:
+                    self._announced.add(user_id)
+                    online.append(user_id)
+            elif user_id in self._announced:
+                self._announced.discard(user_id)
+                offline.append(user_id)
+        return online, offline
+
+    def _expiry(self):
+        return time.monotonic() + 3 * self.snapshot_interval
+
+    async def _on_batch(self, event):
+        if event["origin"] == get_process_bus().process_id:
+            return
+        _, users = self._remote.get(event["origin"], (None, set()))
+        users = (users | set(event["online"])) - set(event["offline"])
+        self._remote[event["origin"]] = (self._expiry(), users)
+
+    async def _on_snapshot(self, event):
+        if event["origin"] == get_process_bus().process_id:
+            return
+        self._remote[event["origin"]] = (self._expiry(), set(event["users"]))
+        now = time.monotonic()
+        for origin, (expires_at, _) in list(self._remote.items()):
+            if expires_at <= now:
+                self._remote.pop(origin, None)
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
+_registry = None
+
+
+def get_presence():
+    """Return the process-wide presence registry, configured from settings."""
+    global _registry
+    if _registry is None:
+        options = getattr(settings, "CHAT_PRESENCE", {})
+        _registry = PresenceRegistry(
+            shards=options.get("SHARDS", 16),
+            debounce=options.get("DEBOUNCE", 1.0),
+            heartbeat_timeout=options.get("HEARTBEAT_TIMEOUT", 60),
+            snapshot_interval=options.get("SNAPSHOT_INTERVAL", 30),
+        )
+        on_shutdown(_registry.close)
+    return _registry
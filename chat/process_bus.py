@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+import uuid
+from channels.layers import get_channel_layer
+from .lifespan import on_shutdown
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessBus:
+    """
+        Process-to-process events over the channel layer.
+
+        Every process owns one channel that is joined to a single shared
+        group, so an event published here reaches each process once instead
+        of once per WebSocket connection. Handlers are registered per event
+        type with `subscribe`; events published by this process come back to
+        it too, with `origin` set to `process_id`.
+    """
+    group_name = "chat.process-bus"
+    # Group membership expires in the channel layer, so re-join well before that
+    refresh_interval = 3600
+
+    def __init__(self):
+        self.process_id = uuid.uuid4().hex
+        self.channel_name = None
+        self._handlers = {}
+        self._layer = None
+        self._task = None
+        self._loop = None
+
+    def subscribe(self, event_type, handler):
+        """Register a coroutine function called with every event of `event_type`."""
+        self._handlers.setdefault(event_type, []).append(handler)
+
+    async def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        self._layer = get_channel_layer()
+        self.channel_name = await self._layer.new_channel()
+        await self._layer.group_add(self.group_name, self.channel_name)
+        self._task = loop.create_task(self._listen())
+
+    async def publish(self, event):
+        await self.ensure_started()
+        await self._layer.group_send(self.group_name, dict(event, origin=self.process_id))
+
+    def publish_threadsafe(self, event):
+        """
+            `publish` from any thread without waiting for it. Dropped when the
+            bus hasn't been started in this process.
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self.publish(event), loop).add_done_callback(self._published)
+
+    @staticmethod
+    def _published(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Error publishing on the process bus: %s", future.exception())
+
+    async def _listen(self):
+        refreshed_at = time.monotonic()
+        while True:
+            # Our own events keep the receive busy, so re-join on the clock rather than on a timeout
+            timeout = max(0.0, refreshed_at + self.refresh_interval - time.monotonic())
+            try:
+                event = await asyncio.wait_for(self._layer.receive(self.channel_name), timeout)
+            except asyncio.TimeoutError:
+                event = None
+            if time.monotonic() - refreshed_at >= self.refresh_interval:
+                await self._layer.group_add(self.group_name, self.channel_name)
+                refreshed_at = time.monotonic()
+            if event is None:
+                continue
+
+            for handler in self._handlers.get(event.get("type"), ()):
+                try:
+                    await handler(event)
+                except Exception:
+                    logger.exception("Error in process bus handler for %s", event.get("type"))
+
+    async def close(self):
+        if self._task is None or self._task.done():
+            return
+        self._task.cancel()
+        await self._layer.group_discard(self.group_name, self.channel_name)
+
+
+_bus = None
+
+
+def get_process_bus():
+    """Return this process's bus."""
+    global _bus
+    if _bus is None:
+        _bus = ProcessBus()
+        on_shutdown(_bus.close)
+    return _bus
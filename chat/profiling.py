@@ -0,0 +1,200 @@
+"""
+    Sampled per-handler profiling.
+
+    A sampled call (`CHAT_PROFILING["SAMPLE_RATE"]` of them) gets a trace in a
+    context variable; `stage("name")` blocks inside it record their wall and
+    CPU time into it, including code run through `database_sync_to_async`
+    and tasks started from the handler, which inherit the context. Traces
+    slower than `SLOW_THRESHOLD` seconds are appended as JSON lines to a
+    rotating file, summarized by the `profile_summary` command.
+
+    CPU time is the thread's: for stages that await, it includes whatever
+    else the event loop ran meanwhile.
+
+    Consumers get it through `ProfiledConsumerMixin`, DRF views through
+    `ProfiledViewMixin`. Outside a sampled call `stage()` costs one context
+    variable lookup.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from django.conf import settings
+
+_current = contextvars.ContextVar("chat_profiling_trace", default=None)
+_slow_logger = None
+
+
+def get_options():
+    options = getattr(settings, "CHAT_PROFILING", {})
+    return {
+        "SAMPLE_RATE": options.get("SAMPLE_RATE", 0.0),
+        "SLOW_THRESHOLD": options.get("SLOW_THRESHOLD", 0.1),
+        "FILE": options.get("FILE", os.path.join(settings.BASE_DIR, "logs", "slow_traces.jsonl")),
+        "MAX_BYTES": options.get("MAX_BYTES", 10 * 1024 * 1024),
+        "BACKUP_COUNT": options.get("BACKUP_COUNT", 5),
+    }
+
+
+class Trace:
+    __slots__ = ("name", "wall", "cpu", "stages", "finished")
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        self.stages = []
+        self.finished = False
+
+    def as_dict(self, wall, cpu):
+        staged = sum(stage_wall for _, stage_wall, _ in self.stages)
+        return {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "handler": self.name,
+            "wall_ms": round(wall * 1000, 3),
+            "cpu_ms": round(cpu * 1000, 3),
+            "other_ms": round(max(wall - staged, 0) * 1000, 3),
+            "stages": [
+                {"name": name, "wall_ms": round(stage_wall * 1000, 3), "cpu_ms": round(stage_cpu * 1000, 3)}
+                for name, stage_wall, stage_cpu in self.stages
+            ],
+        }
+
+
+class _Stage:
+    __slots__ = ("trace", "name", "wall", "cpu")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.trace.finished:
+            self.trace.stages.append((self.name, time.perf_counter() - self.wall, time.thread_time() - self.cpu))
+        return False
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    """Time a block as one stage of the current trace; a no-op when the call isn't sampled."""
+    trace = _current.get()
+    if trace is None or trace.finished:
+        return _NO_STAGE
+    return _Stage(trace, name)
+
+
+class traced:
+    """
+        Context manager (sync or async) that traces the block when the call is
+        sampled. Nested traces are folded into the outer one; a task that
+        outlives the handler it was started from (e.g. a socket writer) can
+        start its own traces once that handler's trace is finished.
+    """
+    __slots__ = ("name", "trace", "token")
+
+    def __init__(self, name):
+        self.name = name
+        self.trace = None
+
+    def __enter__(self):
+        rate = get_options()["SAMPLE_RATE"]
+        current = _current.get()
+        if rate and (current is None or current.finished) and random.random() < rate:
+            self.trace = Trace(self.name)
+            self.token = _current.set(self.trace)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            _current.reset(self.token)
+            finish(self.trace)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc_info):
+        return self.__exit__(*exc_info)
+
+
+def finish(trace):
+    wall = time.perf_counter() - trace.wall
+    cpu = time.thread_time() - trace.cpu
+    trace.finished = True
+    options = get_options()
+    if wall >= options["SLOW_THRESHOLD"]:
+        get_slow_logger(options).info(json.dumps(trace.as_dict(wall, cpu)))
+
+
+def get_slow_logger(options):
+    """Logger writing one JSON trace per line to the rotating slow-trace file."""
+    global _slow_logger
+    if _slow_logger is None:
+        os.makedirs(os.path.dirname(options["FILE"]), exist_ok=True)
+        handler = RotatingFileHandler(options["FILE"], maxBytes=options["MAX_BYTES"],
+                                      backupCount=options["BACKUP_COUNT"])
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger = logging.getLogger("chat.profiling.slow")
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        _slow_logger = logger
+    return _slow_logger
+
+
+class ProfiledConsumerMixin:
+    """
+        Traces every handler a consumer dispatches (connect, receive,
+        disconnect and channel layer events), named `<Consumer>.<message type>`.
+        Goes first in the bases so it wraps the consumer's `dispatch`.
+    """
+
+    async def dispatch(self, message):
+        async with traced(f"{type(self).__name__}.{message['type']}"):
+            await super().dispatch(message)
+
+
+class ProfiledViewMixin:
+    """
+        Traces DRF requests, named `<View>.<method>`, with the authentication
+        and permission checks, the paginated query and the response
+        finalization as stages; the rest (mostly serialization) shows up as
+        `other_ms`.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with traced(f"{type(self).__name__}.{request.method}"):
+            return super().dispatch(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        with stage("initial"):
+            return super().initial(request, *args, **kwargs)
+
+    def paginate_queryset(self, queryset):
+        with stage("query"):
+            return super().paginate_queryset(queryset)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        with stage("finalize"):
+            return super().finalize_response(request, response, *args, **kwargs)
@@ -0,0 +1,208 @@
+"""
+    Token-bucket limits on inbound WebSocket frames.
+
+    Three layers, checked in order (see `RateLimitMixin` in the consumers):
+    - per connection: every frame, checked with the frame size before the
+      frame is decoded
+    - per user: every frame from any of the user's connections, in any
+      process, also before decoding
+    - per action: after decoding, before the action does any DB or channel
+      layer work (`message`, `mark_seen`, `presence`, ...)
+
+    All state is in memory. The per-user buckets are kept in step across
+    processes by publishing each process's consumption over the process bus
+    every `sync_interval` seconds; the other processes drain it from their
+    own buckets. A user spread over several processes can therefore exceed
+    the limit by at most one sync interval's worth of frames.
+"""
+import asyncio
+import logging
+import time
+from django.conf import settings
+from .lifespan import on_shutdown
+from .process_bus import get_process_bus
+
+logger = logging.getLogger(__name__)
+
+# Close code for connections that keep sending while throttled
+RATE_LIMIT_CLOSE_CODE = 4029
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`."""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        # `now` may predate the bucket when it was read before the bucket was created
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now, cost=1):
+        self._refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    def drain(self, amount, now):
+        """Remove tokens spent elsewhere; the debt is capped at one burst."""
+        self._refill(now)
+        self.tokens = max(-self.burst, self.tokens - amount)
+
+    def retry_after(self, cost=1):
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+def make_bucket(limit):
+    """A bucket from a {"RATE": ..., "BURST": ...} setting; None (unlimited) without a rate."""
+    if not limit or not limit.get("RATE"):
+        return None
+    return TokenBucket(limit["RATE"], limit.get("BURST", limit["RATE"]))
+
+
+class ConnectionRateLimiter:
+    """
+        One connection's frame and per-action buckets. `check_*` return None
+        when the frame may go on, or the (scope, retry_after) it was
+        throttled on.
+    """
+
+    def __init__(self, frame_limit, action_limits, max_frame_bytes):
+        self.frames = make_bucket(frame_limit)
+        self.action_limits = action_limits
+        self.actions = {}
+        self.max_frame_bytes = max_frame_bytes
+
+    def check_frame(self, size, now):
+        if self.max_frame_bytes and size > self.max_frame_bytes:
+            return "size", None
+        if self.frames is not None and not self.frames.take(now):
+            return "connection", self.frames.retry_after()
+        return None
+
+    def check_action(self, action, now):
+        bucket = self.actions.get(action)
+        if bucket is None:
+            if action not in self.action_limits:
+                return None
+            bucket = self.actions[action] = make_bucket(self.action_limits[action])
+            if bucket is None:
+                return None
+        if not bucket.take(now):
+            return "action", bucket.retry_after()
+        return None
+
+
+class UserRateLimiter:
+    """Process-wide per-user buckets, synchronized across processes over the process bus."""
+
+    def __init__(self, rate, burst, sync_interval=1.0, idle_after=300):
+        self.rate = rate
+        self.burst = burst
+        self.sync_interval = sync_interval
+        self.idle_after = idle_after
+        self._buckets = {}
+        self._consumed = {}
+        self._task = None
+        self._loop = None
+
+    def check(self, user_id, now):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        if not bucket.take(now):
+            return "user", bucket.retry_after()
+        self._consumed[user_id] = self._consumed.get(user_id, 0) + 1
+        return None
+
+    async def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        bus = get_process_bus()
+        if self._task is None:
+            bus.subscribe("ratelimit.usage", self._on_usage)
+        await bus.ensure_started()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        bus = get_process_bus()
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                consumed, self._consumed = self._consumed, {}
+                if consumed:
+                    await bus.publish({"type": "ratelimit.usage", "usage": consumed})
+                if time.monotonic() - last_sweep >= self.idle_after:
+                    last_sweep = time.monotonic()
+                    self._sweep()
+            except Exception:
+                logger.exception("Error publishing rate limit usage")
+
+    def _sweep(self):
+        """Forget full buckets; they are recreated full on the next frame anyway."""
+        now = time.monotonic()
+        for user_id in [user_id for user_id, bucket in self._buckets.items() if bucket.is_full(now)]:
+            del self._buckets[user_id]
+
+    async def _on_usage(self, event):
+        if event["origin"] == get_process_bus().process_id:
+            return
+        now = time.monotonic()
+        for user_id, count in event["usage"].items():
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+            bucket.drain(count, now)
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
+def get_options():
+    options = getattr(settings, "CHAT_RATE_LIMITS", {})
+    return {
+        "MAX_FRAME_BYTES": options.get("MAX_FRAME_BYTES", 64 * 1024),
+        "CONNECTION": options.get("CONNECTION", {"RATE": 20, "BURST": 40}),
+        "USER": options.get("USER", {"RATE": 30, "BURST": 60}),
+        "ACTIONS": options.get("ACTIONS", {}),
+        "SYNC_INTERVAL": options.get("SYNC_INTERVAL", 1.0),
+        "CLOSE_AFTER": options.get("CLOSE_AFTER", 50),
+    }
+
+
+def connection_limiter():
+    """A fresh limiter for one connection, configured from settings."""
+    options = get_options()
+    return ConnectionRateLimiter(options["CONNECTION"], options["ACTIONS"], options["MAX_FRAME_BYTES"])
+
+
+_user_limiter = None
+
+
+def get_user_limiter():
+    """Return the process-wide per-user limiter, or None when per-user limits are off."""
+    global _user_limiter
+    if _user_limiter is None:
+        options = get_options()
+        limit = options["USER"]
+        if not limit or not limit.get("RATE"):
+            return None
+        _user_limiter = UserRateLimiter(limit["RATE"], limit.get("BURST", limit["RATE"]),
+                                        sync_interval=options["SYNC_INTERVAL"])
+        on_shutdown(_user_limiter.close)
+    return _user_limiter
@@ -0,0 +1,181 @@
+"""
+    Persistent group chat rooms.
+
+    Rooms, memberships and messages are stored (see `Room`, `RoomMembership`,
+    `RoomMessage`); messages go through the batched `RoomMessageWriter`.
+
+    Each process keeps the last `recent_messages` messages of every room it
+    has members in, in a ring buffer fed by the room's channel layer group,
+    so a join is served its backlog from memory. The buffer is loaded from
+    the database when the first local member joins and dropped when the last
+    one leaves, since the process stops receiving the room's messages then.
+    Older history is paged over REST from `RoomMessage`.
+"""
+import asyncio
+import logging
+from collections import deque
+from channels.db import database_sync_to_async
+from django.conf import settings
+from .db_writer import get_database_writer
+from .lifespan import on_shutdown
+from .models import Room, RoomMembership, RoomMessage
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def room_group_name(room_name):
+    return f"chat_{room_name}"
+
+
+def message_entry(message):
+    """The form a room message takes in frames and in the ring buffer."""
+    return {
+        "message_id": str(message.id),
+        "message": message.content,
+        "sender": message.sender_name,
+        "timestamp": message.timestamp.isoformat(),
+    }
+
+
+class RecentMessages:
+    """Ring buffer of one room's newest messages, oldest first, deduplicated by id."""
+    __slots__ = ("entries", "ids", "members", "ready")
+
+    def __init__(self):
+        self.entries = deque()
+        self.ids = set()
+        self.members = 0
+        self.ready = None  # Resolved once loaded from the database
+
+    def add(self, entry, size):
+        message_id = entry["message_id"]
+        if message_id in self.ids:
+            return
+        self.entries.append(entry)
+        self.ids.add(message_id)
+        while len(self.entries) > size:
+            self.ids.discard(self.entries.popleft()["message_id"])
+
+
+class RoomRegistry:
+    """
+        Process-wide room state: room ids by name and the recent-message
+        buffers of rooms with local members, for at most `max_rooms` rooms
+        (joins beyond that read their backlog from the database).
+    """
+
+    def __init__(self, recent_messages=50, max_rooms=1000):
+        self.recent_messages = recent_messages
+        self.max_rooms = max_rooms
+        self._room_ids = {}
+        self._buffers = {}
+        self._background = set()
+        self.hits = 0
+        self.loads = 0
+
+    async def join(self, room_name, user_id=None):
+        """
+            Register a local member and return (room id, backlog): the room's
+            newest messages, oldest first. The membership of `user_id` is
+            recorded in the background.
+        """
+        room_id = await self.room_id(room_name)
+        if user_id is not None:
+            task = asyncio.ensure_future(get_database_writer().run(self._add_member, room_id, user_id))
+            self._background.add(task)
+            task.add_done_callback(self._member_added)
+
+        buffer = self._buffers.get(room_name)
+        if buffer is None:
+            if len(self._buffers) >= self.max_rooms:
+                return room_id, await database_sync_to_async(self._load)(room_id, self.recent_messages)
+            buffer = self._buffers[room_name] = RecentMessages()
+            buffer.ready = asyncio.ensure_future(self._fill(buffer, room_id))
+        else:
+            self.hits += 1
+        buffer.members += 1
+        try:
+            await asyncio.shield(buffer.ready)
+        except Exception:
+            logger.exception("Error loading recent messages of room %s", room_name)
+        return room_id, list(buffer.entries)
+
+    def leave(self, room_name):
+        buffer = self._buffers.get(room_name)
+        if buffer is None:
+            return
+        buffer.members -= 1
+        if buffer.members <= 0:
+            del self._buffers[room_name]
+
+    def record(self, room_name, entry):
+        """Add a message this process received for the room; repeats are ignored."""
+        buffer = self._buffers.get(room_name)
+        if buffer is not None:
+            buffer.add(entry, self.recent_messages)
+
+    async def room_id(self, room_name):
+        room_id = self._room_ids.get(room_name)
+        if room_id is None:
+            room_id = self._room_ids[room_name] = await get_database_writer().run(self._get_or_create, room_name)
+        return room_id
+
+    async def _fill(self, buffer, room_id):
+        self.loads += 1
+        entries = await database_sync_to_async(self._load)(room_id, self.recent_messages)
+        # Messages delivered while loading are already in the buffer; keep them newest
+        live = list(buffer.entries)
+        buffer.entries.clear()
+        buffer.ids.clear()
+        for entry in entries + live:
+            buffer.add(entry, self.recent_messages)
+
+    @staticmethod
+    def _load(room_id, limit):
+        with metrics.DB_SECONDS.labels("room_recent").time():
+            messages = list(RoomMessage.objects.filter(room_id=room_id).order_by('-timestamp', '-id')[:limit])
+        return [message_entry(message) for message in reversed(messages)]
+
+    @staticmethod
+    def _get_or_create(room_name):
+        return Room.objects.get_or_create(name=room_name)[0].id
+
+    @staticmethod
+    def _add_member(room_id, user_id):
+        RoomMembership.objects.bulk_create([RoomMembership(room_id=room_id, user_id=user_id)], ignore_conflicts=True)
+
+    def _member_added(self, task):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error recording room membership: %s", task.exception())
+
+    def stats(self):
+        return {
+            'rooms': len(self._buffers),
+            'max_rooms': self.max_rooms,
+            'recent_messages': self.recent_messages,
+            'buffered_messages': sum(len(buffer.entries) for buffer in self._buffers.values()),
+            'hits': self.hits,
+            'loads': self.loads,
+        }
+
+    async def close(self):
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+
+_registry = None
+
+
+def get_room_registry():
+    """Return the process-wide room registry, configured from settings."""
+    global _registry
+    if _registry is None:
+        options = getattr(settings, "CHAT_ROOMS", {})
+        _registry = RoomRegistry(
+            recent_messages=options.get("RECENT_MESSAGES", 50),
+            max_rooms=options.get("MAX_ROOMS", 1000),
+        )
+        on_shutdown(_registry.close)
+    return _registry
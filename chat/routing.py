@@ -1,7 +1,8 @@
 from django.urls import path
-from .consumers import ChatConsumer, OneToOneChatConsumer
+from .consumers import ChatConsumer, OneToOneChatConsumer, UserChatConsumer
 
 websocket_urlpatterns = [
     path("ws/chat/<str:room_name>/", ChatConsumer.as_asgi()),
     path("ws/onetone/<uuid:user_id>/", OneToOneChatConsumer.as_asgi()),
+    path("ws/user/", UserChatConsumer.as_asgi()),
 ]
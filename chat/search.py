@@ -0,0 +1,145 @@
+"""
+    Full-text search over message content, backed by the SQLite FTS5 table
+    `chat_message_fts` (see migration 0008).
+
+    The FTS table is an external-content index of `chat_message`, keyed by
+    the message table's rowid and kept in sync by triggers on insert, update
+    of `content` and delete. VACUUM can renumber the rowids of a table
+    without an INTEGER PRIMARY KEY, so run `rebuild_search_index` after one.
+
+    On SQLite, Django applies most changes to an existing `Message` field
+    (AlterField, RemoveField, ...) by copying `chat_message` into a new
+    table, which silently drops the triggers and renumbers the rows. A
+    migration that does that must recreate the triggers (the CREATE TRIGGER
+    statements of migration 0008) and rebuild the index afterwards, with
+    `rebuild_search_index`.
+"""
+import base64
+import binascii
+import html
+import re
+from django.db import connection, transaction
+from rest_framework.exceptions import ValidationError
+from .models import Message
+
+FTS_TABLE = "chat_message_fts"
+SNIPPET_TOKENS = 12
+# Control characters can't occur in the escaped output, so they are safe placeholders for the <mark> tags
+_MARK_OPEN, _MARK_CLOSE = "\x02", "\x03"
+_TERM = re.compile(r"\w+", re.UNICODE)
+
+
+def is_available():
+    return connection.vendor == "sqlite"
+
+
+def build_match_query(text):
+    """
+        Turn user input into an FTS5 query: every word must match, the last
+        one as a prefix so results show up while typing. Operators and quotes
+        in the input are treated as plain text.
+    """
+    terms = _TERM.findall(text)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def encode_search_cursor(score, rowid):
+    return base64.urlsafe_b64encode(f"{score!r}|{rowid}".encode()).decode()
+
+
+def decode_search_cursor(cursor):
+    try:
+        score, rowid = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return float(score), int(rowid)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValidationError({"cursor": "Invalid cursor."})
+
+
+def highlight(snippet):
+    """HTML-escape a snippet and turn the match placeholders into <mark> tags."""
+    return html.escape(snippet).replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+
+
+def search_messages(user_id, text, limit, after=None, other_user_id=None):
+    """
+        Messages sent or received by `user_id` that match `text`, best match
+        first (bm25), as `Message` objects with `snippet`, `score` and
+        `fts_rowid` attributes. `after` is the (score, rowid) key of the last
+        row of the previous page; `other_user_id` narrows the search to one
+        conversation.
+    """
+    query = build_match_query(text)
+    if query is None:
+        return []
+
+    user_hex = user_id.hex
+    where = ["f.chat_message_fts MATCH %s"]
+    params = [_MARK_OPEN, _MARK_CLOSE, SNIPPET_TOKENS, query]
+    if other_user_id is None:
+        where.append("(m.sender_id = %s OR m.receiver_id = %s)")
+        params += [user_hex, user_hex]
+    else:
+        other_hex = other_user_id.hex
+        where.append("((m.sender_id = %s AND m.receiver_id = %s) OR (m.sender_id = %s AND m.receiver_id = %s))")
+        params += [user_hex, other_hex, other_hex, user_hex]
+    if after is not None:
+        where.append("(bm25(f.chat_message_fts) > %s OR (bm25(f.chat_message_fts) = %s AND f.rowid > %s))")
+        params += [after[0], after[0], after[1]]
+    params.append(limit)
+    conditions = " AND ".join(where)
+
+    sql = f"""
+        SELECT m.id, m.sender_id, m.receiver_id, m.content, m.timestamp, m.seen,
+               snippet(f.chat_message_fts, 0, %s, %s, '…', %s) AS snippet,
+               bm25(f.chat_message_fts) AS score,
+               f.rowid AS fts_rowid
+        FROM {FTS_TABLE} f
+        JOIN chat_message m ON m.rowid = f.rowid
+        WHERE {conditions}
+        ORDER BY bm25(f.chat_message_fts), f.rowid
+        LIMIT %s
+    """
+    return list(Message.objects.raw(sql, params))
+
+
+def rebuild_index(chunk_size=5000, progress=None):
+    """
+        Repopulate the FTS table from `chat_message`, `chunk_size` rows per
+        transaction so writers are never blocked for long. Searches only see
+        part of the messages until it finishes, and messages edited or
+        deleted meanwhile that weren't reindexed yet can leave stale entries,
+        so prefer a quiet moment. Returns the number indexed.
+    """
+    # Rows inserted from here on are indexed by the trigger, so stop at the current end
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')")
+        cursor.execute("SELECT coalesce(max(rowid), 0) FROM chat_message")
+        end_rowid = cursor.fetchone()[0]
+
+    last_rowid, total = 0, 0
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT max(rowid), count(*) FROM (SELECT rowid FROM chat_message WHERE rowid > %s "
+                "AND rowid <= %s ORDER BY rowid LIMIT %s)",
+                [last_rowid, end_rowid, chunk_size],
+            )
+            upper, count = cursor.fetchone()
+            if not count:
+                break
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE}(rowid, content) SELECT rowid, content FROM chat_message "
+                "WHERE rowid > %s AND rowid <= %s",
+                [last_rowid, upper],
+            )
+        last_rowid, total = upper, total + count
+        if progress is not None:
+            progress(total)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+    return total
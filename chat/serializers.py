@@ -3,6 +3,7 @@ from .models import *
 from django.core.validators import validate_email, EmailValidator
 from django.core.exceptions import ValidationError
 from django.contrib.auth import authenticate
+from .search import highlight
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -59,9 +60,57 @@ class PrivateChatSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 class MessageSerializer(serializers.ModelSerializer):
-    sender = serializers.ReadOnlyField(source='sender.username')
-    receiver = serializers.ReadOnlyField(source='receiver.username')
+    sender = serializers.ReadOnlyField(source='sender.name')
+    receiver = serializers.ReadOnlyField(source='receiver.name')
 
     class Meta:
         model = Message
-        fields = ['id', 'sender', 'receiver', 'content', 'timestamp', 'seen']
\ No newline at end of file
+        fields = ['id', 'sender', 'receiver', 'content', 'timestamp', 'seen']
+
+
+class RoomMessageSerializer(serializers.ModelSerializer):
+    """A room message in the same shape as the room's WebSocket frames."""
+    message_id = serializers.UUIDField(source='id', read_only=True)
+    message = serializers.CharField(source='content', read_only=True)
+    sender = serializers.CharField(source='sender_name', read_only=True)
+
+    class Meta:
+        model = RoomMessage
+        fields = ['message_id', 'sender_id', 'sender', 'message', 'timestamp']
+
+
+class ConversationSummarySerializer(serializers.ModelSerializer):
+    """
+        An inbox row seen from the requesting user's side. Expects `user` and a
+        `users` map ({id: User}) of the other participants in the context.
+    """
+    other_user = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ConversationSummary
+        fields = ['id', 'other_user', 'last_message_id', 'last_message_preview', 'last_message_at',
+                  'last_sender', 'unread_count']
+
+    def get_other_user(self, obj):
+        other_id = obj.other_user_id(self.context['user'].id)
+        other = self.context['users'].get(other_id)
+        return {'id': other_id, 'name': other.name if other else None}
+
+    def get_unread_count(self, obj):
+        return obj.unread_for(self.context['user'].id)
+
+
+class MessageSearchResultSerializer(serializers.ModelSerializer):
+    """A search hit with its highlighted snippet, from `chat.search.search_messages`."""
+    sender_id = serializers.UUIDField(read_only=True)
+    receiver_id = serializers.UUIDField(read_only=True)
+    snippet = serializers.SerializerMethodField()
+    score = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = Message
+        fields = ['id', 'sender_id', 'receiver_id', 'timestamp', 'seen', 'snippet', 'score']
+
+    def get_snippet(self, obj):
+        return highlight(obj.snippet)
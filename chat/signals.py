@@ -1,25 +1,55 @@
-from django.db.models.signals import post_save
+import functools
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-import json
-from .models import Message
+from .models import Message, User
+from . import directory, outbox
+from .history_cache import conversation_key, get_history_cache
+from .summaries import record_messages
+from .user_cache import get_user_cache
 
 @receiver(post_save, sender=Message)
-def broadcast_new_message(sender, instance, created, **kwargs):
+def queue_message_broadcast(sender, instance, created, **kwargs):
+    """
+        Broadcast messages saved through the ORM (e.g. the REST API) via the
+        outbox, so the event commits with the message and is sent after it.
+    """
+    if created and instance.receiver_id is not None:
+        outbox.record_message(instance)
+
+
+@receiver(post_save, sender=Message)
+def update_conversation_summary(sender, instance, created, **kwargs):
+    """Keep the inbox summary in step with messages saved through the ORM."""
     if created:
-        # Compute the same group name as in the consumer using sender and receiver IDs
-        sender_id = instance.sender.id
-        receiver_id = instance.receiver.id
-        sorted_ids = sorted([str(sender_id), str(receiver_id)])
-        room_group_name = "conversation_" + "_".join(sorted_ids)
-        
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            room_group_name,
-            {
-                "type": "chat_message",  # This maps to the chat_message() method in the consumer
-                "message": instance.content,
-                "sender": instance.sender.name,
-            }
-        )
+        record_messages([instance])
+
+
+@receiver(post_save, sender=Message)
+def update_history_cache(sender, instance, created, **kwargs):
+    """Add new messages to the cached newest page once committed; drop it on any other change."""
+    if instance.receiver_id is None:
+        return
+    cache = get_history_cache()
+    if created:
+        transaction.on_commit(functools.partial(cache.record_messages, [instance]))
+    else:
+        transaction.on_commit(functools.partial(
+            cache.invalidate, conversation_key(instance.sender_id, instance.receiver_id)
+        ))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Drop the user from every process's cache on status, logout or any other change, once committed."""
+    transaction.on_commit(functools.partial(get_user_cache().invalidate, instance.pk))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def bump_directory_version(sender, instance, update_fields=None, **kwargs):
+    """Invalidate cached directory pages and client ETags, unless only unlisted fields changed."""
+    if update_fields and set(update_fields) <= directory.UNLISTED_FIELDS:
+        return
+    directory.bump_version()
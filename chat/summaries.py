@@ -0,0 +1,65 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Greatest
+from .models import ConversationSummary
+
+
+def record_messages(messages):
+    """
+        Fold newly saved messages into their conversation summaries: bump the
+        receiver's unread counter and move the "last message" forward.
+        Expects the messages in the order they were sent.
+    """
+    changes = {}
+    for message in messages:
+        if message.receiver_id is None:
+            continue
+        low, high = ConversationSummary.pair(message.sender_id, message.receiver_id)
+        change = changes.setdefault((low, high), {'last': None, 'unread_low': 0, 'unread_high': 0})
+        change['last'] = message
+        if not message.seen:
+            side = 'unread_low' if str(message.receiver_id) == str(low) else 'unread_high'
+            change[side] += 1
+
+    for (low, high), change in changes.items():
+        _apply(low, high, change['last'], change['unread_low'], change['unread_high'])
+
+
+def _apply(low, high, last, unread_low, unread_high):
+    summaries = ConversationSummary.objects.filter(user_low_id=low, user_high_id=high)
+    last_fields = {
+        'last_message_id': last.id,
+        'last_message_preview': last.content[:ConversationSummary.PREVIEW_LENGTH],
+        'last_message_at': last.timestamp,
+        'last_sender_id': last.sender_id,
+    }
+
+    counters = {'unread_low': F('unread_low') + unread_low, 'unread_high': F('unread_high') + unread_high}
+    if not summaries.update(**counters):
+        try:
+            with transaction.atomic():
+                ConversationSummary.objects.create(
+                    user_low_id=low, user_high_id=high,
+                    unread_low=unread_low, unread_high=unread_high,
+                    **last_fields
+                )
+            return
+        except IntegrityError:
+            # Created concurrently, add our counts to that row instead
+            summaries.update(**counters)
+
+    # Never move the last message backwards if a newer one was recorded first
+    summaries.filter(
+        Q(last_message_at__isnull=True) | Q(last_message_at__lte=last.timestamp)
+    ).update(**last_fields)
+
+
+def record_seen(reader_id, other_user_id, count):
+    """Take `count` messages off the reader's unread counter."""
+    if not count:
+        return
+    low, high = ConversationSummary.pair(reader_id, other_user_id)
+    side = 'unread_low' if str(reader_id) == str(low) else 'unread_high'
+    ConversationSummary.objects.filter(user_low_id=low, user_high_id=high).update(
+        **{side: Greatest(F(side) - count, Value(0))}
+    )
@@ -1,3 +1,1225 @@
-from django.test import TestCase
+import asyncio
+import functools
+import tempfile
+import threading
+import uuid
+from types import SimpleNamespace
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from urllib.parse import parse_qs, urlencode, urlparse
+from asgiref.sync import sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone as django_timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+from .consumers import OneToOneChatConsumer
+from .db_writer import DatabaseWriter
+from .middleware import TokenAuthMiddlewareStack
+from .models import ConversationSummary, Message, OutboxEvent, Room, RoomMembership, RoomMessage, User
+from .outbound import OutboundQueue, transport_backlog
+from .outbox import OutboxDispatcher, chat_message_event, conversation_group_name, user_group_name
+from .pagination import KeysetPagination, encode_cursor
+from .archive import ConversationArchive
+from .history_cache import HistoryPageCache, conversation_key, get_history_cache, message_row
+from .layers import ShardedInMemoryChannelLayer
+from .process_bus import ProcessBus, get_process_bus
+from .ratelimit import RATE_LIMIT_CLOSE_CODE
+from .rooms import RecentMessages, RoomRegistry, message_entry
+from .routing import websocket_urlpatterns
+from .user_cache import get_user_cache
+from .writer import MessageWriter
+from . import profiling, wire
 
-# Create your tests here.
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "chat.layers.ShardedInMemoryChannelLayer"}}
+
+
+def create_users(count=2):
+    return [User.objects.create_user(email=f"user{i}@example.com", name=f"User {i}") for i in range(count)]
+
+
+def connect(path, user, subprotocols=None, **params):
+    """A WebSocket communicator for `path`, authenticated as `user` like a client would be."""
+    application = TokenAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+    query = urlencode({"token": str(AccessToken.for_user(user)), **params})
+    return WebsocketCommunicator(application, f"{path}?{query}", subprotocols=subprotocols)
+
+
+async def receive_until(communicator, frame_type, timeout=2):
+    """The next JSON frame of `frame_type`, skipping the others (presence, acks)."""
+    while True:
+        frame = await communicator.receive_json_from(timeout)
+        if frame.get("type") == frame_type:
+            return frame
+
+
+def summary_of(user_a, user_b):
+    low, high = ConversationSummary.pair(user_a.id, user_b.id)
+    return ConversationSummary.objects.filter(user_low_id=low, user_high_id=high).first()
+
+
+class MessageWriterTests(TransactionTestCase):
+    """The write-behind queue commits on its own thread, so these can't run inside a test transaction."""
+
+    def setUp(self):
+        self.sender, self.receiver = create_users()
+
+    @staticmethod
+    def stored(message_id):
+        return Message.objects.filter(id=message_id).exists()
+
+    async def test_flush_durability_returns_once_committed(self):
+        writer = MessageWriter(batch_size=10, flush_interval=0.01, durability="flush")
+        message = await writer.save(self.sender.id, self.receiver.id, "hello")
+        self.assertTrue(await sync_to_async(self.stored)(message.id))
+        await writer.close()
+
+    async def test_enqueue_durability_returns_before_commit(self):
+        writer = MessageWriter(batch_size=10, flush_interval=60, durability="enqueue")
+        message = await writer.save(self.sender.id, self.receiver.id, "hello")
+        self.assertFalse(await sync_to_async(self.stored)(message.id))
+        # Closing writes what is still queued
+        await writer.close()
+        self.assertTrue(await sync_to_async(self.stored)(message.id))
+
+    async def test_full_batch_is_written_without_waiting_for_the_interval(self):
+        writer = MessageWriter(batch_size=3, flush_interval=60, durability="flush")
+        futures = [writer.enqueue(self.sender.id, self.receiver.id, f"message {i}", wait=True)[1] for i in range(3)]
+        for future in futures:
+            await future
+        self.assertEqual(await Message.objects.acount(), 3)
+        await writer.close()
+
+    async def test_closed_writer_refuses_messages(self):
+        writer = MessageWriter(durability="flush")
+        await writer.save(self.sender.id, self.receiver.id, "before")
+        await writer.close()
+        with self.assertRaises(RuntimeError):
+            await writer.save(self.sender.id, self.receiver.id, "after")
+        self.assertEqual(await Message.objects.acount(), 1)
+
+    async def test_bad_row_fails_alone(self):
+        existing = await Message.objects.acreate(sender=self.sender, receiver=self.receiver, content="existing")
+        writer = MessageWriter(batch_size=10, flush_interval=0.05, durability="flush")
+        good, good_future = writer.enqueue(self.sender.id, self.receiver.id, "good", wait=True)
+        duplicate = Message(id=existing.id, sender_id=self.sender.id, receiver_id=self.receiver.id, content="duplicate")
+        _, duplicate_future = writer.enqueue_instance(duplicate, wait=True)
+
+        # The batch insert fails on the duplicate id; the rows are then retried one by one
+        with self.assertLogs('chat.writer', 'WARNING'):
+            self.assertEqual(await good_future, good)
+            with self.assertRaises(IntegrityError):
+                await duplicate_future
+        self.assertTrue(await sync_to_async(self.stored)(good.id))
+        self.assertEqual(await Message.objects.filter(id=existing.id).values_list('content', flat=True).aget(),
+                         "existing")
+        await writer.close()
+
+    async def test_failed_retry_fails_the_batch_and_keeps_the_writer_running(self):
+        writer = MessageWriter(batch_size=10, flush_interval=0.01, durability="flush")
+        locked = mock.Mock(run=mock.AsyncMock(side_effect=OperationalError("database is locked")))
+        with mock.patch("chat.writer.get_database_writer", return_value=locked), \
+                self.assertLogs('chat.writer', 'WARNING'):
+            with self.assertRaises(OperationalError):
+                await asyncio.wait_for(writer.save(self.sender.id, self.receiver.id, "lost"), 2)
+        message = await writer.save(self.sender.id, self.receiver.id, "saved")
+        self.assertTrue(await sync_to_async(self.stored)(message.id))
+        await writer.close()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_SEEN_RECEIPT_WINDOW=0)
+class SeenReceiptTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice, self.bob = create_users()
+        self.sent = [
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=f"message {i}") for i in range(3)
+        ]
+
+    async def test_mark_seen_updates_messages_counters_and_tells_both_sides(self):
+        self.assertEqual((await sync_to_async(summary_of)(self.alice, self.bob)).unread_for(self.bob.id), 3)
+        reader, sender = connect("/ws/user/", self.bob), connect("/ws/user/", self.alice)
+        self.assertTrue((await reader.connect())[0])
+        self.assertTrue((await sender.connect())[0])
+
+        read = self.sent[:2]
+        with self.assertLogs('chat.consumers', 'INFO'):
+            await reader.send_json_to({
+                "action": "mark_seen", "conversation": str(self.alice.id),
+                "message_ids": [str(message.id) for message in read] + ["not-a-uuid"],
+            })
+            await reader.receive_nothing(0.1)
+        for communicator in (reader, sender):
+            receipt = await receive_until(communicator, "seen")
+            self.assertEqual(receipt["reader_id"], str(self.bob.id))
+            self.assertEqual(receipt["up_to"], str(read[-1].id))
+            self.assertEqual(receipt["count"], 2)
+        await reader.disconnect()
+        await sender.disconnect()
+
+        seen = await sync_to_async(set)(Message.objects.filter(seen=True).values_list('id', flat=True))
+        self.assertEqual(seen, {message.id for message in read})
+        summary = await sync_to_async(summary_of)(self.alice, self.bob)
+        self.assertEqual(summary.unread_for(self.bob.id), 1)
+        self.assertEqual(summary.unread_for(self.alice.id), 0)
+
+    async def test_own_messages_are_not_marked(self):
+        sender = connect("/ws/user/", self.alice)
+        self.assertTrue((await sender.connect())[0])
+        await sender.send_json_to({
+            "action": "mark_seen", "conversation": str(self.bob.id), "message_ids": [str(self.sent[0].id)],
+        })
+        frames = []
+        while not await sender.receive_nothing(0.3):
+            frames.append(await sender.receive_json_from())
+        self.assertNotIn("seen", [frame.get("type") for frame in frames])
+        await sender.disconnect()
+        self.assertFalse(await Message.objects.filter(seen=True).aexists())
+
+    @override_settings(CHAT_SEEN_RECEIPT_WINDOW=0.2)
+    async def test_receipts_within_the_window_are_coalesced(self):
+        reader, sender = connect("/ws/user/", self.bob), connect("/ws/user/", self.alice)
+        self.assertTrue((await reader.connect())[0])
+        self.assertTrue((await sender.connect())[0])
+
+        for message in self.sent:
+            await reader.send_json_to({
+                "action": "mark_seen", "conversation": str(self.alice.id), "message_ids": [str(message.id)],
+            })
+        receipt = await receive_until(sender, "seen")
+        self.assertEqual(receipt["up_to"], str(self.sent[-1].id))
+        self.assertEqual(receipt["count"], 3)
+        frames = []
+        while not await sender.receive_nothing(0.4):
+            frames.append(await sender.receive_json_from())
+        self.assertNotIn("seen", [frame.get("type") for frame in frames])
+        await reader.disconnect()
+        await sender.disconnect()
+
+        summary = await sync_to_async(summary_of)(self.alice, self.bob)
+        self.assertEqual(summary.unread_for(self.bob.id), 0)
+
+
+class DatabaseWriterTests(TransactionTestCase):
+
+    def setUp(self):
+        self.writer = DatabaseWriter()
+        self.addCleanup(self.writer.stop)
+
+    def hold(self):
+        """Keep the writer thread busy until the returned event is set, so the next jobs share a batch."""
+        release, running = threading.Event(), threading.Event()
+
+        def blocker():
+            running.set()
+            release.wait(2)
+        self.writer.submit(blocker)
+        self.assertTrue(running.wait(2))
+        return release
+
+    def test_failing_job_only_rolls_back_itself(self):
+        def create(email):
+            return User.objects.create_user(email=email, name=email).id
+
+        def create_then_fail():
+            User.objects.create_user(email="partial@example.com", name="partial")
+            create("first@example.com")  # Taken by the first job of the batch
+
+        release = self.hold()
+        first = self.writer.submit(create, "first@example.com")
+        failing = self.writer.submit(create_then_fail)
+        last = self.writer.submit(create, "last@example.com")
+        release.set()
+
+        self.assertTrue(User.objects.filter(id=first.result(2)).exists())
+        self.assertTrue(User.objects.filter(id=last.result(2)).exists())
+        with self.assertRaises(IntegrityError):
+            failing.result(2)
+        self.assertFalse(User.objects.filter(email="partial@example.com").exists())
+        self.assertEqual(self.writer.stats()['batches'], 2)
+        self.assertEqual(self.writer.stats()['jobs'], 4)
+
+    def test_jobs_run_inline_on_the_writer_thread(self):
+        def outer():
+            return self.writer.call(threading.current_thread)
+        self.assertIs(self.writer.submit(outer).result(2), self.writer._thread)
+
+
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = create_users()
+        start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        # Three messages share a timestamp, so pages have to split on the id too
+        for i, offset in enumerate([0, 1, 2, 2, 2, 3, 4]):
+            sender, receiver = (cls.alice, cls.bob) if i % 2 else (cls.bob, cls.alice)
+            message = Message.objects.create(sender=sender, receiver=receiver, content=f"message {i}")
+            Message.objects.filter(id=message.id).update(timestamp=start + timedelta(seconds=offset))
+        cls.tie = start + timedelta(seconds=2)
+        cls.ordered = list(Message.objects.order_by('timestamp', 'id').values_list('id', flat=True))
+
+    def conversation(self):
+        """Both directions as separate querysets, combined by the paginator with UNION ALL."""
+        return [
+            Message.objects.filter(sender=self.alice, receiver=self.bob),
+            Message.objects.filter(sender=self.bob, receiver=self.alice),
+        ]
+
+    def page(self, **params):
+        paginator = KeysetPagination()
+        request = Request(APIRequestFactory().get('/messages/', {'page_size': 3, **params}))
+        rows = paginator.paginate_queryset(self.conversation(), request)
+        return paginator, [row.id for row in rows]
+
+    @staticmethod
+    def cursor(link, param):
+        return parse_qs(urlparse(link).query)[param][0] if link else None
+
+    def test_newest_page_without_cursor(self):
+        paginator, ids = self.page()
+        self.assertEqual(ids, self.ordered[-3:])
+        self.assertIsNone(paginator.get_next_link())
+        self.assertIsNotNone(paginator.get_previous_link())
+
+    def test_walking_back_visits_every_message_once(self):
+        paginator, ids = self.page()
+        seen = ids
+        while (before := self.cursor(paginator.get_previous_link(), 'before')) is not None:
+            paginator, ids = self.page(before=before)
+            seen = ids + seen
+        self.assertEqual(seen, self.ordered)
+
+    def test_walking_forward_visits_every_message_once(self):
+        first = Message.objects.get(id=self.ordered[0])
+        paginator, ids = self.page(after=encode_cursor(first.timestamp, first.id))
+        seen = [first.id] + ids
+        while (after := self.cursor(paginator.get_next_link(), 'after')) is not None:
+            paginator, ids = self.page(after=after)
+            seen += ids
+        self.assertEqual(seen, self.ordered)
+
+    def test_cursor_row_is_excluded_at_timestamp_ties(self):
+        tied = list(Message.objects.filter(timestamp=self.tie).order_by('id'))
+        self.assertEqual(len(tied), 3)
+        middle = tied[1]
+        _, older = self.page(before=encode_cursor(middle.timestamp, middle.id))
+        _, newer = self.page(after=encode_cursor(middle.timestamp, middle.id), page_size=10)
+        self.assertEqual(older[-1], tied[0].id)
+        self.assertEqual(newer[0], tied[2].id)
+        self.assertNotIn(middle.id, older + newer)
+        self.assertEqual(older + [middle.id] + newer, self.ordered[self.ordered.index(older[0]):])
+
+    def test_edges_have_no_links_past_them(self):
+        oldest = Message.objects.get(id=self.ordered[0])
+        paginator, ids = self.page(before=encode_cursor(oldest.timestamp, oldest.id))
+        self.assertEqual(ids, [])
+        self.assertIsNone(paginator.get_previous_link())
+
+        newest = Message.objects.get(id=self.ordered[-1])
+        paginator, ids = self.page(after=encode_cursor(newest.timestamp, newest.id))
+        self.assertEqual(ids, [])
+        self.assertIsNone(paginator.get_next_link())
+
+    def test_invalid_cursors_are_rejected(self):
+        with self.assertRaises(ValidationError):
+            self.page(before="not a cursor")
+        newest = Message.objects.get(id=self.ordered[-1])
+        cursor = encode_cursor(newest.timestamp, newest.id)
+        with self.assertRaises(ValidationError):
+            self.page(before=cursor, after=cursor)
+
+
+class InboxTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        users = sorted(create_users(6), key=lambda user: str(user.id))
+        # In the middle of the id order, so alice is user_low of some pairs and user_high of others
+        cls.alice, cls.stranger = users.pop(2), users.pop()
+        start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        listed = []
+        for other, offset in zip(users, [0, 1, 1, 2]):
+            low, high = ConversationSummary.pair(cls.alice.id, other.id)
+            unread = {'unread_low': 1, 'unread_high': 5} if low == cls.alice.id else {'unread_low': 5, 'unread_high': 1}
+            listed.append(ConversationSummary.objects.create(
+                user_low_id=low, user_high_id=high, last_message_at=start + timedelta(seconds=offset),
+                last_message_preview=f"to {other.name}", last_sender=other, **unread,
+            ).id)
+        # Neither a conversation without messages nor someone else's is listed
+        low, high = ConversationSummary.pair(cls.alice.id, cls.stranger.id)
+        ConversationSummary.objects.create(user_low_id=low, user_high_id=high)
+        low, high = ConversationSummary.pair(users[0].id, cls.stranger.id)
+        ConversationSummary.objects.create(user_low_id=low, user_high_id=high, last_message_at=start)
+        cls.newest_first = list(
+            ConversationSummary.objects.filter(id__in=listed).order_by('-last_message_at', '-id').values_list('id', flat=True)
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def get(self, url='/chat/inbox/', **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_most_recent_first_from_the_readers_side(self):
+        page = self.get()
+        self.assertEqual([row['id'] for row in page['results']], [str(pk) for pk in self.newest_first])
+        for row in page['results']:
+            self.assertEqual(row['last_message_preview'], f"to {row['other_user']['name']}")
+            self.assertEqual(row['unread_count'], 1)
+        self.assertIsNone(page['previous'])
+        self.assertIsNone(page['next'])
+
+    def test_walking_back_visits_every_conversation_once(self):
+        page = self.get(page_size=1)
+        ids = [row['id'] for row in page['results']]
+        while page['previous']:
+            page = self.get(page['previous'])
+            ids += [row['id'] for row in page['results']]
+        self.assertEqual(ids, [str(pk) for pk in self.newest_first])
+
+    def test_walking_forward_from_the_oldest(self):
+        oldest = ConversationSummary.objects.get(id=self.newest_first[-1])
+        page = self.get(page_size=2, after=encode_cursor(oldest.last_message_at, oldest.id))
+        ids = [row['id'] for row in page['results']]
+        while page['next']:
+            page = self.get(page['next'])
+            ids = [row['id'] for row in page['results']] + ids
+        self.assertEqual(ids, [str(pk) for pk in self.newest_first[:-1]])
+
+
+class ShardedLayerTests(SimpleTestCase):
+
+    async def test_full_channel_raises_until_drained(self):
+        layer = ShardedInMemoryChannelLayer(capacity=2)
+        await layer.send("chat.one", {"type": "a"})
+        await layer.send("chat.one", {"type": "b"})
+        with self.assertRaises(ChannelFull):
+            await layer.send("chat.one", {"type": "c"})
+        self.assertEqual((await layer.receive("chat.one"))["type"], "a")
+        await layer.send("chat.one", {"type": "c"})
+        self.assertEqual((await layer.receive("chat.one"))["type"], "b")
+        self.assertEqual((await layer.receive("chat.one"))["type"], "c")
+
+    async def test_group_send_skips_full_members(self):
+        layer = ShardedInMemoryChannelLayer(capacity=1)
+        await layer.group_add("room", "chat.full")
+        await layer.group_add("room", "chat.free")
+        await layer.send("chat.full", {"type": "earlier"})
+        await layer.group_send("room", {"type": "broadcast"})
+        self.assertEqual((await layer.receive("chat.full"))["type"], "earlier")
+        self.assertEqual((await layer.receive("chat.free"))["type"], "broadcast")
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive("chat.full"), 0.1)
+
+    async def test_expired_messages_and_memberships_are_dropped(self):
+        layer = ShardedInMemoryChannelLayer(expiry=0.05, group_expiry=0.05)
+        await layer.send("chat.one", {"type": "stale"})
+        await layer.group_add("room", "chat.two")
+        await asyncio.sleep(0.1)
+        await layer.group_send("room", {"type": "too late"})
+        await layer.send("chat.one", {"type": "fresh"})
+        self.assertEqual((await layer.receive("chat.one"))["type"], "fresh")
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive("chat.two"), 0.1)
+
+    async def test_group_send_skips_the_excluded_channel(self):
+        layer = ShardedInMemoryChannelLayer()
+        for channel in ("chat.sender", "chat.other"):
+            await layer.group_add("room", channel)
+        await layer.group_send("room", {"type": "broadcast", "exclude": "chat.sender"})
+        self.assertEqual((await layer.receive("chat.other"))["type"], "broadcast")
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive("chat.sender"), 0.1)
+
+    async def test_send_from_another_thread_wakes_the_receiver(self):
+        layer = ShardedInMemoryChannelLayer()
+        receiving = asyncio.create_task(layer.receive("chat.one"))
+        await asyncio.sleep(0.05)  # Waiting on its future before the send
+        await layer.group_add("room", "chat.one")
+        thread = threading.Thread(target=asyncio.run, args=(layer.group_send("room", {"type": "from a thread"}),))
+        thread.start()
+        message = await asyncio.wait_for(receiving, 1)
+        thread.join()
+        self.assertEqual(message["type"], "from a thread")
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class OutboxTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice, self.bob = create_users()
+
+    def post_message(self, content):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        return client.post(f"/chat/conversations/{self.bob.id}/", {"content": content})
+
+    async def test_rest_message_reaches_the_conversation_and_the_receiver(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(conversation_group_name(self.alice.id, self.bob.id), channel)
+        await layer.group_add(user_group_name(self.bob.id), channel)
+
+        response = await sync_to_async(self.post_message)("hello over REST")
+        self.assertEqual(response.status_code, 201)
+        message_id = response.data["id"]
+        self.assertEqual(await OutboxEvent.objects.acount(), 1)
+
+        self.assertEqual(await OutboxDispatcher().drain(), 1)
+        events = {}
+        for _ in range(2):
+            event = await layer.receive(channel)
+            events[event["type"]] = event
+        self.assertEqual(set(events), {"chat_message", "user_message"})
+        for event in events.values():
+            self.assertEqual(event["message_id"], str(message_id))
+            self.assertEqual(event["sender_id"], str(self.alice.id))
+        self.assertEqual(await OutboxEvent.objects.acount(), 0)
+
+    def test_event_rolls_back_with_its_message(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            Message.objects.create(sender=self.alice, receiver=self.bob, content="never sent")
+            raise RuntimeError
+        self.assertFalse(OutboxEvent.objects.exists())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_RESUME={"CHUNK_SIZE": 2, "MAX_MESSAGES": 4})
+class ResumeTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice, self.bob = create_users()
+        self.start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        self.sent = [self.message(self.alice, self.bob, i) for i in range(4)]
+        self.message(self.bob, self.alice, 10)  # Bob's own messages aren't replayed to him
+        # Delivered while bob was connected; only the replay should send them again
+        OutboxEvent.objects.all().delete()
+
+    def message(self, sender, receiver, offset):
+        message = Message.objects.create(sender=sender, receiver=receiver, content=f"message at {offset}")
+        Message.objects.filter(id=message.id).update(timestamp=self.start + timedelta(seconds=offset))
+        return message
+
+    @staticmethod
+    async def messages_until(communicator, frame_type):
+        """The chat messages received before the next `frame_type` frame."""
+        messages = []
+        while (frame := await communicator.receive_json_from(2)).get("type") != frame_type:
+            if "message_id" in frame:
+                messages.append(frame["message"])
+        return messages
+
+    async def test_missed_messages_are_replayed_oldest_first(self):
+        communicator = connect(f"/ws/onetone/{self.alice.id}/", self.bob, since=str(self.sent[0].id))
+        self.assertTrue((await communicator.connect())[0])
+        messages = await self.messages_until(communicator, "resumed")
+        self.assertEqual(messages, ["message at 1", "message at 2", "message at 3"])
+        await communicator.disconnect()
+
+    async def test_history_cursors_resume_too(self):
+        cursor = encode_cursor(self.start + timedelta(seconds=2), self.sent[2].id)
+        communicator = connect(f"/ws/onetone/{self.alice.id}/", self.bob, since=cursor)
+        self.assertTrue((await communicator.connect())[0])
+        self.assertEqual(await self.messages_until(communicator, "resumed"), ["message at 3"])
+        await communicator.disconnect()
+
+    async def test_too_far_behind_or_unknown_needs_a_resync(self):
+        for offset in (5, 6):
+            await sync_to_async(self.message)(self.alice, self.bob, offset)
+        for since in [str(self.sent[0].id), str(uuid.uuid4()), "not a cursor"]:
+            communicator = connect(f"/ws/onetone/{self.alice.id}/", self.bob, since=since)
+            self.assertTrue((await communicator.connect())[0])
+            await receive_until(communicator, "resync_required")
+            await communicator.disconnect()
+
+    async def test_live_messages_during_the_replay_are_sent_once(self):
+        fetched = asyncio.Event()
+        release = asyncio.Event()
+        fetch_missed = OneToOneChatConsumer.__dict__["_fetch_missed"]
+
+        async def held_fetch(consumer, key, limit):
+            fetched.set()
+            await release.wait()
+            return await fetch_missed(consumer, key, limit)
+
+        # Saved but only delivered live once the replay has started, so the replay sends it as well
+        saved = await sync_to_async(self.message)(self.alice, self.bob, 5)
+        await OutboxEvent.objects.all().adelete()
+        with mock.patch.object(OneToOneChatConsumer, "_fetch_missed", held_fetch):
+            communicator = connect(f"/ws/onetone/{self.alice.id}/", self.bob, since=str(self.sent[2].id))
+            self.assertTrue((await communicator.connect())[0])
+            await asyncio.wait_for(fetched.wait(), 2)
+
+            layer = get_channel_layer()
+            group = conversation_group_name(self.alice.id, self.bob.id)
+            for message_id, content in [(str(saved.id), saved.content), (str(uuid.uuid4()), "live only")]:
+                await layer.group_send(group, chat_message_event(
+                    message_id, str(self.alice.id), str(self.bob.id), content, self.alice.name
+                ))
+            await asyncio.sleep(0.1)  # Both reach the consumer while the replay is held
+            release.set()
+
+            self.assertEqual(await self.messages_until(communicator, "resumed"), ["message at 3", "message at 5"])
+            self.assertEqual((await communicator.receive_json_from(2))["message"], "live only")
+            self.assertTrue(await communicator.receive_nothing(0.2))
+            await communicator.disconnect()
+
+
+class ArchiveSummaryTests(TestCase):
+
+    def setUp(self):
+        self.alice, self.bob = create_users()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        archive_settings = override_settings(CHAT_ARCHIVE={"ROOT": root.name})
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+    def send(self, content, days_ago=0, seen=False):
+        message = Message.objects.create(sender=self.alice, receiver=self.bob, content=content, seen=seen)
+        timestamp = django_timezone.now() - timedelta(days=days_ago)
+        Message.objects.filter(id=message.id).update(timestamp=timestamp)
+        return message
+
+    def test_archiving_counts_as_reading(self):
+        self.send("old and read", days_ago=200, seen=True)
+        self.send("old", days_ago=200)
+        self.send("older", days_ago=201)
+        recent = self.send("recent")
+        self.assertEqual(summary_of(self.alice, self.bob).unread_for(self.bob.id), 3)
+
+        call_command('archive_messages', older_than_days=90, stdout=StringIO())
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [recent.id])
+        # Nothing can mark an archived message seen, so it is archived as read
+        self.assertEqual(summary_of(self.alice, self.bob).unread_for(self.bob.id), 1)
+        archived = ConversationArchive(self.alice.id, self.bob.id).fetch(None, False, 10)
+        self.assertEqual([(message.content, message.seen) for message in archived],
+                         [("old", True), ("old and read", True), ("older", True)])
+
+        call_command('rebuild_conversation_summaries', stdout=StringIO())
+        summary = summary_of(self.alice, self.bob)
+        self.assertEqual(summary.unread_for(self.bob.id), 1)
+        self.assertEqual(summary.last_message_id, recent.id)
+
+    def test_rebuild_keeps_fully_archived_conversations(self):
+        self.send("older", days_ago=201)
+        newest = self.send("old", days_ago=200)
+        newest.refresh_from_db()
+        call_command('archive_messages', older_than_days=90, stdout=StringIO())
+        self.assertFalse(Message.objects.exists())
+
+        call_command('rebuild_conversation_summaries', stdout=StringIO())
+        summary = summary_of(self.alice, self.bob)
+        self.assertIsNotNone(summary)
+        self.assertEqual(summary.last_message_id, newest.id)
+        self.assertEqual(summary.last_message_at, newest.timestamp)
+        self.assertEqual(summary.unread_for(self.bob.id), 0)
+
+
+def rate_limits(connection=None, actions=None, close_after=0):
+    return {"MAX_FRAME_BYTES": 1024, "CONNECTION": connection, "USER": None, "ACTIONS": actions or {},
+            "SYNC_INTERVAL": 1.0, "CLOSE_AFTER": close_after}
+
+
+class RoomBacklogTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice, = create_users(1)
+        self.room = Room.objects.create(name="lobby")
+        start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        self.stored = [
+            RoomMessage.objects.create(room=self.room, sender_name="Alice", content=f"message {i}",
+                                       timestamp=start + timedelta(seconds=i))
+            for i in range(5)
+        ]
+        self.registry = RoomRegistry(recent_messages=3, max_rooms=1)
+
+    @staticmethod
+    def entry(content, message_id=None):
+        return {"message_id": message_id or str(uuid.uuid4()), "message": content, "sender": "Bob",
+                "timestamp": django_timezone.now().isoformat()}
+
+    @staticmethod
+    def contents(entries):
+        return [entry["message"] for entry in entries]
+
+    def test_ring_buffer_keeps_the_newest_once(self):
+        buffer = RecentMessages()
+        first = self.entry("first")
+        for entry in [first, self.entry("second"), first, self.entry("third"), self.entry("fourth")]:
+            buffer.add(entry, 3)
+        self.assertEqual(self.contents(buffer.entries), ["second", "third", "fourth"])
+        # An evicted id is forgotten too
+        buffer.add(first, 3)
+        self.assertEqual(self.contents(buffer.entries), ["third", "fourth", "first"])
+
+    async def test_join_loads_once_and_live_messages_follow(self):
+        room_id, backlog = await self.registry.join("lobby", self.alice.id)
+        self.assertEqual(room_id, self.room.id)
+        self.assertEqual(self.contents(backlog), ["message 2", "message 3", "message 4"])
+
+        self.registry.record("lobby", self.entry("live"))
+        _, backlog = await self.registry.join("lobby")
+        self.assertEqual(self.contents(backlog), ["message 3", "message 4", "live"])
+        self.assertEqual((self.registry.loads, self.registry.hits), (1, 1))
+
+        await self.registry.close()
+        self.assertTrue(await RoomMembership.objects.filter(room=self.room, user=self.alice).aexists())
+
+    async def test_buffer_is_dropped_with_the_last_local_member(self):
+        await self.registry.join("lobby")
+        await self.registry.join("lobby")
+        self.registry.leave("lobby")
+        self.assertEqual(self.registry.stats()['rooms'], 1)
+        self.registry.leave("lobby")
+        self.assertEqual(self.registry.stats()['rooms'], 0)
+        # Nobody here receives the room's messages now, so they aren't kept either
+        self.registry.record("lobby", self.entry("missed"))
+        _, backlog = await self.registry.join("lobby")
+        self.assertEqual(self.contents(backlog), ["message 2", "message 3", "message 4"])
+        self.assertEqual(self.registry.loads, 2)
+
+    async def test_messages_delivered_while_loading_are_kept_newest(self):
+        loading, release = threading.Event(), threading.Event()
+        load = RoomRegistry._load
+
+        def held_load(room_id, limit):
+            loading.set()
+            release.wait(2)
+            return load(room_id, limit)
+
+        with mock.patch.object(RoomRegistry, "_load", staticmethod(held_load)):
+            join = asyncio.ensure_future(self.registry.join("lobby"))
+            self.assertTrue(await asyncio.to_thread(loading.wait, 2))
+            # Written by the batch that's being loaded, and delivered live as well
+            self.registry.record("lobby", message_entry(self.stored[-1]))
+            self.registry.record("lobby", self.entry("live"))
+            release.set()
+            _, backlog = await join
+        self.assertEqual(self.contents(backlog), ["message 3", "message 4", "live"])
+
+    async def test_rooms_past_the_limit_read_the_database(self):
+        await self.registry.join("lobby")
+        _, backlog = await self.registry.join("other")
+        self.assertEqual(backlog, [])
+        self.assertEqual(self.registry.stats()['rooms'], 1)
+
+
+class MessageSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = create_users(3)
+        cls.mine = [
+            Message.objects.create(sender=cls.alice, receiver=cls.bob, content="lunch tomorrow at noon?"),
+            Message.objects.create(sender=cls.bob, receiver=cls.alice, content="lunch lunch lunch"),
+            Message.objects.create(sender=cls.alice, receiver=cls.carol, content="<b>lunch</b> & tea"),
+            Message.objects.create(sender=cls.carol, receiver=cls.alice, content="the lunch menu was long, very long"),
+        ]
+        Message.objects.create(sender=cls.alice, receiver=cls.bob, content="rocket launch")
+        Message.objects.create(sender=cls.bob, receiver=cls.carol, content="lunch without alice")
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def search(self, url='/chat/search/', **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_only_the_users_conversations_match(self):
+        results = self.search(q="lunch")['results']
+        self.assertEqual({row['id'] for row in results}, {str(message.id) for message in self.mine})
+        with_bob = self.search(q="lunch", **{'with': self.bob.id})['results']
+        self.assertEqual({row['id'] for row in with_bob}, {str(message.id) for message in self.mine[:2]})
+
+    def test_best_match_first(self):
+        results = self.search(q="lunch")['results']
+        self.assertEqual(results[0]['id'], str(self.mine[1].id))
+        scores = [row['score'] for row in results]
+        self.assertEqual(scores, sorted(scores))
+
+    def test_last_word_matches_as_a_prefix(self):
+        self.assertEqual(len(self.search(q="lun")['results']), 4)
+        self.assertEqual(len(self.search(q="lun tomorrow")['results']), 0)
+        self.assertEqual(len(self.search(q="tomorrow lun")['results']), 1)
+
+    def test_operators_and_quotes_are_plain_text(self):
+        self.assertEqual(len(self.search(q='lunch OR "rocket')['results']), 0)
+        self.assertEqual(len(self.search(q='NOT lunch')['results']), 0)
+        self.assertEqual(self.search(q='"*')['results'], [])
+
+    def test_snippets_are_escaped_around_the_marks(self):
+        results = self.search(q="tea")['results']
+        self.assertEqual(results[0]['snippet'], "&lt;b&gt;lunch&lt;/b&gt; &amp; <mark>tea</mark>")
+
+    def test_pages_visit_every_match_once(self):
+        expected = [row['id'] for row in self.search(q="lunch")['results']]
+        page = self.search(q="lunch", page_size=1)
+        ids = [row['id'] for row in page['results']]
+        while page['next']:
+            page = self.search(page['next'])
+            ids += [row['id'] for row in page['results']]
+        self.assertEqual(ids, expected)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get('/chat/search/').status_code, 400)
+        self.assertEqual(self.client.get('/chat/search/', {'q': "lunch", 'with': "bob"}).status_code, 400)
+        self.assertEqual(self.client.get('/chat/search/', {'q': "lunch", 'after': "?"}).status_code, 400)
+
+
+class UserDirectoryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user(email="viewer@example.com", name="Viewer")
+        cls.emile = User.objects.create_user(email="zola@example.com", name="Émile")
+        cls.anna = User.objects.create_user(email="anna@example.com", name="anna")
+        cls.bob = User.objects.create_user(email="bob@example.com", name="Bob")
+        User.objects.create_superuser(email="root@example.com", name="Admin", password="unused-password")
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def names(self, url='/chat/auth/user_list/', **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return [row['name'] for row in response.data['data']]
+
+    def test_ordered_by_name_without_superusers(self):
+        self.assertEqual(self.names(), ["anna", "Bob", "Viewer", "Émile"])
+
+    def test_name_or_email_prefix_ignoring_case(self):
+        self.assertEqual(self.names(q="B"), ["Bob"])
+        self.assertEqual(self.names(q="é"), ["Émile"])
+        self.assertEqual(self.names(q="ZOLA@"), ["Émile"])
+        self.assertEqual(self.names(q="v"), ["Viewer"])
+        self.assertEqual(self.names(q="x"), [])
+
+    def test_pages_visit_every_user_once(self):
+        response = self.client.get('/chat/auth/user_list/', {'page_size': 3})
+        names = [row['name'] for row in response.data['data']]
+        names += self.names(response.data['next'])
+        self.assertEqual(names, ["anna", "Bob", "Viewer", "Émile"])
+
+    def test_revalidation_until_the_directory_changes(self):
+        response = self.client.get('/chat/auth/user_list/')
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/chat/auth/user_list/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # Logins don't change what the directory shows
+        self.bob.last_login = django_timezone.now()
+        self.bob.save(update_fields=['last_login'])
+        self.assertEqual(self.client.get('/chat/auth/user_list/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.bob.name = "Robert"
+        self.bob.save()
+        response = self.client.get('/chat/auth/user_list/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn("Robert", [row['name'] for row in response.data['data']])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class RateLimitTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice, self.bob = create_users()
+
+    async def open(self):
+        communicator = connect("/ws/user/", self.alice)
+        self.assertTrue((await communicator.connect())[0])
+        return communicator
+
+    @override_settings(CHAT_RATE_LIMITS=rate_limits(actions={"message": {"RATE": 0.001, "BURST": 1}}))
+    async def test_throttled_message_is_answered_and_not_saved(self):
+        communicator = await self.open()
+        for content in ("first", "second"):
+            await communicator.send_json_to({"conversation": str(self.bob.id), "message": content})
+        error = await receive_until(communicator, "error")
+        self.assertEqual((error["error"], error["scope"], error["action"]), ("rate_limited", "action", "message"))
+        self.assertGreater(error["retry_after"], 0)
+        await communicator.disconnect()
+        self.assertEqual([message async for message in Message.objects.values_list('content', flat=True)],
+                         ["first"])
+
+    @override_settings(CHAT_RATE_LIMITS=rate_limits())
+    async def test_oversized_frame_is_rejected_before_decoding(self):
+        communicator = await self.open()
+        await communicator.send_to(text_data="x" * 2048)
+        error = await receive_until(communicator, "error")
+        self.assertEqual((error["error"], error["scope"]), ("rate_limited", "size"))
+        await communicator.disconnect()
+
+    @override_settings(CHAT_RATE_LIMITS=rate_limits(connection={"RATE": 0.001, "BURST": 2}, close_after=3))
+    async def test_connection_closed_after_repeated_throttling(self):
+        communicator = await self.open()
+        for _ in range(5):
+            await communicator.send_json_to({"action": "heartbeat"})
+        with self.assertLogs('chat.consumers', 'WARNING'):
+            while True:
+                output = await communicator.receive_output(2)
+                if output["type"] == "websocket.close":
+                    break
+        self.assertEqual(output["code"], RATE_LIMIT_CLOSE_CODE)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_RATE_LIMITS=rate_limits())
+class MalformedFrameTests(TransactionTestCase):
+    """Each endpoint answers a frame it can't decode and keeps the connection open."""
+
+    def setUp(self):
+        self.alice, self.bob = create_users()
+
+    async def receive_frame(self, communicator, frame_type):
+        """The next frame of `frame_type` in either wire format, skipping the others."""
+        while True:
+            output = await communicator.receive_output(2)
+            self.assertEqual(output["type"], "websocket.send")
+            frame = wire.decode(output.get("text"), output.get("bytes"))
+            if frame.get("type") == frame_type:
+                return frame
+
+    async def assert_answered(self, communicator, malformed, binary=False):
+        self.assertTrue((await communicator.connect())[0])
+        with self.assertLogs('chat.consumers', 'INFO'):
+            await communicator.send_to(**{"bytes_data" if binary else "text_data": malformed})
+            error = await self.receive_frame(communicator, "error")
+        self.assertEqual(error["error"], "invalid_frame")
+
+        stats = {"action": "outbound_stats"}
+        await communicator.send_to(**({"bytes_data": wire.encode_binary(stats)} if binary else
+                                      {"text_data": wire.encode_text(stats)}))
+        await self.receive_frame(communicator, "outbound_stats")
+        await communicator.disconnect()
+
+    async def test_room_socket(self):
+        await self.assert_answered(connect("/ws/chat/lobby/", self.alice), "{not json")
+
+    async def test_presence_query_without_a_list(self):
+        await self.assert_answered(connect("/ws/chat/lobby/", self.alice), '{"action": "presence", "user_ids": 5}')
+
+    async def test_one_to_one_socket(self):
+        await self.assert_answered(connect(f"/ws/onetone/{self.bob.id}/", self.alice), '["not", "an", "object"]')
+
+    async def test_one_to_one_message_that_isnt_a_string(self):
+        communicator = connect(f"/ws/onetone/{self.bob.id}/", self.alice, [wire.MSGPACK])
+        await self.assert_answered(communicator, wire.encode_binary({"message": {"nested": 1}}), binary=True)
+        self.assertFalse(await Message.objects.aexists())
+
+    async def test_user_socket_with_msgpack(self):
+        await self.assert_answered(connect("/ws/user/", self.alice, [wire.MSGPACK]), b"\xc1", binary=True)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class UserCacheInvalidationTests(TransactionTestCase):
+    """Run without lifespan events, as under daphne."""
+
+    def setUp(self):
+        self.alice, self.bob = create_users()
+        not_started = mock.patch("chat.lifespan._started", False)
+        not_started.start()
+        self.addCleanup(not_started.stop)
+
+    async def test_other_process_invalidation_drops_cached_user(self):
+        from chat_application.asgi import application
+        communicator = WebsocketCommunicator(application, f"/ws/user/?token={AccessToken.for_user(self.alice)}")
+        self.assertTrue((await communicator.connect())[0])
+        cache = get_user_cache()
+        self.assertIsNotNone(cache.get(self.alice.id))
+
+        other_process = ProcessBus()
+        await other_process.publish({"type": "user_cache.invalidate", "user_id": str(self.alice.id)})
+        for _ in range(50):
+            if cache.get(self.alice.id) is None:
+                break
+            await asyncio.sleep(0.01)
+        self.assertIsNone(cache.get(self.alice.id))
+        await communicator.disconnect()
+
+    async def test_saves_are_published_to_other_processes(self):
+        other_process = ProcessBus()
+        received = []
+
+        async def on_invalidate(event):
+            received.append(event["user_id"])
+        other_process.subscribe("user_cache.invalidate", on_invalidate)
+        await other_process.ensure_started()
+        await get_process_bus().ensure_started()
+
+        self.bob.name = "Robert"
+        await sync_to_async(self.bob.save)()
+        for _ in range(50):
+            if received:
+                break
+            await asyncio.sleep(0.01)
+        self.assertIn(str(self.bob.id), received)
+
+
+class HistoryCacheTests(SimpleTestCase):
+    """Write-through updates of cached pages; `page_rows=3` keeps the newest three rows."""
+
+    def setUp(self):
+        self.alice, self.bob = uuid.uuid4(), uuid.uuid4()
+        self.key = conversation_key(self.alice, self.bob)
+        self.cache = HistoryPageCache(page_rows=3)
+        self.start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    def message(self, offset, sender=None, receiver=None, seen=False):
+        return SimpleNamespace(id=uuid.uuid4(), sender_id=sender or self.alice, receiver_id=receiver or self.bob,
+                               content=f"message at {offset}", timestamp=self.start + timedelta(seconds=offset),
+                               seen=seen)
+
+    def rows(self, *messages):
+        """Newest first, as the page query returns them."""
+        return [message_row(message) for message in sorted(messages, key=lambda m: m.timestamp, reverse=True)]
+
+    def cached(self, limit=3):
+        rows = self.cache.get(self.key, limit)
+        return None if rows is None else [row[3] for row in rows]
+
+    def test_new_messages_go_on_top_and_push_the_oldest_out(self):
+        self.cache.store(self.key, self.cache.begin_load(self.key), self.rows(self.message(0), self.message(1)))
+        self.assertEqual(self.cached(10), ["message at 1", "message at 0"])
+
+        newer = self.message(2, sender=self.bob, receiver=self.alice)
+        self.cache.record_messages([newer, self.message(3)])
+        self.cache.record_messages([newer])  # Repeats are ignored
+        self.assertEqual(self.cached(), ["message at 3", "message at 2", "message at 1"])
+        # The oldest row is gone, so longer pages aren't served from here any more
+        self.assertIsNone(self.cached(10))
+
+        # Older than everything cached once the page is incomplete: not on the newest page
+        self.cache.record_messages([self.message(-1)])
+        self.assertEqual(self.cached(), ["message at 3", "message at 2", "message at 1"])
+
+    def test_a_write_during_the_read_cancels_its_store(self):
+        token = self.cache.begin_load(self.key)
+        self.cache.record_messages([self.message(5)])
+        self.cache.store(self.key, token, self.rows(self.message(0)))
+        self.assertIsNone(self.cached())
+
+    def test_other_conversations_are_left_alone(self):
+        self.cache.store(self.key, self.cache.begin_load(self.key), self.rows(self.message(0)))
+        self.cache.record_messages([self.message(1, receiver=uuid.uuid4())])
+        self.assertEqual(self.cached(), ["message at 0"])
+
+    def test_seen_marks_only_the_readers_received_messages(self):
+        received = [self.message(offset, sender=self.bob, receiver=self.alice) for offset in (0, 1)]
+        sent = self.message(2)
+        self.cache.store(self.key, self.cache.begin_load(self.key), self.rows(*received, sent))
+
+        self.cache.record_seen(self.alice, self.bob, [received[0].id, sent.id])
+        seen = {row[0]: row[5] for row in self.cache.get(self.key, 3)}
+        self.assertEqual(seen, {received[0].id: True, received[1].id: False, sent.id: False})
+
+
+class HistoryCacheWriteThroughTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice, self.bob = create_users()
+        Message.objects.create(sender=self.bob, receiver=self.alice, content="hello")
+        get_history_cache().clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def contents(self):
+        response = self.client.get(f"/chat/conversations/{self.bob.id}/")
+        self.assertEqual(response.status_code, 200)
+        return [row["content"] for row in response.json()["results"]]
+
+    def test_messages_sent_over_rest_update_the_cached_page(self):
+        self.assertEqual(self.contents(), ["hello"])
+        response = self.client.post(f"/chat/conversations/{self.bob.id}/", {"content": "hi back"})
+        self.assertEqual(response.status_code, 201)
+
+        stats = get_history_cache().stats()
+        self.assertEqual(self.contents(), ["hello", "hi back"])
+        self.assertEqual(get_history_cache().stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(get_history_cache().stats()['misses'], stats['misses'])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class HistoryCacheInvalidationTests(TransactionTestCase):
+
+    async def test_other_process_invalidation_drops_the_page_without_startup_hooks(self):
+        cache = get_history_cache()
+        key = conversation_key(uuid.uuid4(), uuid.uuid4())
+        cache.store(key, cache.begin_load(key), [])
+        self.assertEqual(cache.get(key, 10), [])
+        # Started by whatever runs first (a consumer, `start_on_first_use`), not by the cache's startup hook
+        await get_process_bus().ensure_started()
+
+        await ProcessBus().publish({"type": "history.invalidate", "keys": [list(key)]})
+        for _ in range(50):
+            if cache.get(key, 10) is None:
+                break
+            await asyncio.sleep(0.01)
+        self.assertIsNone(cache.get(key, 10))
+
+
+class ProfiledViewTests(TestCase):
+
+    def setUp(self):
+        self.alice, self.bob = create_users()
+        Message.objects.create(sender=self.alice, receiver=self.bob, content="hello")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_views_with_their_own_pagination_profile_the_query(self):
+        for url in ("/chat/inbox/", f"/chat/conversations/{self.bob.id}/"):
+            with self.subTest(url=url), mock.patch("chat.profiling.stage", wraps=profiling.stage) as stage:
+                self.assertEqual(self.client.get(url).status_code, 200)
+                self.assertIn(mock.call("query"), stage.call_args_list)
+
+
+class OutboundQueueTests(SimpleTestCase):
+    """`put` never yields, so frames queued in one go pile up before the writer task runs."""
+
+    def queue(self, **kwargs):
+        self.written = []
+        self.overflows = 0
+
+        async def write(frame):
+            self.written.append(frame)
+
+        async def on_overflow():
+            self.overflows += 1
+        return OutboundQueue(write, on_overflow=on_overflow, **kwargs)
+
+    async def drain(self):
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def test_drop_oldest_drops_ephemeral_frames_first(self):
+        queue = self.queue(max_depth=3)
+        queue.put("message 1")
+        queue.put("receipt 1", ephemeral=True)
+        queue.put("receipt 2", ephemeral=True)
+        queue.put("message 2")
+        await self.drain()
+        self.assertEqual(self.written, ["message 1", "receipt 2", "message 2"])
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(self.overflows, 0)
+
+    async def test_messages_are_never_dropped_silently(self):
+        queue = self.queue(max_depth=2)
+        for i in range(3):
+            queue.put(f"message {i}")
+        queue.put("message after the overflow")
+        await self.drain()
+        self.assertEqual(self.written, [])
+        self.assertEqual(self.overflows, 1)
+
+    async def test_byte_limit_counts_too(self):
+        queue = self.queue(max_queue_bytes=10)
+        queue.put("12345", ephemeral=True)
+        queue.put("67890")
+        queue.put("x")
+        await self.drain()
+        self.assertEqual(self.written, ["67890", "x"])
+        self.assertEqual(queue.dropped, 1)
+
+    async def test_disconnect_policy_overflows_with_ephemeral_frames_queued(self):
+        queue = self.queue(max_depth=1, policy="disconnect")
+        queue.put("receipt", ephemeral=True)
+        queue.put("presence", ephemeral=True)
+        await self.drain()
+        self.assertEqual(self.written, [])
+        self.assertEqual(self.overflows, 1)
+
+    async def test_coalesce_replaces_the_queued_frame_with_the_same_key(self):
+        queue = self.queue(policy="coalesce")
+        queue.put("alice online", ephemeral=True, key="presence:alice")
+        queue.put("message")
+        queue.put("bob online", ephemeral=True, key="presence:bob")
+        queue.put("alice offline", ephemeral=True, key="presence:alice")
+        await self.drain()
+        self.assertEqual(self.written, ["alice offline", "message", "bob online"])
+        self.assertEqual(queue.coalesced, 1)
+
+        # Once written, the key starts over
+        queue.put("alice online", ephemeral=True, key="presence:alice")
+        await self.drain()
+        self.assertEqual(self.written[-1], "alice online")
+        self.assertEqual(queue.coalesced, 1)
+
+    async def test_keys_only_coalesce_under_the_coalesce_policy(self):
+        queue = self.queue()
+        queue.put("alice online", ephemeral=True, key="presence:alice")
+        queue.put("alice offline", ephemeral=True, key="presence:alice")
+        await self.drain()
+        self.assertEqual(self.written, ["alice online", "alice offline"])
+
+    async def test_frames_wait_in_the_queue_while_the_server_buffer_is_high(self):
+        buffered = [0]
+        queue = self.queue(max_depth=2, backlog=lambda: buffered[0], high_water=100)
+        buffered[0] = 500
+        queue.put("first")
+        await self.drain()
+        self.assertEqual(self.written, ["first"])
+        # Held back by the server's buffer, so the policy applies to what's queued here
+        queue.put("receipt", ephemeral=True)
+        queue.put("message 1")
+        queue.put("message 2")
+        await self.drain()
+        self.assertEqual(self.written, ["first"])
+        self.assertEqual(queue.stalls, 1)
+        self.assertEqual(queue.dropped, 1)
+
+        buffered[0] = 0
+        await asyncio.sleep(queue.DRAIN_POLL * 5)
+        self.assertEqual(self.written, ["first", "message 1", "message 2"])
+
+
+class TransportBacklogTests(SimpleTestCase):
+    """Reading daphne's Twisted write buffer through its `send` partial."""
+
+    @staticmethod
+    def daphne_send(transport):
+        def handle_reply(protocol, message):
+            pass
+        return functools.partial(handle_reply, SimpleNamespace(transport=transport))
+
+    def test_reads_the_buffer_through_a_tls_wrapper(self):
+        tcp = SimpleNamespace(dataBuffer=b"x" * 100, offset=30, _tempDataLen=5)
+        backlog = transport_backlog(self.daphne_send(SimpleNamespace(transport=tcp)))
+        self.assertEqual(backlog(), 75)
+        tcp.dataBuffer, tcp.offset, tcp._tempDataLen = b"", 0, 0
+        self.assertEqual(backlog(), 0)
+
+    def test_other_servers_have_no_backlog(self):
+        async def send(message):
+            pass
+        self.assertIsNone(transport_backlog(send))
+
+    @mock.patch("chat.outbound._uninspectable_logged", False)
+    def test_changed_transport_falls_back_to_the_queue_and_logs_once(self):
+        changed = SimpleNamespace(dataBuffer=b"", offset=0)  # No _tempDataLen
+        with self.assertLogs('chat.outbound', 'WARNING') as logs:
+            self.assertIsNone(transport_backlog(self.daphne_send(changed)))
+            self.assertIsNone(transport_backlog(self.daphne_send(SimpleNamespace())))
+        self.assertEqual(len(logs.records), 1)
+
+    @mock.patch("chat.outbound._uninspectable_logged", False)
+    def test_transport_changing_later_reads_as_empty(self):
+        tcp = SimpleNamespace(dataBuffer=b"x" * 10, offset=0, _tempDataLen=0)
+        backlog = transport_backlog(self.daphne_send(tcp))
+        del tcp.offset
+        with self.assertLogs('chat.outbound', 'WARNING'):
+            self.assertEqual(backlog(), 0)
@@ -9,7 +9,13 @@ urlpatterns = [
     path("",include(router.urls)),
     path('register/', UserCreateView.as_view(), name='user-register'),
     path('login/', LoginView.as_view(), name='login'),
+    path('inbox/', InboxListView.as_view(), name='inbox'),
+    path('presence/', PresenceView.as_view(), name='presence'),
+    path('search/', MessageSearchView.as_view(), name='message-search'),
+    path('rooms/<str:room_name>/messages/', RoomMessageListView.as_view(), name='room-messages'),
+    path('metrics/', metrics_view, name='metrics'),
     path('private-chats/', PrivateChatListCreateView.as_view(), name='private-chat-list'),
+    path('stats/cache/', CacheStatsView.as_view(), name='cache-stats'),
     path('conversations/<str:user_id>/', ConversationMessageListCreateView.as_view(), name='conversation-messages')
 ]
 
@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from . import metrics
+from .process_bus import get_process_bus
+
+
+class UserCache:
+    """
+        Bounded, in-process LRU cache of `User` rows keyed by id, with a TTL.
+
+        Shared by the WebSocket auth middleware and the consumers so a burst of
+        handshakes for the same users costs one DB lookup per user, not one
+        per connection. Entries are dropped when the user is saved or deleted
+        (see `chat.signals`), and other processes are told over the process
+        bus to drop theirs, so a ban or deactivation reaches every process's
+        WebSocket auth; the TTL bounds staleness for changes they miss.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user id -> (expires_at, user)
+        self._lock = threading.Lock()
+        self._subscribed = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        """Return the cached user, or None on a miss. Never touches the DB."""
+        key = str(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, user):
+        key = str(user.pk)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id, publish=True):
+        with self._lock:
+            self._entries.pop(str(user_id), None)
+        if publish:
+            get_process_bus().publish_threadsafe({"type": "user_cache.invalidate", "user_id": str(user_id)})
+
+    def subscribe(self):
+        """Receive other processes' invalidations once the process bus runs."""
+        if not self._subscribed:
+            get_process_bus().subscribe("user_cache.invalidate", self._on_invalidate)
+            self._subscribed = True
+
+    async def ensure_started(self):
+        self.subscribe()
+        await get_process_bus().ensure_started()
+
+    async def _on_invalidate(self, event):
+        if event["origin"] == get_process_bus().process_id:
+            return
+        self.invalidate(event["user_id"], publish=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def fetch(self, user_id):
+        """Return the user from the cache, loading it from the DB on a miss."""
+        user = self.get(user_id)
+        if user is None:
+            user = get_user_model().objects.get(id=user_id)
+            self.set(user)
+        return user
+
+    async def aget(self, user_id):
+        """Async version of `fetch`; only misses pay for the thread hop."""
+        user = self.get(user_id)
+        if user is None:
+            user = await database_sync_to_async(self._load)(user_id)
+            self.set(user)
+        return user
+
+    @staticmethod
+    def _load(user_id):
+        with metrics.DB_SECONDS.labels("user_lookup").time():
+            return get_user_model().objects.get(id=user_id)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else None,
+        }
+
+
+_cache = None
+
+
+def get_user_cache():
+    """Return the process-wide user cache, configured from settings."""
+    global _cache
+    if _cache is None:
+        options = getattr(settings, "CHAT_USER_CACHE", {})
+        _cache = UserCache(max_size=options.get("MAX_SIZE", 10000), ttl=options.get("TTL", 60))
+        # Not left to `ensure_started`: without lifespan events it only runs on the first request
+        _cache.subscribe()
+    return _cache
@@ -1,7 +1,7 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.conf import settings
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.generics import CreateAPIView, GenericAPIView
 from rest_framework import status
 from django.utils.timezone import now
@@ -15,7 +15,22 @@ from rest_framework import generics, permissions
 from django.shortcuts import get_object_or_404
 from .models import User
 from datetime import datetime
-from django.db.models import Q
+from django.db import transaction
+from .pagination import DirectoryPagination, InboxPagination, KeysetPagination
+from .user_cache import get_user_cache
+from .history_cache import conversation_key, get_history_cache
+from .presence import get_presence
+from .rooms import get_room_registry
+from .db_writer import get_database_writer
+from . import directory, history, metrics, profiling, search
+from django.http import HttpResponse
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.utils.crypto import constant_time_compare
+from .archive import ConversationArchive
+from rest_framework.utils.urls import replace_query_param
+import uuid
 
 class UserCreateView(CreateAPIView):
     """
@@ -27,7 +42,7 @@ class UserCreateView(CreateAPIView):
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        self.perform_create(serializer)
+        get_database_writer().call(self.perform_create, serializer)
         headers = self.get_success_headers(serializer.data)
         return Response({'success': True, 'message': "User Created Successfully."}, status=status.HTTP_201_CREATED, headers=headers)
 
@@ -41,7 +56,7 @@ class LoginView(GenericAPIView):
         if serializer.is_valid():
             user = serializer.validated_data['user']
             user.last_login = now()
-            user.save(update_fields=['last_login'])
+            get_database_writer().call(user.save, update_fields=['last_login'])
             return Response(
                 {
                     'success': True,
@@ -80,7 +95,7 @@ class AuthViewSet(ViewSet):
             refresh = RefreshToken(token)
             refresh.blacklist()
             user.last_logout = current_time
-            user.save()
+            get_database_writer().call(user.save, update_fields=['last_logout'])
             return Response({"success": True, "message": "User logged out successfully."}, status=status.HTTP_200_OK)
 
         except TokenError:
@@ -111,13 +126,67 @@ class AuthViewSet(ViewSet):
         
     @action(detail=False, methods=['get'])
     def user_list(self, request):
-        users = User.objects.all().exclude(is_superuser=True)
-        serializer = UserSerializer(list(users), many=True).data  
-        return Response({'success': True, 'data': serializer}, status=status.HTTP_200_OK)
+        """
+            The user directory, ordered by name, one page at a time.
+            GET [?q=<name or email prefix>][&page_size=<n>][&after=<cursor>]
+            Answers 304 Not Modified to a matching If-None-Match or
+            If-Modified-Since while the directory hasn't changed.
+        """
+        version, updated_at = directory.current_version()
+        etag = f'"directory-{version}"'
+        last_modified = int(updated_at.timestamp()) if updated_at else None
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        options = directory.get_options()
+        key = directory.cache_key(version, request.build_absolute_uri())
+        data = cache.get(key)
+        if data is None:
+            paginator = DirectoryPagination()
+            paginator.page_size, paginator.max_page_size = options["PAGE_SIZE"], options["MAX_PAGE_SIZE"]
+            rows = paginator.paginate_queryset(directory.listed_users(request.query_params.get('q', '').strip()),
+                                               request, view=self)
+            rows = directory.represent(rows)
+            data = paginator.get_paginated_response(rows).data
+            cache.set(key, data, options["CACHE_TTL"])
+
+        response = Response(data, status=status.HTTP_200_OK)
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        # Clients may keep the page but must revalidate it before use
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
 
 
 
 
+class PresenceView(profiling.ProfiledViewMixin, APIView):
+    """
+        Tells which of the given users are online.
+        GET ?user_ids=<id>,<id>,... or POST {"user_ids": [...]}
+    """
+    permission_classes = (IsAuthenticated,)
+    max_user_ids = 500
+
+    def get(self, request):
+        user_ids = [user_id for user_id in request.query_params.get('user_ids', '').split(',') if user_id]
+        return self.respond(user_ids)
+
+    def post(self, request):
+        user_ids = request.data.get('user_ids', [])
+        if not isinstance(user_ids, list):
+            return Response({"success": False, "message": "`user_ids` must be a list."}, status=status.HTTP_400_BAD_REQUEST)
+        return self.respond(user_ids)
+
+    def respond(self, user_ids):
+        if len(user_ids) > self.max_user_ids:
+            return Response({"success": False, "message": f"At most {self.max_user_ids} user ids per request."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({'success': True, 'data': {'online': get_presence().online(user_ids)}}, status=status.HTTP_200_OK)
+
+
 class PrivateChatListCreateView(generics.ListCreateAPIView):
     """
     Lists all private chats of the logged-in user and allows creating a new chat.
@@ -129,22 +198,170 @@ class PrivateChatListCreateView(generics.ListCreateAPIView):
         return PrivateChat.objects.filter(user1=self.request.user) | PrivateChat.objects.filter(user2=self.request.user)
 
 
-class ConversationMessageListCreateView(generics.ListCreateAPIView):
+class InboxListView(profiling.ProfiledViewMixin, generics.ListAPIView):
     """
-        Lists all messages between the logged-in user and another user,
-        and allows sending a new message.
+        Lists the logged-in user's conversations from the summary table, most
+        recent activity first, with `before`/`after` cursors.
+    """
+    serializer_class = ConversationSummarySerializer
+    permission_classes = (IsAuthenticated,)
+    pagination_class = InboxPagination
+
+    def get_inbox_querysets(self):
+        """One queryset per side of the pair, each covered by its own index."""
+        summaries = ConversationSummary.objects.filter(last_message_at__isnull=False)
+        user = self.request.user
+        return [summaries.filter(user_low=user), summaries.filter(user_high=user).exclude(user_low=user)]
+
+    def get_queryset(self):
+        low, high = [qs.order_by() for qs in self.get_inbox_querysets()]
+        return low.union(high, all=True).order_by('-last_message_at', '-id')
+
+    def paginate_queryset(self, queryset):
+        # Through the mixins, so the query is profiled too
+        return super().paginate_queryset(self.get_inbox_querysets())
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        user_id = request.user.id
+        users = User.objects.in_bulk({summary.other_user_id(user_id) for summary in page})
+        serializer = self.get_serializer(page, many=True, context={'user': request.user, 'users': users})
+        return self.get_paginated_response(serializer.data)
+
+
+class ConversationMessageListCreateView(profiling.ProfiledViewMixin, generics.ListCreateAPIView):
+    """
+        Lists messages between the logged-in user and another user, newest page
+        first with `before`/`after` cursors, and allows sending a new message.
     """
     serializer_class = MessageSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    pagination_class = history.HistoryPagination
 
-    def get_queryset(self):
+    def get_conversation_querysets(self):
+        """One queryset per direction, each covered by its own composite index."""
         other_user_id = self.kwargs['user_id']
-        return Message.objects.filter(
-            Q(sender=self.request.user, receiver_id=other_user_id) |
-            Q(sender_id=other_user_id, receiver=self.request.user)
-        )
+        sent = Message.objects.filter(sender=self.request.user, receiver_id=other_user_id)
+        if str(other_user_id) == str(self.request.user.id):
+            return [sent]
+        received = Message.objects.filter(sender_id=other_user_id, receiver=self.request.user)
+        return [sent, received]
+
+    def get_conversation_key(self):
+        return conversation_key(self.request.user.id, self.kwargs['user_id'])
+
+    def get_queryset(self):
+        sent, *received = [qs.order_by() for qs in self.get_conversation_querysets()]
+        return sent.union(*received, all=True).order_by('timestamp', 'id')
+
+    def paginate_queryset(self, queryset):
+        # Through the mixins, so the query is profiled too
+        return super().paginate_queryset(self.get_conversation_querysets())
+
+    def list(self, request, *args, **kwargs):
+        """History pages go through the tuple-based read path in `chat.history`."""
+        rows = self.paginate_queryset(None)
+        with profiling.stage("encode"):
+            body = history.render_page(rows, self.paginator.get_previous_link(), self.paginator.get_next_link())
+        return HttpResponse(body, content_type="application/json")
+
+    def get_archive(self):
+        """Older history moved out of the table by `archive_messages`."""
+        return ConversationArchive(self.request.user.id, self.kwargs['user_id'])
 
     def perform_create(self, serializer):
         other_user_id = self.kwargs['user_id']
         other_user = get_object_or_404(User, pk=other_user_id)
-        serializer.save(sender=self.request.user, receiver=other_user)
\ No newline at end of file
+        # The message, its inbox summary and its outbox event commit together
+        get_database_writer().call(self._save_message, serializer, other_user)
+
+    def _save_message(self, serializer, other_user):
+        with transaction.atomic():
+            serializer.save(sender=self.request.user, receiver=other_user)
+
+
+class RoomMessageListView(profiling.ProfiledViewMixin, generics.ListAPIView):
+    """
+        A room's history, newest page first, with `before`/`after` cursors.
+        The newest messages also come with the WebSocket join, along with
+        the `before` cursor to continue from here.
+    """
+    serializer_class = RoomMessageSerializer
+    permission_classes = (IsAuthenticated,)
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        room = get_object_or_404(Room, name=self.kwargs['room_name'])
+        return RoomMessage.objects.filter(room=room)
+
+
+class MessageSearchView(profiling.ProfiledViewMixin, APIView):
+    """
+        Full-text search over the logged-in user's messages, best match first.
+        GET ?q=<text>[&with=<user_id>][&page_size=<n>][&after=<cursor>]
+        Snippets come HTML-escaped with the matches wrapped in <mark> tags.
+    """
+    permission_classes = (IsAuthenticated,)
+    page_size = 20
+    max_page_size = 100
+
+    def get(self, request):
+        if not search.is_available():
+            return Response({"success": False, "message": "Search is not available on this database."},
+                            status=status.HTTP_501_NOT_IMPLEMENTED)
+
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response({"success": False, "message": "`q` is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        other_user_id = request.query_params.get('with')
+        if other_user_id:
+            try:
+                other_user_id = uuid.UUID(other_user_id)
+            except ValueError:
+                return Response({"success": False, "message": "`with` must be a user id."},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            page_size = max(1, min(int(request.query_params.get('page_size', self.page_size)), self.max_page_size))
+        except ValueError:
+            page_size = self.page_size
+        after = request.query_params.get('after')
+        after = search.decode_search_cursor(after) if after else None
+
+        with profiling.stage("query"):
+            rows = search.search_messages(request.user.id, text, page_size + 1, after=after,
+                                          other_user_id=other_user_id or None)
+        next_link = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            cursor = search.encode_search_cursor(rows[-1].score, rows[-1].fts_rowid)
+            next_link = replace_query_param(request.build_absolute_uri(), 'after', cursor)
+
+        return Response({
+            'next': next_link,
+            'results': MessageSearchResultSerializer(rows, many=True).data,
+        }, status=status.HTTP_200_OK)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint for this process's metrics (see `chat.metrics`)."""
+    token = getattr(settings, "CHAT_METRICS", {}).get("TOKEN")
+    if token and not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class CacheStatsView(APIView):
+    """
+        Hit/miss counters of the in-process caches, for sizing them.
+        Only covers the process that serves the request.
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response({'success': True, 'data': {
+            'user_cache': get_user_cache().stats(),
+            'rooms': get_room_registry().stats(),
+            'history_pages': get_history_cache().stats(),
+        }}, status=status.HTTP_200_OK)
@@ -0,0 +1,121 @@
+"""
+    Wire formats for the WebSocket consumers.
+
+    JSON text frames are the default. Clients that offer the `msgpack`
+    subprotocol during the handshake get binary MessagePack frames instead,
+    with the short keys from `COMPACT_KEYS` and ids as raw 16-byte UUIDs.
+"""
+import json
+import uuid
+from urllib.parse import parse_qs
+import msgpack
+
+MSGPACK = "msgpack"
+
+COMPACT_KEYS = {
+    "type": "t",
+    "action": "a",
+    "message": "m",
+    "message_id": "id",
+    "message_ids": "ids",
+    "sender": "s",
+    "sender_id": "si",
+    "receiver_id": "r",
+    "seen": "sn",
+    "timestamp": "ts",
+    "reader_id": "rd",
+    "up_to": "u",
+    "up_to_timestamp": "ut",
+    "count": "c",
+    "user_ids": "us",
+    "online": "on",
+}
+EXPANDED_KEYS = {short: key for key, short in COMPACT_KEYS.items()}
+
+# Fields holding one UUID or a list of them, sent as raw bytes in MessagePack
+UUID_FIELDS = {"message_id", "sender_id", "receiver_id", "reader_id", "up_to", "message_ids", "user_ids", "online"}
+
+
+def negotiate(scope):
+    """Pick the subprotocol to accept: `msgpack` if offered, else plain JSON (None)."""
+    return MSGPACK if MSGPACK in scope.get("subprotocols", ()) else None
+
+
+def wants_batching(scope):
+    """Clients opt into coalesced array frames with `?batch=1` on the handshake URL."""
+    query_params = parse_qs(scope.get("query_string", b"").decode())
+    return query_params.get("batch", ["0"])[0] in ("1", "true")
+
+
+def resume_point(scope):
+    """
+        Where a reconnecting client left off: `?since=<message id>` or a
+        history cursor (`?since=<cursor>`). None for a fresh connection.
+    """
+    query_params = parse_qs(scope.get("query_string", b"").decode())
+    return query_params.get("since", [None])[0] or None
+
+
+def _uuid_to_bytes(value):
+    try:
+        return uuid.UUID(str(value)).bytes
+    except ValueError:
+        return value
+
+
+def _bytes_to_uuid(value):
+    if isinstance(value, bytes) and len(value) == 16:
+        return str(uuid.UUID(bytes=value))
+    return value
+
+
+def _convert_ids(value, convert):
+    if isinstance(value, list):
+        return [convert(item) for item in value]
+    return convert(value)
+
+
+def encode_text(payload):
+    return json.dumps(payload)
+
+
+def encode_binary(payload):
+    compact = {}
+    for key, value in payload.items():
+        if key in UUID_FIELDS and value is not None:
+            value = _convert_ids(value, _uuid_to_bytes)
+        compact[COMPACT_KEYS.get(key, key)] = value
+    return msgpack.packb(compact, use_bin_type=True)
+
+
+def encode_frames(payload):
+    """
+        Encode a broadcast payload once per format. The result is merged into
+        the channel layer event so recipients only pick their format and write
+        it out.
+    """
+    return {"text": encode_text(payload), "bin": encode_binary(payload)}
+
+
+def decode(text_data=None, bytes_data=None):
+    """Decode an inbound frame to a dict with the long keys. Raises ValueError on bad input."""
+    if bytes_data is None:
+        data = json.loads(text_data)
+        if not isinstance(data, dict):
+            raise ValueError("Frame is not an object")
+        return data
+
+    try:
+        compact = msgpack.unpackb(bytes_data, raw=False)
+    except Exception as e:
+        raise ValueError(f"Invalid MessagePack frame: {e}")
+    if not isinstance(compact, dict):
+        raise ValueError("Frame is not a map")
+
+    data = {}
+    for key, value in compact.items():
+        key = EXPANDED_KEYS.get(key, key)
+        if key in UUID_FIELDS and value is not None:
+            value = _convert_ids(value, _bytes_to_uuid)
+        data[key] = value
+    return data
@@ -0,0 +1,223 @@
+import asyncio
+import atexit
+import functools
+import logging
+import uuid
+from collections import deque
+from django.conf import settings
+from django.db import transaction
+from .db_writer import get_database_writer
+from .history_cache import get_history_cache
+from .lifespan import on_shutdown
+from .models import Message, RoomMessage
+from .summaries import record_messages
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+        Write-behind queue for chat messages.
+
+        Messages get their UUID when they are queued, so the id can be
+        broadcast right away. Rows are inserted with ``bulk_create`` once
+        ``batch_size`` messages are pending or ``flush_interval`` seconds
+        have passed, whichever comes first.
+
+        ``durability`` decides when ``save`` returns:
+        - "flush": after the batch holding the message is committed
+        - "enqueue": as soon as the message is queued
+    """
+    DURABILITY_MODES = ("flush", "enqueue")
+
+    def __init__(self, batch_size=200, flush_interval=0.02, durability="flush"):
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability!r}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self._pending = deque()
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+        self._closing = False
+        self._atexit_registered = False
+
+    async def save(self, sender_id, receiver_id, content):
+        """Queue a message and return the (unsaved until flushed) `Message`."""
+        return await self.save_instance(
+            Message(id=uuid.uuid4(), sender_id=sender_id, receiver_id=receiver_id, content=content)
+        )
+
+    async def save_instance(self, message):
+        """Queue an unsaved row with its id already set; returns it according to `durability`."""
+        message, future = self.enqueue_instance(message, wait=self.durability == "flush")
+        if future is not None:
+            await future
+        return message
+
+    def enqueue(self, sender_id, receiver_id, content, wait=False):
+        """
+            Add a message to the queue. When `wait` is set, a future is returned
+            that resolves once the message is committed.
+        """
+        message = Message(id=uuid.uuid4(), sender_id=sender_id, receiver_id=receiver_id, content=content)
+        return self.enqueue_instance(message, wait=wait)
+
+    def enqueue_instance(self, message, wait=False):
+        self._ensure_started()
+        if self._closing:
+            raise RuntimeError("Message writer is shutting down.")
+        future = self._loop.create_future() if wait else None
+        self._pending.append((message, future))
+
+        # Wake the flusher on the first message of a batch and once a batch is full
+        if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return message, future
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        if self._loop is loop and self._closing:
+            raise RuntimeError("Message writer is shutting down.")
+        if self._loop is not loop:
+            # A new event loop (a restarted server, a test) starts over; `close` is sticky per loop
+            self._closing = False
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+        if self._pending:
+            self._wakeup.set()
+        if not self._atexit_registered:
+            atexit.register(self.drain_sync)
+            self._atexit_registered = True
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            # Give the batch a chance to fill up before writing it
+            if len(self._pending) < self.batch_size and not self._closing:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+            while self._pending:
+                count = min(self.batch_size, len(self._pending))
+                batch = [self._pending.popleft() for _ in range(count)]
+                await self._flush(batch)
+
+            if self._closing:
+                return
+
+    async def _flush(self, batch):
+        messages = [message for message, _ in batch]
+        try:
+            await get_database_writer().run(self._write, messages)
+            errors = [None] * len(messages)
+        except Exception as e:
+            logger.warning("Batch save of %s messages failed, retrying one by one: %s", len(messages), e)
+            try:
+                errors = await get_database_writer().run(self._write_each, messages)
+            except Exception as e:
+                # E.g. the retry's own transaction couldn't start; fail the batch but keep the writer running
+                logger.error("Saving %s messages one by one failed: %s", len(messages), e)
+                errors = [e] * len(messages)
+
+        for (message, future), error in zip(batch, errors):
+            if future is None or future.done():
+                continue
+            if error is None:
+                future.set_result(message)
+            else:
+                future.set_exception(error)
+
+    @staticmethod
+    def _write(messages):
+        with metrics.DB_SECONDS.labels("message_batch").time(), transaction.atomic():
+            Message.objects.bulk_create(messages)
+            record_messages(messages)
+            transaction.on_commit(functools.partial(get_history_cache().record_messages, messages))
+
+    @classmethod
+    def _write_each(cls, messages):
+        """Insert rows one at a time so a single bad row doesn't lose the whole batch."""
+        errors = []
+        for message in messages:
+            try:
+                cls._write([message])
+                errors.append(None)
+            except Exception as e:
+                logger.error("Database save error: %s", e)
+                errors.append(e)
+        return errors
+
+    async def close(self):
+        """Stop accepting messages and wait until everything queued is written."""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        self._closing = True
+        if self._task is None or self._task.done():
+            return
+        self._wakeup.set()
+        await self._task
+
+    def drain_sync(self):
+        """Write whatever is still queued from a synchronous context (interpreter exit)."""
+        self._closing = True
+        while self._pending:
+            count = min(self.batch_size, len(self._pending))
+            messages = [self._pending.popleft()[0] for _ in range(count)]
+            try:
+                self._write(messages)
+            except Exception:
+                self._write_each(messages)
+
+
+class RoomMessageWriter(MessageWriter):
+    """The same write-behind queue for `RoomMessage` rows."""
+
+    @staticmethod
+    def _write(messages):
+        with metrics.DB_SECONDS.labels("room_message_batch").time(), transaction.atomic():
+            RoomMessage.objects.bulk_create(messages)
+
+
+_writer = None
+
+
+def get_message_writer():
+    """Return the process-wide message writer, configured from settings."""
+    global _writer
+    if _writer is None:
+        options = getattr(settings, "CHAT_MESSAGE_WRITER", {})
+        _writer = MessageWriter(
+            batch_size=options.get("BATCH_SIZE", 200),
+            flush_interval=options.get("FLUSH_INTERVAL", 0.02),
+            durability=options.get("DURABILITY", "flush"),
+        )
+        on_shutdown(_writer.close)
+    return _writer
+
+
+_room_writer = None
+
+
+def get_room_message_writer():
+    """Return the process-wide room message writer, configured like the message writer."""
+    global _room_writer
+    if _room_writer is None:
+        options = getattr(settings, "CHAT_MESSAGE_WRITER", {})
+        _room_writer = RoomMessageWriter(
+            batch_size=options.get("BATCH_SIZE", 200),
+            flush_interval=options.get("FLUSH_INTERVAL", 0.02),
+            durability=options.get("DURABILITY", "flush"),
+        )
+        on_shutdown(_room_writer.close)
+    return _room_writer
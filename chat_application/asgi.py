@@ -29,12 +29,21 @@ from chat.routing import websocket_urlpatterns
     Custom Middleware, Sender Access token send request
 """
 from chat.middleware import TokenAuthMiddlewareStack
+from chat.lifespan import lifespan_app, on_startup, start_on_first_use
+from chat.outbox import get_outbox_dispatcher
+from chat.history_cache import get_history_cache
+from chat.user_cache import get_user_cache
+
+on_startup(get_outbox_dispatcher().ensure_started)
+on_startup(get_history_cache().ensure_started)
+on_startup(get_user_cache().ensure_started)
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": TokenAuthMiddlewareStack(
+    "http": start_on_first_use(get_asgi_application()),
+    "websocket": start_on_first_use(TokenAuthMiddlewareStack(
         URLRouter(
             websocket_urlpatterns
         )
-    ),
+    )),
+    "lifespan": lifespan_app,
 })
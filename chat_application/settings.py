@@ -39,6 +39,7 @@ INSTALLED_APPS += [
 ]
 
 MIDDLEWARE = [
+    'chat.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -74,10 +75,27 @@ WSGI_APPLICATION = 'chat_application.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLITE_WAL tunes every SQLite connection for concurrent use: WAL so reads don't wait
+# for the writer, synchronous=NORMAL (commits survive an app crash; a power loss can
+# drop the last few), and IMMEDIATE transactions, which take the write lock up front
+# and wait for it instead of failing when a reader upgrades to a writer.
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",  # KiB
+    "PRAGMA mmap_size=134217728",
+]
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db3.sqlite3',
+        'OPTIONS': {
+            'init_command': ";".join(SQLITE_PRAGMAS),
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        } if config("SQLITE_WAL", default=True, cast=bool) else {},
     }
 }
 
@@ -133,12 +151,197 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Single-node deployments and CI can skip Redis with CHANNEL_BACKEND=memory
+if config("CHANNEL_BACKEND", default="redis") == "memory":
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.ShardedInMemoryChannelLayer',
+            'CONFIG': {
+                "capacity": int(config("CHANNEL_CAPACITY", default=1000)),
+                "shards": int(config("CHANNEL_SHARDS", default=16)),
+            },
+        },
+    }
+
 # CHANNEL_LAYERS = {
 #     "default": {
 #         "BACKEND": "channels.layers.InMemoryChannelLayer",
 #     },
 # }
 
+## write-behind message persistence
+# DURABILITY: "flush" acks a message after its batch is committed,
+# "enqueue" acks as soon as it is queued in memory.
+CHAT_MESSAGE_WRITER = {
+    "BATCH_SIZE": int(config("CHAT_WRITE_BATCH_SIZE", default=200)),
+    "FLUSH_INTERVAL": float(config("CHAT_WRITE_FLUSH_INTERVAL", default=0.02)),
+    "DURABILITY": config("CHAT_WRITE_DURABILITY", default="flush"),
+}
+
+# Writes from consumers and the auth/message views go through one writer thread that
+# commits up to MAX_BATCH of them per transaction (see chat.db_writer). On by default
+# for SQLite, which only allows one writer at a time.
+CHAT_DB_WRITER = {
+    "MAX_BATCH": int(config("CHAT_DB_WRITER_MAX_BATCH", default=64)),
+}
+if config("CHAT_DB_WRITER_ENABLED", default="") != "":
+    CHAT_DB_WRITER["ENABLED"] = config("CHAT_DB_WRITER_ENABLED", cast=bool)
+
+# Group chat rooms: each process keeps the RECENT_MESSAGES newest messages of up to
+# MAX_ROOMS rooms with local members in memory, sent to clients as they join
+CHAT_ROOMS = {
+    "RECENT_MESSAGES": int(config("CHAT_ROOMS_RECENT_MESSAGES", default=50)),
+    "MAX_ROOMS": int(config("CHAT_ROOMS_MAX_ROOMS", default=1000)),
+}
+
+# In-process cache of each conversation's newest history page (PAGE_SIZE messages),
+# kept current as messages are saved and seen. Bounded by MAX_ENTRIES conversations
+# and about MAX_BYTES of rows; entries expire after TTL seconds. MAX_BYTES=0 turns it off.
+CHAT_HISTORY_CACHE = {
+    "PAGE_SIZE": int(config("CHAT_HISTORY_CACHE_PAGE_SIZE", default=50)),
+    "MAX_ENTRIES": int(config("CHAT_HISTORY_CACHE_MAX_ENTRIES", default=10000)),
+    "MAX_BYTES": int(config("CHAT_HISTORY_CACHE_MAX_BYTES", default=32 * 1024 * 1024)),
+    "TTL": float(config("CHAT_HISTORY_CACHE_TTL", default=300)),
+}
+
+# In-process cache of authenticated users (WebSocket handshakes, sender names)
+CHAT_USER_CACHE = {
+    "MAX_SIZE": int(config("CHAT_USER_CACHE_SIZE", default=10000)),
+    "TTL": float(config("CHAT_USER_CACHE_TTL", default=60)),
+}
+
+# User directory (/chat/auth/user_list/): pages are cached for CACHE_TTL seconds per
+# directory version (in the default Django cache), so edits show up immediately.
+CHAT_DIRECTORY = {
+    "PAGE_SIZE": int(config("CHAT_DIRECTORY_PAGE_SIZE", default=100)),
+    "MAX_PAGE_SIZE": int(config("CHAT_DIRECTORY_MAX_PAGE_SIZE", default=500)),
+    "CACHE_TTL": int(config("CHAT_DIRECTORY_CACHE_TTL", default=300)),
+}
+
+# Presence: changes are announced to other processes at most once per DEBOUNCE
+# seconds; connections that send heartbeats expire after HEARTBEAT_TIMEOUT.
+CHAT_PRESENCE = {
+    "SHARDS": int(config("CHAT_PRESENCE_SHARDS", default=16)),
+    "DEBOUNCE": float(config("CHAT_PRESENCE_DEBOUNCE", default=1.0)),
+    "HEARTBEAT_TIMEOUT": float(config("CHAT_PRESENCE_HEARTBEAT_TIMEOUT", default=60)),
+    "SNAPSHOT_INTERVAL": float(config("CHAT_PRESENCE_SNAPSHOT_INTERVAL", default=30)),
+}
+
+# Outbound frame coalescing for clients connecting with ?batch=1: frames within
+# WINDOW seconds go out as one array frame, flushed early at MAX_FRAMES/MAX_BYTES.
+CHAT_OUTBOUND_BATCHING = {
+    "WINDOW": float(config("CHAT_BATCH_WINDOW", default=0.005)),
+    "MAX_FRAMES": int(config("CHAT_BATCH_MAX_FRAMES", default=64)),
+    "MAX_BYTES": int(config("CHAT_BATCH_MAX_BYTES", default=65536)),
+}
+
+# Per-connection outbound queue limits. Past MAX_DEPTH frames or MAX_BYTES bytes,
+# POLICY is "drop_oldest" (drop ephemeral frames such as receipts and presence),
+# "coalesce" (also replace queued frames superseded by a newer one) or
+# "disconnect" (close with code 4008 so the client resyncs). Chat messages are
+# never dropped: if only they are left, the connection is closed. Under daphne,
+# frames stay in this queue while the server holds more than TRANSPORT_HIGH_WATER
+# bytes it couldn't write to the socket yet.
+CHAT_OUTBOUND_QUEUE = {
+    "MAX_DEPTH": int(config("CHAT_OUTBOUND_MAX_DEPTH", default=1000)),
+    "MAX_BYTES": int(config("CHAT_OUTBOUND_MAX_BYTES", default=4 * 1024 * 1024)),
+    "POLICY": config("CHAT_OUTBOUND_POLICY", default="coalesce"),
+    "TRANSPORT_HIGH_WATER": int(config("CHAT_OUTBOUND_TRANSPORT_HIGH_WATER", default=256 * 1024)),
+}
+
+# Outbox of channel layer events for messages created outside the consumers (REST).
+# Published in batches of BATCH_SIZE right after commit, and polled every
+# POLL_INTERVAL seconds; a claimed event is retried after LEASE seconds.
+CHAT_OUTBOX = {
+    "BATCH_SIZE": int(config("CHAT_OUTBOX_BATCH_SIZE", default=100)),
+    "POLL_INTERVAL": float(config("CHAT_OUTBOX_POLL_INTERVAL", default=1.0)),
+    "LEASE": float(config("CHAT_OUTBOX_LEASE", default=30)),
+}
+
+# Reconnecting with ?since=<message id or cursor> replays missed messages in
+# chunks of CHUNK_SIZE; past MAX_MESSAGES the client is told to resync over REST.
+CHAT_RESUME = {
+    "CHUNK_SIZE": int(config("CHAT_RESUME_CHUNK_SIZE", default=100)),
+    "MAX_MESSAGES": int(config("CHAT_RESUME_MAX_MESSAGES", default=500)),
+}
+
+# `archive_messages` moves messages older than OLDER_THAN_DAYS into compressed
+# per-conversation segment files under ROOT, BLOCK_SIZE messages per block.
+CHAT_ARCHIVE = {
+    "ROOT": config("CHAT_ARCHIVE_ROOT", default=str(BASE_DIR / "archive")),
+    "OLDER_THAN_DAYS": int(config("CHAT_ARCHIVE_OLDER_THAN_DAYS", default=90)),
+    "BLOCK_SIZE": int(config("CHAT_ARCHIVE_BLOCK_SIZE", default=256)),
+}
+
+# Prometheus text endpoint at /chat/metrics/. With a TOKEN set, scrapers must send
+# "Authorization: Bearer <TOKEN>"; without one it is open, so keep it internal.
+CHAT_METRICS = {
+    "TOKEN": config("CHAT_METRICS_TOKEN", default=""),
+}
+
+# Sampled per-handler profiling: SAMPLE_RATE of consumer events and API requests are
+# traced stage by stage, and traces slower than SLOW_THRESHOLD seconds are appended
+# to FILE (rotated at MAX_BYTES). Summarize them with `manage.py profile_summary`.
+CHAT_PROFILING = {
+    "SAMPLE_RATE": float(config("CHAT_PROFILING_SAMPLE_RATE", default=0.0)),
+    "SLOW_THRESHOLD": float(config("CHAT_PROFILING_SLOW_THRESHOLD", default=0.1)),
+    "FILE": config("CHAT_PROFILING_FILE", default=str(BASE_DIR / "logs" / "slow_traces.jsonl")),
+    "MAX_BYTES": int(config("CHAT_PROFILING_MAX_BYTES", default=10 * 1024 * 1024)),
+    "BACKUP_COUNT": int(config("CHAT_PROFILING_BACKUP_COUNT", default=5)),
+}
+
+# Token-bucket limits on inbound WebSocket frames (RATE per second, BURST at most).
+# CONNECTION and USER apply to every frame before it is decoded, USER across all of
+# a user's connections in every process; ACTIONS per connection and action once it
+# is decoded. A connection throttled CLOSE_AFTER frames in a row is closed (4029).
+CHAT_RATE_LIMITS = {
+    "MAX_FRAME_BYTES": int(config("CHAT_RATE_LIMIT_MAX_FRAME_BYTES", default=64 * 1024)),
+    "CONNECTION": {
+        "RATE": float(config("CHAT_RATE_LIMIT_CONNECTION_RATE", default=20)),
+        "BURST": int(config("CHAT_RATE_LIMIT_CONNECTION_BURST", default=40)),
+    },
+    "USER": {
+        "RATE": float(config("CHAT_RATE_LIMIT_USER_RATE", default=30)),
+        "BURST": int(config("CHAT_RATE_LIMIT_USER_BURST", default=60)),
+    },
+    "ACTIONS": {
+        "message": {"RATE": 5, "BURST": 15},
+        "mark_seen": {"RATE": 4, "BURST": 10},
+        "presence": {"RATE": 1, "BURST": 5},
+        "outbound_stats": {"RATE": 1, "BURST": 2},
+    },
+    "SYNC_INTERVAL": float(config("CHAT_RATE_LIMIT_SYNC_INTERVAL", default=1.0)),
+    "CLOSE_AFTER": int(config("CHAT_RATE_LIMIT_CLOSE_AFTER", default=50)),
+}
+
+# Read receipts from one connection are coalesced over this many seconds
+CHAT_SEEN_RECEIPT_WINDOW = float(config("CHAT_SEEN_RECEIPT_WINDOW", default=0.25))
+
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'default': {
+            'format': '%(asctime)s %(levelname)s %(name)s: %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'default',
+        },
+    },
+    'loggers': {
+        # DEBUG also logs every message received and receipt written
+        'chat': {
+            'handlers': ['console'],
+            'level': config("CHAT_LOG_LEVEL", default="INFO"),
+            'propagate': False,
+        },
+    },
+}
+
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (